@@ -39,6 +39,9 @@ def create_app() -> Flask:
         DEBUG=os.getenv("DEBUG", "1") in ("1", "true", "True"),
         VERSION=os.getenv("APP_VERSION", "0.1.0"),
         TZ=os.getenv("TZ", "Asia/Tokyo"),
+        METRICS_ENABLED=os.getenv("METRICS_ENABLED", "1") in ("1", "true", "True"),
+        SLOW_QUERY_ENABLED=os.getenv("SLOW_QUERY_ENABLED", "0") in ("1", "true", "True"),
+        QUERY_DEBUG=os.getenv("QUERY_DEBUG", "0") in ("1", "true", "True"),
     )
 
     # config.py があれば上書き
@@ -61,6 +64,34 @@ def create_app() -> Flask:
     except Exception:
         pass
 
+    # リクエストIDをレスポンスヘッダーに返す（ログの request_id と対応）
+    try:
+        from .logging import init_request_id  # type: ignore
+        init_request_id(app)
+    except Exception:
+        pass
+
+    # リクエスト計測（/metrics）
+    try:
+        from .utils.metrics import init_metrics
+        init_metrics(app)
+    except Exception as e:
+        print(f"⚠️ メトリクス初期化エラー: {e}")
+
+    # スロークエリ記録（SLOW_QUERY_ENABLED=1 のときのみ）
+    try:
+        from .utils.slow_query import init_slow_query_log
+        init_slow_query_log(app)
+    except Exception as e:
+        print(f"⚠️ スロークエリ記録初期化エラー: {e}")
+
+    # クエリ件数チェック・N+1 検出（QUERY_DEBUG=1 のときのみリクエスト単位で警告）
+    try:
+        from .utils.query_budget import init_query_debug
+        init_query_debug(app)
+    except Exception as e:
+        print(f"⚠️ クエリデバッグ初期化エラー: {e}")
+
     # CSRF トークンをテンプレートで使えるようにする
     @app.context_processor
     def inject_csrf():
@@ -1,10 +1,14 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify, Response
 from werkzeug.utils import secure_filename
 from app.utils.decorators import require_roles, require_app_enabled
+from app.utils import blob_store, chunked_upload, derivatives, extraction, image_payload, material_match, page_dedup, pdf_text, resilience, storage, tiles, usage
 import os
-from datetime import datetime
+import logging
+import pathlib
+import queue
+import threading
 import json
-import base64
+from urllib.parse import quote
 import cloudinary
 import cloudinary.uploader
 from dotenv import load_dotenv
@@ -12,6 +16,8 @@ from dotenv import load_dotenv
 # 環境変数を読み込む
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 auto_estimate_bp = Blueprint('auto_estimate', __name__, url_prefix='/auto_estimate')
 
 # Cloudinary設定
@@ -22,8 +28,15 @@ cloudinary.config(
     secure=True
 )
 
+# 解析の進捗ストリームで、イベントが無い間に送るコメント行の間隔（秒）
+# プロキシのアイドルタイムアウトによる切断を防ぎ、クライアントの切断（キャンセル）を検知する
+ANALYZE_STREAM_PING_SECONDS = float(os.getenv('ANALYZE_STREAM_PING_SECONDS', '15'))
+
+# 一覧の1ページの件数
+AUTO_ESTIMATE_PAGE_SIZE = int(os.getenv('AUTO_ESTIMATE_PAGE_SIZE', '50'))
+
 # アップロードフォルダの設定（フォールバック用）
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static', 'uploads', 'blueprints')
+UPLOAD_FOLDER = storage.LOCAL_DIR
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
 
 # フォルダが存在しない場合は作成（フォールバック用）
@@ -32,11 +45,64 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+
+def _store_blueprint(cur, auto_estimate_id, file, filename, file_ext, digest=None):
+    """
+    設計図を保存して T_設計図ファイル に登録する
+    
+    実体は内容の SHA-256 ごとに1件だけ保存し（app/utils/blob_store.py）、同じ内容が
+    保存済みならアップロードしません。サムネイル・プレビューと拡大表示用のタイルはバックグラウンドで作ります。保存先は STORAGE_BACKEND で、書き込めない場合
+    （障害でサーキットブレーカーが開いていてすぐに失敗する場合を含む）は STORAGE_FALLBACK に保存します。
+    
+    Args:
+        digest: 計算済みの content_hash（分割アップロードは確定時に計算済み）
+    
+    Returns:
+        str: ファイルパス（app/utils/storage.py の形式）
+    """
+    digest, filepath = blob_store.acquire(cur, file, file_ext, digest=digest)
+    # 一覧・解析画面のサムネイルと拡大表示用のタイルを先に作っておく
+    derivatives.schedule(digest, filepath, file_ext)
+    tiles.schedule(digest, filepath, file_ext)
+    cur.execute('''
+        INSERT INTO "T_設計図ファイル" ("自動見積もりID", "ファイル名", "ファイルパス", "ファイルタイプ", "content_hash")
+        VALUES (%s, %s, %s, %s, %s)
+    ''', (auto_estimate_id, filename, filepath, file_ext, digest))
+    return filepath
+
+
+def _analysis_queued(message=None):
+    """OpenAI のブレーカーが開いているときの応答内容（解析は後で再開する）"""
+    return {
+        'queued': True,
+        'retry_after': int(resilience.breaker('openai').retry_after()) + 1,
+        'error': message or 'AI解析サービスに一時的に接続できません。設計図は保存済みです。しばらくしてから自動で再開します。',
+    }
+
+def _spooled_blueprints(claimed):
+    """
+    分割アップロードした設計図を順に開く（app/utils/chunked_upload.py）
+    
+    Args:
+        claimed: chunked_upload.claim の戻り値 (meta, パス) のリスト
+    
+    Yields:
+        tuple: (ファイル名, 拡張子, ファイルオブジェクト, ファイルのパス（pathlib.Path）, content_hash, upload_id)
+    """
+    for meta, path in claimed:
+        with open(path, 'rb') as f:
+            yield meta['filename'], meta['file_ext'], f, pathlib.Path(path), meta['sha256'], meta['upload_id']
+
 @auto_estimate_bp.route('/')
 @require_app_enabled('signboard')
 @require_roles('tenant_admin', 'admin')
 def index():
-    """自動見積もり一覧"""
+    """
+    自動見積もり一覧（新しい順に AUTO_ESTIMATE_PAGE_SIZE 件ずつ）
+    
+    全件を数えずに1件多く取得して次のページの有無を判定します
+    （migrations/012 の (テナントID, 作成日時) のインデックスで、件数が増えても先頭のページは速い）。
+    """
     from app.utils.db import get_db_connection
     
     tenant_id = session.get('tenant_id')
@@ -44,6 +110,8 @@ def index():
         flash('ログインが必要です', 'error')
         return redirect(url_for('select_login'))
     
+    page = max(request.args.get('page', 1, type=int), 1)
+    
     conn = get_db_connection()
     cur = conn.cursor()
     
@@ -51,14 +119,17 @@ def index():
         SELECT "ID", "顧客名", "ステータス", "作成日時"
         FROM "T_自動見積もり"
         WHERE "テナントID" = %s
-        ORDER BY "作成日時" DESC
-    ''', (tenant_id,))
+        ORDER BY "作成日時" DESC, "ID" DESC
+        LIMIT %s OFFSET %s
+    ''', (tenant_id, AUTO_ESTIMATE_PAGE_SIZE + 1, (page - 1) * AUTO_ESTIMATE_PAGE_SIZE))
     
     auto_estimates = cur.fetchall()
     cur.close()
     conn.close()
     
-    return render_template('auto_estimate_list.html', auto_estimates=auto_estimates)
+    has_next = len(auto_estimates) > AUTO_ESTIMATE_PAGE_SIZE
+    return render_template('auto_estimate_list.html', auto_estimates=auto_estimates[:AUTO_ESTIMATE_PAGE_SIZE],
+                           page=page, has_next=has_next)
 
 @auto_estimate_bp.route('/new', methods=['GET', 'POST'])
 @require_app_enabled('signboard')
@@ -77,15 +148,18 @@ def new():
             flash('顧客名を入力してください', 'error')
             return redirect(url_for('auto_estimate.new'))
         
-        # ファイルチェック
-        if 'blueprint_files' not in request.files:
+        # ファイルチェック（分割アップロードしたファイルは upload_ids で受け取る）
+        files = [file for file in request.files.getlist('blueprint_files') if file.filename != '']
+        upload_ids = request.form.getlist('upload_ids')
+        
+        if not files and not upload_ids:
             flash('ファイルが選択されていません', 'error')
             return redirect(url_for('auto_estimate.new'))
         
-        files = request.files.getlist('blueprint_files')
-        
-        if not files or files[0].filename == '':
-            flash('ファイルが選択されていません', 'error')
+        try:
+            claimed = [chunked_upload.claim(upload_id, tenant_id) for upload_id in upload_ids]
+        except chunked_upload.UploadError as e:
+            flash(str(e), 'error')
             return redirect(url_for('auto_estimate.new'))
         
         from app.utils.db import get_db_connection
@@ -102,43 +176,21 @@ def new():
             
             auto_estimate_id = cur.fetchone()[0]
             
-            # ファイルをCloudinaryにアップロード
+            # ファイルをCloudinaryにアップロード（失敗したらローカルに保存）
             uploaded_files = []
             for file in files:
                 if file and allowed_file(file.filename):
                     filename = secure_filename(file.filename)
-                    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                    unique_filename = f"{auto_estimate_id}_{timestamp}_{filename}"
-                    
-                    # Cloudinaryにアップロード
-                    try:
-                        upload_result = cloudinary.uploader.upload(
-                            file,
-                            folder="signboard/blueprints",
-                            public_id=unique_filename.rsplit('.', 1)[0],  # 拡張子を除いた名前
-                            resource_type="auto"  # 画像とPDFを自動判定
-                        )
-                        cloudinary_url = upload_result['secure_url']
-                        
-                        # データベースにCloudinary URLを保存
-                        cur.execute('''
-                            INSERT INTO "T_設計図ファイル" ("自動見積もりID", "ファイル名", "ファイルパス", "ファイルタイプ")
-                            VALUES (%s, %s, %s, %s)
-                        ''', (auto_estimate_id, filename, cloudinary_url, filename.rsplit('.', 1)[1].lower()))
-                        
-                        uploaded_files.append(cloudinary_url)
-                    except Exception as upload_error:
-                        print(f"Cloudinaryアップロードエラー: {upload_error}")
-                        # フォールバック: ローカルに保存
-                        filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
-                        file.save(filepath)
-                        cur.execute('''
-                            INSERT INTO "T_設計図ファイル" ("自動見積もりID", "ファイル名", "ファイルパス", "ファイルタイプ")
-                            VALUES (%s, %s, %s, %s)
-                        ''', (auto_estimate_id, filename, filepath, filename.rsplit('.', 1)[1].lower()))
-                        uploaded_files.append(filepath)
+                    uploaded_files.append(_store_blueprint(
+                        cur, auto_estimate_id, file, filename, filename.rsplit('.', 1)[1].lower()
+                    ))
+            # ディスクから読みながら保存先に送る
+            for filename, file_ext, file, _, digest, _ in _spooled_blueprints(claimed):
+                uploaded_files.append(_store_blueprint(cur, auto_estimate_id, file, filename, file_ext, digest))
             
             conn.commit()
+            for meta, _ in claimed:
+                chunked_upload.discard(meta['upload_id'])
             
             # AI解析にリダイレクト
             return redirect(url_for('auto_estimate.analyze', auto_estimate_id=auto_estimate_id))
@@ -153,6 +205,94 @@ def new():
     
     return render_template('auto_estimate_new.html')
 
+@auto_estimate_bp.route('/uploads', methods=['POST'])
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def upload_init():
+    """
+    分割アップロードの開始（app/utils/chunked_upload.py）
+    
+    JSON {"filename", "size"} を受け取り、upload_id とチャンクサイズを返します。
+    """
+    tenant_id = session.get('tenant_id')
+    if not tenant_id:
+        return jsonify({'success': False, 'error': 'ログインが必要です'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        size = int(data.get('size') or 0)
+        meta = chunked_upload.init(tenant_id, secure_filename(data.get('filename') or ''), size, ALLOWED_EXTENSIONS)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'ファイルサイズが正しくありません'}), 400
+    except chunked_upload.UploadError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    return jsonify({
+        'success': True,
+        'upload_id': meta['upload_id'],
+        'chunk_size': meta['chunk_size'],
+        'chunks': meta['chunks'],
+        'received': [],
+    })
+
+
+@auto_estimate_bp.route('/uploads/<upload_id>', methods=['GET'])
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def upload_status(upload_id):
+    """分割アップロードの状態（再開時に受け取り済みのチャンクを確認する）"""
+    tenant_id = session.get('tenant_id')
+    if not tenant_id:
+        return jsonify({'success': False, 'error': 'ログインが必要です'}), 401
+    
+    try:
+        return jsonify(dict(chunked_upload.status(upload_id, tenant_id), success=True))
+    except chunked_upload.UploadError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+
+
+@auto_estimate_bp.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def upload_append(upload_id, index):
+    """
+    分割アップロードのチャンクの受け取り
+    
+    本文はチャンクのバイト列そのもので、X-Chunk-SHA256 ヘッダーにその SHA-256 を付けます。
+    同じチャンクは何度送っても上書きされるだけです。
+    """
+    tenant_id = session.get('tenant_id')
+    if not tenant_id:
+        return jsonify({'success': False, 'error': 'ログインが必要です'}), 401
+    
+    try:
+        chunked_upload.append(upload_id, tenant_id, index, request.stream, request.headers.get('X-Chunk-SHA256'))
+    except chunked_upload.UploadError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    return jsonify({'success': True, 'index': index})
+
+
+@auto_estimate_bp.route('/uploads/<upload_id>/complete', methods=['POST'])
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def upload_complete(upload_id):
+    """
+    分割アップロードの確定（以降は new / analyze_image に upload_ids で渡す）
+
+    JSON の sha256（または X-Content-SHA256 ヘッダー）にファイル全体の SHA-256 を指定すると、
+    受け取った内容と一致するときだけ確定する
+    """
+    tenant_id = session.get('tenant_id')
+    if not tenant_id:
+        return jsonify({'success': False, 'error': 'ログインが必要です'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    sha256 = data.get('sha256') or request.headers.get('X-Content-SHA256')
+    try:
+        meta = chunked_upload.complete(upload_id, tenant_id, sha256)
+    except chunked_upload.UploadError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    return jsonify({'success': True, 'upload_id': upload_id, 'size': meta['size'], 'sha256': meta['sha256']})
+
 @auto_estimate_bp.route('/analyze/<int:auto_estimate_id>')
 @require_app_enabled('signboard')
 @require_roles('tenant_admin', 'admin')
@@ -183,7 +323,7 @@ def analyze(auto_estimate_id):
     
     # 設計図ファイルを取得
     cur.execute('''
-        SELECT "ID", "ファイル名", "ファイルパス", "ファイルタイプ"
+        SELECT "ID", "ファイル名", "ファイルパス", "ファイルタイプ", "content_hash"
         FROM "T_設計図ファイル"
         WHERE "自動見積もりID" = %s
     ''', (auto_estimate_id,))
@@ -202,21 +342,35 @@ def analyze(auto_estimate_id):
 def analyze_image():
     """画像/PDF直接アップロードでAI解析（新規見積もり画面用）"""
     from app.utils.db import get_db_connection
-    from pdf2image import convert_from_bytes
-    import io
     
     tenant_id = session.get('tenant_id')
     if not tenant_id:
         return jsonify({'success': False, 'error': 'ログインが必要です'}), 401
     
-    # ファイルを取得
-    if 'files' not in request.files:
-        return jsonify({'success': False, 'error': 'ファイルがありません'}), 400
-    
+    # ファイルを取得（分割アップロードしたファイルは upload_ids で受け取る）
     files = request.files.getlist('files')
-    if not files or len(files) == 0:
+    upload_ids = request.form.getlist('upload_ids')
+    if not files and not upload_ids:
         return jsonify({'success': False, 'error': 'ファイルが選択されていません'}), 400
     
+    try:
+        claimed = [chunked_upload.claim(upload_id, tenant_id) for upload_id in upload_ids]
+    except chunked_upload.UploadError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    
+    def blueprints():
+        for file in files:
+            if file.filename == '':
+                continue
+            filename = secure_filename(file.filename)
+            file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else 'jpeg'
+            # ファイルを一度読み込む
+            file.seek(0)
+            yield filename, file_ext, file, file.read(), None, None
+        # 分割アップロードしたファイルはパスのまま解析する（メモリに読み込まない）
+        yield from _spooled_blueprints(claimed)
+    
+    stored_uploads = []
     try:
         # データベース接続
         conn = get_db_connection()
@@ -240,158 +394,202 @@ def analyze_image():
             cur.close()
             conn.close()
             return jsonify({'success': False, 'error': 'OpenAI APIキーが設定されていません。'}), 400
+        # テナント別の利用台帳・レート制限
+        client = usage.metered(client, tenant_id, session.get('store_id'), auto_estimate_id)
         
+        # OpenAI の障害中は設計図の保存だけを行い、解析は一覧の「解析実行」から後で行う
+        analysis_available = not resilience.breaker('openai').is_open()
         all_items = []
         customer_name = None
         uploaded_files = []
+        material_names = None  # PDFがある場合だけ読み込む
+        dedup = page_dedup.PageDeduplicator()  # 白紙・重複ページのスキップ
+        budget = extraction.RetryBudget()  # 抽出に失敗したページの再試行回数
+        failed_pages = []
         
         # 各ファイルを処理
-        for file in files:
-            if file.filename == '':
-                continue
-            
-            filename = secure_filename(file.filename)
-            file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else 'jpeg'
-            
-            # ファイルを一度読み込む
-            file.seek(0)
-            file_content = file.read()
-            
-            # Cloudinaryにアップロード
+        for filename, file_ext, file, file_content, digest, upload_id in blueprints():
+            # Cloudinaryにアップロード（失敗したらローカルに保存）
             try:
-                file.seek(0)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                unique_filename = f"{auto_estimate_id}_{timestamp}_{filename}"
-                
-                upload_result = cloudinary.uploader.upload(
-                    file,
-                    folder="signboard/blueprints",
-                    public_id=unique_filename.rsplit('.', 1)[0],
-                    resource_type="auto"
-                )
-                cloudinary_url = upload_result['secure_url']
-                
-                # データベースに登録
-                cur.execute('''
-                    INSERT INTO "T_設計図ファイル" ("自動見積もりID", "ファイル名", "ファイルパス", "ファイルタイプ")
-                    VALUES (%s, %s, %s, %s)
-                ''', (auto_estimate_id, filename, cloudinary_url, file_ext))
+                uploaded_files.append(_store_blueprint(cur, auto_estimate_id, file, filename, file_ext, digest))
                 conn.commit()
-                
-                uploaded_files.append(cloudinary_url)
+                if upload_id:
+                    stored_uploads.append(upload_id)
             except Exception as upload_error:
-                print(f"Cloudinaryアップロードエラー: {str(upload_error)}")
+                conn.rollback()
+                logger.warning(f"設計図の保存エラー: {upload_error}")
                 # エラーでも処理を続行
             
-            # PDFの場合は画像に変換
-            if file_ext == 'pdf':
-                try:
-                    images = convert_from_bytes(file_content)
-                    for page_num, image in enumerate(images):
-                        # PIL ImageをBase64に変換
-                        buffered = io.BytesIO()
-                        image.save(buffered, format="PNG")
-                        image_data = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                        
-                        # AI解析を実行
-                        result = analyze_single_image(client, image_data, 'png')
-                        if result:
-                            if not customer_name and result.get('customer_name'):
-                                customer_name = result['customer_name']
-                            all_items.extend(result.get('items', []))
-                except Exception as e:
-                    print(f"PDF変換エラー: {str(e)}")
-                    return jsonify({'success': False, 'error': f'PDF変換に失敗しました: {str(e)}'}), 500
-            else:
-                # 画像ファイルの場合
-                image_data = base64.b64encode(file_content).decode('utf-8')
-                
-                # AI解析を実行
-                result = analyze_single_image(client, image_data, file_ext)
-                if result:
-                    if not customer_name and result.get('customer_name'):
-                        customer_name = result['customer_name']
-                    all_items.extend(result.get('items', []))
+            if not analysis_available:
+                continue
+            
+            try:
+                if file_ext == 'pdf' and material_names is None:
+                    # PDFの材質注記の照合用
+                    cur.execute('SELECT "name" FROM "T_材質" WHERE "tenant_id" = %s', (tenant_id,))
+                    material_names = [row[0] for row in cur.fetchall()]
+                for event in iter_file_pages(client, filename, file_ext, file_content, dedup, material_names, budget):
+                    if event['stage'] == 'failed':
+                        failed_pages.append(f"{filename} p{event['page']}")
+                    if event['stage'] != 'parsed':
+                        continue
+                    if not customer_name and event.get('customer_name'):
+                        customer_name = event['customer_name']
+                    all_items.extend(event['items'])
+            except Exception as e:
+                logger.error(f"PDF変換エラー: {str(e)}")
+                return jsonify({'success': False, 'error': f'PDF変換に失敗しました: {str(e)}'}), 500
         
         # データベース接続を閉じる
         cur.close()
         conn.close()
         
+        if not analysis_available:
+            return jsonify(dict(_analysis_queued(), success=False, auto_estimate_id=auto_estimate_id)), 503
+        
         return jsonify({
             'success': True,
             'data': {
                 'customer_name': customer_name,
                 'items': all_items,
-                'auto_estimate_id': auto_estimate_id
+                'auto_estimate_id': auto_estimate_id,
+                'skipped_pages': dedup.skipped_total,
+                'skipped_blank_pages': dedup.skipped['blank'],
+                'skipped_duplicate_pages': dedup.skipped['duplicate'],
+                'failed_pages': failed_pages
             }
         })
         
     except Exception as e:
-        print(f"AI解析エラー: {str(e)}")
+        logger.exception(f"AI解析エラー: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        # 保存先に保存できた分割アップロードだけ削除する（残りは期限切れで削除）
+        for upload_id in stored_uploads:
+            chunked_upload.discard(upload_id)
 
 
-def analyze_single_image(client, image_data, file_ext):
-    """単一画像のAI解析"""
-    try:
-        # GPT-4 Visionで解析
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """この設計図から看板の情報を抽出してください。
-                            
-以下の情報をJSON形式で返してください：
-{
-  "customer_name": "顧客名（あれば）",
-  "items": [
-    {
-      "material_name": "材質名（アルミ、鉄骨、アクリルなど）",
-      "width": 幅（mm、数値のみ）,
-      "height": 高さ（mm、数値のみ）,
-      "quantity": 数量（数値のみ）,
-      "description": "備考（あれば）"
-    }
-  ]
-}
-
-- 複数の看板がある場合は、itemsに複数のオブジェクトを含めてください
-- 数値は単位を除いた数字のみを返してください
-- 材質が不明な場合は"不明"としてください
-- 寸法が読み取れない場合は0としてください"""
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/{file_ext};base64,{image_data}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=1000
+def analyze_single_image(client, image, file_ext=None, budget=None):
+    """
+    単一画像のAI解析
+    
+    Args:
+        image: 画像のバイト列、PIL.Image（PDFから変換したページ）、または画像のURL
+        file_ext: 元の拡張子
+        budget: extraction.RetryBudget（リクエスト全体の再試行回数）
+    
+    Raises:
+        extraction.ExtractionError: 再試行しても抽出できなかった場合
+    """
+    if isinstance(image, str):
+        # URLの場合は縮小・再エンコードの変換を付けて直接渡す
+        image_content = {"url": image_payload.cloudinary_url(image)}
+    else:
+        # 縮小・再エンコードしてから送信
+        payload = image_payload.optimize(image, file_ext)
+        image_content = {"url": payload['url'], "detail": payload['detail']}
+    return extraction.extract_image(client, image_content, budget)
+
+
+def iter_file_pages(client, filename, file_ext, content, dedup, material_names=(), budget=None):
+    """
+    1ファイルをページ単位で解析し、進捗イベントを順に返す
+    
+    PDFはテキスト層に寸法の注記があるページを先に処理し、それ以外のページと、テキストから
+    明細が取れなかったページを1ページずつ画像に変換してAIに送ります。
+    白紙・重複ページは dedup でスキップします。
+    
+    Args:
+        content: ファイルのバイト列（画像はURL文字列も可）、または分割アップロードしたファイルの
+                 パス（pathlib.Path、PDFはメモリに読み込まずにパスのまま変換する）
+        dedup: page_dedup.PageDeduplicator（リクエスト内で共有）
+        budget: extraction.RetryBudget（リクエスト内で共有）
+    
+    Yields:
+        dict: {'file', 'page', 'stage': 'rendered'|'skipped'|'sent'|'parsed'|'failed', ...}
+              skipped は 'reason'、sent は 'source'、parsed は 'items' と 'customer_name'、
+              failed は 'error' を含む（抽出に失敗したページだけが failed になり、他のページは続行）
+    """
+    from pdf2image import convert_from_bytes, convert_from_path, pdfinfo_from_bytes, pdfinfo_from_path
+    
+    def event(page, stage, **data):
+        return dict(file=filename, page=page, stage=stage, **data)
+    
+    def skipped(page, status, original):
+        logger.info(f"ページをスキップ（{status}）: {filename} p{page} {original or ''}")
+        return event(page, 'skipped', reason=status, duplicate_of=original)
+    
+    def parsed(page, result, source):
+        return event(page, 'parsed', source=source, items=result['items'],
+                     customer_name=result.get('customer_name'), prompt=result.get('prompt'))
+    
+    def analyze(page, source, analyzer, *args):
+        try:
+            return parsed(page, analyzer(client, *args, budget=budget), source)
+        except extraction.ExtractionError as e:
+            logger.warning(f"明細の抽出に失敗しました: {filename} p{page} {str(e)}")
+            return event(page, 'failed', source=source, error=str(e))
+    
+    if file_ext != 'pdf':
+        if isinstance(content, os.PathLike):
+            # 画像は1枚ずつなので読み込んでから縮小する
+            with open(content, 'rb') as f:
+                content = f.read()
+        # 画像ファイル（URLの場合はそのままAIに渡す）
+        if not isinstance(content, str):
+            status, original = dedup.check_image(content, filename)
+            if status != 'new':
+                yield skipped(1, status, original)
+                return
+        yield event(1, 'sent', source='image')
+        yield analyze(1, 'image', analyze_single_image, content, file_ext)
+        return
+    
+    pdf_pages = pdf_text.extract(content, material_names or ())
+    if pdf_pages is None:
+        # pdftotext が使えない場合は全ページを画像で解析
+        info = pdfinfo_from_path(content) if isinstance(content, os.PathLike) else pdfinfo_from_bytes(content)
+        raster_pages = list(range(1, info['Pages'] + 1))
+    else:
+        raster_pages = []
+        for page in pdf_pages:
+            if not page['vector']:
+                raster_pages.append(page['page'])
+                continue
+            status, original = dedup.check_text(page['text'], f"{filename} p{page['page']}")
+            if status != 'new':
+                yield skipped(page['page'], status, original)
+                continue
+            if page['items']:
+                # 注記から明細が組めたページはAIを呼ばない
+                yield parsed(page['page'], {'items': page['items']}, 'pdf_text')
+            else:
+                # 明細が組めなければテキストだけをAIに渡す（画像より安価）
+                yield event(page['page'], 'sent', source='pdf_text')
+                result = analyze(page['page'], 'pdf_text', extraction.extract_text, page['text'])
+                if result['stage'] == 'parsed' and not result['items']:
+                    # テキストだけでは明細にならなかった（寸法が図形側にある）ので画像で解析する
+                    raster_pages.append(page['page'])
+                    continue
+                yield result
+        logger.info(
+            f"PDFテキスト抽出: {filename} {len(pdf_pages)}ページ中"
+            f" {len(pdf_pages) - len(raster_pages)}ページを画像変換なしで処理"
         )
+    
+    for page_num in raster_pages:
+        # 送信時の最大サイズで直接レンダリング（高解像度で変換してから縮小しない）
+        convert = convert_from_path if isinstance(content, os.PathLike) else convert_from_bytes
+        image = convert(content, size=image_payload.MAX_EDGE, first_page=page_num, last_page=page_num)[0]
+        yield event(page_num, 'rendered')
         
-        # レスポンスをパース
-        result_text = response.choices[0].message.content
-        
-        # JSONを抽出（```json ... ```の場合に対応）
-        if '```json' in result_text:
-            result_text = result_text.split('```json')[1].split('```')[0].strip()
-        elif '```' in result_text:
-            result_text = result_text.split('```')[1].split('```')[0].strip()
-        
-        result_json = json.loads(result_text)
-        
-        return result_json
-        
-    except Exception as e:
-        print(f"AI解析エラー: {str(e)}")
-        return None
+        # 白紙・同じリクエスト内の重複ページはAIに送らない
+        status, original = dedup.check_image(image, f"{filename} p{page_num}")
+        if status != 'new':
+            yield skipped(page_num, status, original)
+            continue
+        yield event(page_num, 'sent', source='image')
+        yield analyze(page_num, 'image', analyze_single_image, image)
 
 
 @auto_estimate_bp.route('/api/analyze/<int:auto_estimate_id>', methods=['POST'])
@@ -399,7 +597,7 @@ def analyze_single_image(client, image_data, file_ext):
 @require_roles('tenant_admin', 'admin')
 def api_analyze(auto_estimate_id):
     """AI解析API"""
-    from app.utils.db import get_db_connection
+    from app.utils.db import get_db_connection, manual_commit
     
     tenant_id = session.get('tenant_id')
     if not tenant_id:
@@ -411,10 +609,12 @@ def api_analyze(auto_estimate_id):
     try:
         # 設計図ファイルを取得
         cur.execute('''
-            SELECT "ファイルパス", "ファイルタイプ"
-            FROM "T_設計図ファイル"
-            WHERE "自動見積もりID" = %s
-        ''', (auto_estimate_id,))
+            SELECT f."ファイル名", f."ファイルパス", f."ファイルタイプ"
+            FROM "T_設計図ファイル" f
+            JOIN "T_自動見積もり" a ON a."ID" = f."自動見積もりID"
+            WHERE f."自動見積もりID" = %s AND a."テナントID" = %s
+            ORDER BY f."ID"
+        ''', (auto_estimate_id, tenant_id))
         
         blueprint_files = cur.fetchall()
         
@@ -427,107 +627,70 @@ def api_analyze(auto_estimate_id):
         
         if not client:
             return jsonify({'error': 'OpenAI APIキーが設定されていません。テナント情報またはテナントアプリ設定から設定してください。'}), 400
+        client = usage.metered(client, tenant_id, session.get('store_id'), auto_estimate_id)
+        if resilience.breaker('openai').is_open():
+            return jsonify(_analysis_queued()), 503
         
-        all_items = []
+        material_names = ()
+        if any(filetype == 'pdf' for _, _, filetype in blueprint_files):
+            cur.execute('SELECT "name" FROM "T_材質" WHERE "tenant_id" = %s', (tenant_id,))
+            material_names = [row[0] for row in cur.fetchall()]
         
-        for filepath, filetype in blueprint_files:
-            # Cloudinary URLかローカルファイルかを判定
-            if filepath.startswith('http://') or filepath.startswith('https://'):
-                # Cloudinary URLの場合は直接使用
-                image_url = filepath
-                # OpenAIに直接URLを渡す
-                image_content = {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": image_url
-                    }
-                }
-            else:
-                # ローカルファイルの場合はBase64エンコード
-                with open(filepath, 'rb') as image_file:
-                    image_data = base64.b64encode(image_file.read()).decode('utf-8')
-                image_content = {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/{filetype};base64,{image_data}"
-                    }
-                }
-            
-            # GPT-4 Visionで解析
-            response = client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": """この設計図から看板の情報を抽出してください。
-                                
-以下の情報をJSON形式で返してください：
-{
-  "items": [
-    {
-      "material": "材質名（アルミ、鉄骨、アクリルなど）",
-      "width": 幅（mm、数値のみ）,
-      "height": 高さ（mm、数値のみ）,
-      "quantity": 数量（数値のみ）,
-      "notes": "備考（あれば）"
-    }
-  ]
-}
-
-- 複数の看板がある場合は、itemsに複数のオブジェクトを含めてください
-- 数値は単位を除いた数字のみを返してください
-- 材質が不明な場合は"不明"としてください
-- 寸法が読み取れない場合は0としてください"""
-                            },
-                            image_content
-                        ]
-                    }
-                ],
-                max_tokens=1000
-            )
-            
-            # レスポンスをパース
-            result_text = response.choices[0].message.content
-            
-            # JSONを抽出（```json ... ```の場合に対応）
-            if '```json' in result_text:
-                result_text = result_text.split('```json')[1].split('```')[0].strip()
-            elif '```' in result_text:
-                result_text = result_text.split('```')[1].split('```')[0].strip()
-            
-            result_json = json.loads(result_text)
-            all_items.extend(result_json.get('items', []))
+        all_items = []
+        failed_files = []
+        failed_pages = []
+        dedup = page_dedup.PageDeduplicator()
+        budget = extraction.RetryBudget()
         
-        # データベースに保存
-        for item in all_items:
-            cur.execute('''
-                INSERT INTO "T_自動見積もり明細" 
-                ("自動見積もりID", "材質名", "幅", "高さ", "数量", "備考")
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (
-                auto_estimate_id,
-                item.get('material', '不明'),
-                item.get('width', 0),
-                item.get('height', 0),
-                item.get('quantity', 1),
-                item.get('notes', '')
-            ))
+        for filename, filepath, filetype in blueprint_files:
+            # ストリーム版と同じくページ単位で解析する（PDFはテキスト層・ページごとの画像変換）
+            try:
+                content = _read_blueprint(filepath, filetype)
+                for event in iter_file_pages(client, filename, filetype, content, dedup, material_names, budget):
+                    if event['stage'] == 'failed':
+                        if resilience.breaker('openai').is_open():
+                            # 残りのページもすぐに失敗するだけなので、保存せずに後でやり直す
+                            return jsonify(_analysis_queued()), 503
+                        failed_pages.append(f"{filename} p{event['page']}")
+                    elif event['stage'] == 'parsed':
+                        all_items.extend(event['items'])
+            except Exception as e:
+                # 読み込み・変換できなかったファイルだけを除いて続行
+                logger.warning(f"設計図の解析エラー: {filename} {str(e)}")
+                failed_files.append(filename)
         
-        # ステータスを更新
-        cur.execute('''
-            UPDATE "T_自動見積もり"
-            SET "ステータス" = '確認待ち', "AI解析結果JSON" = %s, "更新日時" = CURRENT_TIMESTAMP
-            WHERE "ID" = %s
-        ''', (json.dumps(all_items, ensure_ascii=False), auto_estimate_id))
+        # やり直しで明細が重複しないよう、前回の結果を消してから保存する
+        # （autocommit の接続なので、置き換えが途中で止まらないよう1つのトランザクションにする）
+        with manual_commit(conn):
+            cur.execute('DELETE FROM "T_自動見積もり明細" WHERE "自動見積もりID" = %s', (auto_estimate_id,))
+            for item in all_items:
+                cur.execute('''
+                    INSERT INTO "T_自動見積もり明細" 
+                    ("自動見積もりID", "材質名", "幅", "高さ", "数量", "備考")
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                ''', (
+                    auto_estimate_id,
+                    item.get('material_name', '不明'),
+                    item.get('width', 0),
+                    item.get('height', 0),
+                    item.get('quantity', 1),
+                    item.get('description', '')
+                ))
         
-        conn.commit()
+            # ステータスを更新
+            cur.execute('''
+                UPDATE "T_自動見積もり"
+                SET "ステータス" = '確認待ち', "AI解析結果JSON" = %s, "更新日時" = CURRENT_TIMESTAMP
+                WHERE "ID" = %s
+            ''', (json.dumps(all_items, ensure_ascii=False), auto_estimate_id))
+            conn.commit()
         
         return jsonify({
             'success': True,
-            'items': all_items
+            'items': all_items,
+            'failed_files': failed_files,
+            'failed_pages': failed_pages,
+            'skipped_pages': dedup.skipped_total
         })
         
     except Exception as e:
@@ -538,6 +701,405 @@ def api_analyze(auto_estimate_id):
         conn.close()
 
 
+def _sse(event, data):
+    """Server-Sent Events の1イベント"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _read_blueprint(filepath, filetype):
+    """
+    設計図ファイルを解析用に読み込む
+    
+    Cloudinary の画像はURLのまま（AIにURLで渡す）、それ以外は保存先から取得します。
+    """
+    if filetype != 'pdf' and storage.backend_for(filepath).name == 'cloudinary':
+        return filepath
+    return storage.read(filepath)
+
+
+@auto_estimate_bp.route('/file/<int:file_id>')
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def blueprint_file(file_id):
+    """
+    設計図ファイルの表示・ダウンロード
+    
+    Cloudinary は配信URL、S3 は署名付きURLにリダイレクトし、
+    ローカルのファイルは少しずつ読んで返します。
+    """
+    from app.utils.db import get_db_connection
+    
+    tenant_id = session.get('tenant_id')
+    if not tenant_id:
+        return jsonify({'error': 'ログインが必要です'}), 401
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute('''
+            SELECT f."ファイル名", f."ファイルパス", f."ファイルタイプ"
+            FROM "T_設計図ファイル" f
+            JOIN "T_自動見積もり" a ON a."ID" = f."自動見積もりID"
+            WHERE f."ID" = %s AND a."テナントID" = %s
+        ''', (file_id, tenant_id))
+        row = cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+    
+    if not row:
+        return jsonify({'error': 'ファイルが見つかりません'}), 404
+    filename, filepath, filetype = row
+    
+    url = storage.url(filepath)
+    if url:
+        return redirect(url)
+    try:
+        stream = storage.open_stream(filepath)
+    except FileNotFoundError:
+        return jsonify({'error': 'ファイルが見つかりません'}), 404
+    
+    def generate():
+        with stream:
+            yield from storage.iter_chunks(stream)
+    
+    return Response(generate(), mimetype=storage.content_type(filetype), headers={
+        'Content-Disposition': f"inline; filename*=UTF-8''{quote(filename)}",
+        'Cache-Control': 'private, max-age=3600',
+    })
+
+
+@auto_estimate_bp.route('/derivative/<content_hash>/<size>.jpg')
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def blueprint_derivative(content_hash, size):
+    """
+    設計図のサムネイル・プレビュー（app/utils/derivatives.py）
+    
+    URLは内容のハッシュで決まるので、ブラウザに immutable でキャッシュさせます。
+    """
+    from app.utils.db import get_db_connection
+    
+    tenant_id = session.get('tenant_id')
+    if not tenant_id:
+        return jsonify({'error': 'ログインが必要です'}), 401
+    if size not in derivatives.SIZES:
+        return jsonify({'error': 'サイズが不正です'}), 404
+    
+    etag = f'"{content_hash}-{size}"'
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers={'ETag': etag})
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # 自テナントの自動見積もりで使われている内容だけ返す
+        cur.execute('''
+            SELECT f."ファイルパス", f."ファイルタイプ"
+            FROM "T_設計図ファイル" f
+            JOIN "T_自動見積もり" a ON a."ID" = f."自動見積もりID"
+            WHERE f."content_hash" = %s AND a."テナントID" = %s
+            LIMIT 1
+        ''', (content_hash, tenant_id))
+        row = cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+    
+    if not row:
+        return jsonify({'error': 'ファイルが見つかりません'}), 404
+    filepath, filetype = row
+    
+    try:
+        data = derivatives.get(content_hash, size, filepath, filetype)
+    except Exception as e:
+        logger.warning(f"派生画像を作れませんでした: {content_hash[:12]} {size} {e}")
+        return jsonify({'error': 'プレビューを作成できませんでした'}), 500
+    return Response(data, mimetype='image/jpeg', headers={
+        'ETag': etag,
+        'Cache-Control': 'private, max-age=31536000, immutable',
+    })
+
+
+@auto_estimate_bp.route('/viewer/<int:file_id>')
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def viewer(file_id):
+    """
+    設計図の拡大表示（Deep Zoom）
+    
+    表示している範囲・倍率のタイルだけを読み込みます。タイルがまだ無ければ
+    作成を始めて、できるまで画面を再読み込みします。
+    """
+    from app.utils.db import get_db_connection
+    
+    tenant_id = session.get('tenant_id')
+    if not tenant_id:
+        flash('ログインが必要です', 'error')
+        return redirect(url_for('select_login'))
+    page = request.args.get('page', 1, type=int)
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute('''
+            SELECT f."ID", f."ファイル名", f."ファイルパス", f."ファイルタイプ", f."content_hash", f."自動見積もりID"
+            FROM "T_設計図ファイル" f
+            JOIN "T_自動見積もり" a ON a."ID" = f."自動見積もりID"
+            WHERE f."ID" = %s AND a."テナントID" = %s
+        ''', (file_id, tenant_id))
+        blueprint = cur.fetchone()
+        tile_pages = tiles.pages(cur, blueprint[4]) if blueprint and blueprint[4] else []
+    finally:
+        cur.close()
+        conn.close()
+    
+    if not blueprint:
+        flash('ファイルが見つかりません', 'error')
+        return redirect(url_for('auto_estimate.index'))
+    if not blueprint[4]:
+        # 内容のハッシュが無い（以前の形式の）ファイルは元のファイルを表示する
+        return redirect(url_for('auto_estimate.blueprint_file', file_id=file_id))
+    
+    page_count = tile_pages[0]['page_count'] if tile_pages else 1
+    if tile_pages and not 1 <= page <= page_count:
+        # 存在しないページはタイルができないまま再読み込みを続けるので、範囲内に戻す
+        return redirect(url_for('auto_estimate.viewer', file_id=file_id, page=min(max(page, 1), page_count)))
+    
+    info = next((p for p in tile_pages if p['page'] == page), None)
+    if not tile_pages or (info and info['state'] == tiles.FAILED):
+        # 作成中なら待つだけ（失敗したものは TILE_STALE_SECONDS 経ってから作り直す）
+        tiles.schedule(blueprint[4], blueprint[2], blueprint[3], force=True)
+    return render_template('auto_estimate_viewer.html',
+                         blueprint=blueprint,
+                         page=page,
+                         info=info,
+                         page_count=page_count)
+
+
+def _tile_info(content_hash, page):
+    """自テナントの設計図のタイルの作成状態（無ければ None）"""
+    from app.utils.db import get_db_connection
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute('''
+            SELECT t."ページ", t."状態", t."幅", t."高さ", t."タイルサイズ", t."重なり", t."保存先"
+            FROM "T_設計図タイル" t
+            WHERE t."content_hash" = %s AND t."ページ" = %s AND EXISTS (
+                SELECT 1 FROM "T_設計図ファイル" f
+                JOIN "T_自動見積もり" a ON a."ID" = f."自動見積もりID"
+                WHERE f."content_hash" = t."content_hash" AND a."テナントID" = %s
+            )
+        ''', (content_hash, page, session.get('tenant_id')))
+        row = cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+    if not row or row[1] != tiles.READY:
+        return None
+    return dict(zip(('page', 'state', 'width', 'height', 'tile_size', 'overlap', 'backend'), row))
+
+
+@auto_estimate_bp.route('/tiles/<content_hash>/<int:page>.dzi')
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def tile_descriptor(content_hash, page):
+    """Deep Zoom の .dzi（画像の大きさとタイルの形式）"""
+    info = _tile_info(content_hash, page)
+    if not info:
+        return jsonify({'error': 'タイルが見つかりません'}), 404
+    return Response(tiles.descriptor(info), mimetype='application/xml')
+
+
+@auto_estimate_bp.route('/tiles/<content_hash>/<int:page>_files/<int:level>/<int:col>_<int:row>.jpg')
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def tile_image(content_hash, page, level, col, row):
+    """タイル1枚（内容のハッシュで決まるので immutable でキャッシュさせる）"""
+    info = _tile_info(content_hash, page)
+    if not info:
+        return jsonify({'error': 'タイルが見つかりません'}), 404
+    try:
+        data = tiles.read_tile(info, content_hash, level, col, row)
+    except Exception:
+        return jsonify({'error': 'タイルが見つかりません'}), 404
+    return Response(data, mimetype='image/jpeg', headers={
+        'Cache-Control': 'private, max-age=31536000, immutable',
+    })
+
+
+@auto_estimate_bp.route('/api/analyze/<int:auto_estimate_id>/stream')
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def api_analyze_stream(auto_estimate_id):
+    """
+    AI解析API（Server-Sent Events で進捗を返す）
+    
+    ファイルごと・ページごとに file / page（rendered, skipped, sent, parsed）イベントを送り、
+    明細はページの解析が終わるたびに保存します。クライアントが接続を閉じると
+    （EventSource.close()）、解析中のページの後で残りのページを打ち切ります。
+    OpenAI のサーキットブレーカーが開いている（障害中）場合は analysis_queued を送り、
+    ステータスを解析中のままにします（画面側で retry_after 秒後にやり直す）。
+    """
+    from app.utils.db import get_db_connection
+    from app.utils.api_key import get_openai_client
+    
+    def error_stream(message):
+        return Response(_sse('analysis_error', {'error': message}), mimetype='text/event-stream')
+    
+    tenant_id = session.get('tenant_id')
+    if not tenant_id:
+        return error_stream('ログインが必要です')
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute('''
+            SELECT f."ファイル名", f."ファイルパス", f."ファイルタイプ"
+            FROM "T_設計図ファイル" f
+            JOIN "T_自動見積もり" a ON a."ID" = f."自動見積もりID"
+            WHERE f."自動見積もりID" = %s AND a."テナントID" = %s
+            ORDER BY f."ID"
+        ''', (auto_estimate_id, tenant_id))
+        blueprint_files = cur.fetchall()
+        
+        material_names = ()
+        if any(filetype == 'pdf' for _, _, filetype in blueprint_files):
+            cur.execute('SELECT "name" FROM "T_材質" WHERE "tenant_id" = %s', (tenant_id,))
+            material_names = [row[0] for row in cur.fetchall()]
+    finally:
+        cur.close()
+        conn.close()
+    
+    if not blueprint_files:
+        return error_stream('ファイルが見つかりません')
+    
+    client = get_openai_client(tenant_id=tenant_id, app_name='signboard')
+    if not client:
+        return error_stream('OpenAI APIキーが設定されていません。テナント情報またはテナントアプリ設定から設定してください。')
+    # 解析スレッドはリクエスト外で動くので、テナント・店舗はここで渡しておく
+    client = usage.metered(client, tenant_id, session.get('store_id'), auto_estimate_id)
+    if resilience.breaker('openai').is_open():
+        # ステータスは解析中のまま（画面側で retry_after 秒後に再開する）
+        return Response(_sse('analysis_queued', _analysis_queued()), mimetype='text/event-stream')
+    
+    # 解析（OpenAI の応答待ち）は別スレッドで行い、応答側はイベントを中継するだけにする
+    # （待ち時間中もコメント行を送れるので、切断をページ単位で検知できる）
+    events = queue.Queue()
+    cancelled = threading.Event()
+    queued = threading.Event()  # 途中で OpenAI のブレーカーが開いた
+    
+    def worker():
+        dedup = page_dedup.PageDeduplicator()
+        budget = extraction.RetryBudget()
+        try:
+            for file_index, (filename, filepath, filetype) in enumerate(blueprint_files, 1):
+                if cancelled.is_set() or queued.is_set():
+                    break
+                events.put(('file', {'file': filename, 'index': file_index, 'total': len(blueprint_files)}))
+                try:
+                    content = _read_blueprint(filepath, filetype)
+                    for event in iter_file_pages(client, filename, filetype, content, dedup, material_names, budget):
+                        events.put(('page', event))
+                        if event['stage'] == 'failed' and resilience.breaker('openai').is_open():
+                            # 残りのページもすぐに失敗するだけなので、解析待ちにして後でやり直す
+                            queued.set()
+                        if cancelled.is_set() or queued.is_set():
+                            break
+                except Exception as e:
+                    logger.warning(f"設計図の解析エラー: {filename} {str(e)}")
+                    events.put(('file_error', {'file': filename, 'error': str(e)}))
+        finally:
+            events.put(('summary', {
+                'skipped_pages': dedup.skipped_total,
+                'skipped_blank_pages': dedup.skipped['blank'],
+                'skipped_duplicate_pages': dedup.skipped['duplicate'],
+            }))
+            events.put(None)
+    
+    def generate():
+        conn = get_db_connection()
+        cur = conn.cursor()
+        all_items = []
+        finished = False
+        
+        def finish():
+            cur.execute('''
+                UPDATE "T_自動見積もり"
+                SET "ステータス" = '確認待ち', "AI解析結果JSON" = %s, "更新日時" = CURRENT_TIMESTAMP
+                WHERE "ID" = %s
+            ''', (json.dumps(all_items, ensure_ascii=False), auto_estimate_id))
+            conn.commit()
+        
+        # やり直し（解析待ちからの再開を含む）で明細が重複しないよう、前回の結果を消してから始める
+        cur.execute('DELETE FROM "T_自動見積もり明細" WHERE "自動見積もりID" = %s', (auto_estimate_id,))
+        conn.commit()
+        
+        threading.Thread(target=worker, name=f"analyze-{auto_estimate_id}", daemon=True).start()
+        try:
+            yield _sse('start', {'auto_estimate_id': auto_estimate_id, 'files': len(blueprint_files)})
+            while True:
+                try:
+                    item = events.get(timeout=ANALYZE_STREAM_PING_SECONDS)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if item is None:
+                    break
+                name, data = item
+                if name == 'page' and data['stage'] == 'parsed' and data['items']:
+                    # 確認画面で途中の結果も見えるよう、ページごとに保存
+                    for it in data['items']:
+                        cur.execute('''
+                            INSERT INTO "T_自動見積もり明細"
+                            ("自動見積もりID", "材質名", "幅", "高さ", "数量", "備考")
+                            VALUES (%s, %s, %s, %s, %s, %s)
+                        ''', (
+                            auto_estimate_id,
+                            it.get('material_name', '不明'),
+                            it.get('width', 0),
+                            it.get('height', 0),
+                            it.get('quantity', 1),
+                            it.get('description', '')
+                        ))
+                    conn.commit()
+                    all_items.extend(data['items'])
+                yield _sse(name, data)
+            
+            if queued.is_set():
+                # ステータスは解析中のまま（画面側で retry_after 秒後に最初からやり直す）
+                finished = True
+                yield _sse('analysis_queued', _analysis_queued())
+                return
+            
+            finish()
+            finished = True
+            yield _sse('done', {'items': len(all_items)})
+        except Exception as e:
+            conn.rollback()
+            logger.exception(f"AI解析エラー: {str(e)}")
+            yield _sse('analysis_error', {'error': str(e)})
+        finally:
+            # クライアントが切断した場合も、残りのページを打ち切って途中までの結果で確認待ちにする
+            cancelled.set()
+            try:
+                if not finished:
+                    logger.info(f"AI解析を打ち切りました: 自動見積もりID={auto_estimate_id} 明細{len(all_items)}件")
+                    finish()
+            except Exception as e:
+                logger.warning(f"解析状態の更新エラー: {str(e)}")
+            finally:
+                cur.close()
+                conn.close()
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
 @auto_estimate_bp.route('/confirm/<int:auto_estimate_id>', methods=['GET', 'POST'])
 @require_app_enabled('signboard')
 @require_roles('tenant_admin', 'admin')
@@ -619,13 +1181,18 @@ def confirm(auto_estimate_id):
     
     materials = cur.fetchall()
     
+    # AI抽出の材質名ごとに材質マスタの候補を照合（表記ゆれ・板厚表記の違いを吸収）
+    candidates = material_match.load_index(conn, tenant_id).resolve(item[1] for item in items)
+    
     cur.close()
     conn.close()
     
     return render_template('auto_estimate_confirm.html', 
                          auto_estimate=auto_estimate,
                          items=items,
-                         materials=materials)
+                         materials=materials,
+                         candidates=candidates,
+                         min_score=material_match.MIN_SCORE)
 
 @auto_estimate_bp.route('/create_estimate/<int:auto_estimate_id>', methods=['POST'])
 @require_app_enabled('signboard')
@@ -707,41 +1274,29 @@ def create_estimate(auto_estimate_id):
         
         estimate_id = cur.fetchone()[0]
         
+        # 材質名を材質マスタにまとめて照合（完全一致しなければ最も近い材質）
+        material_index = material_match.load_index(conn, tenant_id)
+        matches = material_index.resolve((item[0] for item in items), limit=1)
+        
         # 明細を作成
         for item in items:
             material_name, width, height, quantity, notes = item
             
-            # 材質名から材質IDを取得
-            cur.execute('''
-                SELECT "id", "price_type", "unit_price_area", "unit_price_weight", "specific_gravity"
-                FROM "T_材質"
-                WHERE "name" = %s AND "tenant_id" = %s
-                LIMIT 1
-            ''', (material_name, tenant_id))
-            
-            material = cur.fetchone()
-            
-            if not material:
-                # 材質が見つからない場合はデフォルトの材質を使用
-                cur.execute('''
-                    SELECT "id", "price_type", "unit_price_area", "unit_price_weight", "specific_gravity"
-                    FROM "T_材質"
-                    WHERE "tenant_id" = %s
-                    ORDER BY "id"
-                    LIMIT 1
-                ''', (tenant_id,))
-                
-                material = cur.fetchone()
-            
-            if not material:
+            best = matches.get(material_name)
+            if not best or best[0]['score'] < material_match.MIN_SCORE:
                 conn.rollback()
                 flash(f'材質「{material_name}」が見つかりませんでした。材質マスタに登録されている材質名を選択してください。', 'error')
                 return redirect(url_for('auto_estimate.confirm', auto_estimate_id=auto_estimate_id))
             
+            material = best[0]['material']
+            if material['name'] != material_name:
+                logger.info(f"材質名を照合: {material_name} → {material['name']}（スコア {best[0]['score']}）")
+            material = (material['id'], material['price_type'], material['unit_price_area'],
+                        material['unit_price_weight'], material['specific_gravity'])
+            
             material_id, price_type, unit_price_area, unit_price_weight, density = material
             
-            # デバッグログ
-            print(f'DEBUG: 材質情報 - ID:{material_id}, 名前:{material_name}, 単価タイプ:{price_type}, 面積単価:{unit_price_area}, 重量単価:{unit_price_weight}, 比重:{density}')
+            logger.debug(f'材質情報 - ID:{material_id}, 名前:{material_name}, 単価タイプ:{price_type}, 面積単価:{unit_price_area}, 重量単価:{unit_price_weight}, 比重:{density}')
             
             # 単価を選択
             if price_type == 'area':
@@ -749,7 +1304,7 @@ def create_estimate(auto_estimate_id):
             else:  # weight
                 unit_price = unit_price_weight or 0
             
-            print(f'DEBUG: 選択された単価: {unit_price}')
+            logger.debug(f'選択された単価: {unit_price}')
             
             if unit_price is None or unit_price == 0:
                 conn.rollback()
@@ -55,10 +55,13 @@ def mypage():
             TJugyoinTenpo.employee_id == user_id
         ).all()
         
+        # 店舗は1回のクエリでまとめて取得する（所属の順に並べる）
+        store_ids = [rel.store_id for rel in store_relations]
+        store_map = {s.id: s for s in db.query(TTenpo).filter(TTenpo.id.in_(store_ids)).all()} if store_ids else {}
         stores = []
         store_list = []
-        for rel in store_relations:
-            store = db.query(TTenpo).filter(TTenpo.id == rel.store_id).first()
+        for store_id in store_ids:
+            store = store_map.get(store_id)
             if store:
                 stores.append(store.名称)
                 store_list.append({'id': store.id, 'name': store.名称})
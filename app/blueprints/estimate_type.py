@@ -109,20 +109,21 @@ def manage():
     cur.execute(sql)
     estimate_types = cur.fetchall()
     
-    # 各見積タイプのサブタイプを取得
+    # 全タイプのサブタイプを1回で取得して見積タイプごとに分ける
+    sql = _sql(conn, '''
+        SELECT estimate_type_id, id, name, code, description, display_order
+        FROM "T_見積サブタイプ"
+        ORDER BY estimate_type_id, display_order
+    ''')
+    cur.execute(sql)
+    subtypes_by_type = {}
+    for row in cur.fetchall():
+        subtypes_by_type.setdefault(row[0], []).append(row[1:])
     types_with_subtypes = []
     for et in estimate_types:
-        sql = _sql(conn, '''
-            SELECT id, name, code, description, display_order
-            FROM "T_見積サブタイプ"
-            WHERE estimate_type_id = %s
-            ORDER BY display_order
-        ''')
-        cur.execute(sql, (et[0],))
-        subtypes = cur.fetchall()
         types_with_subtypes.append({
             'type': et,
-            'subtypes': subtypes
+            'subtypes': subtypes_by_type.get(et[0], [])
         })
     
     cur.close()
@@ -1,4 +1,5 @@
-from flask import Blueprint, jsonify, current_app
+import os
+from flask import Blueprint, jsonify, current_app, request, Response
 
 bp = Blueprint("health", __name__)
 
@@ -7,9 +8,30 @@ def healthz():
     """
     アプリケーションの状態を返します。
     ok=True のとき正常稼働です。
+    breakers は外部サービスごとのサーキットブレーカーの状態（このワーカーのもの）で、
+    いずれかが open のときは degraded=True（アップロードはローカル保存、AI解析は待機になる）です。
     """
+    from ..utils.resilience import states
+
+    breakers = states()
     return jsonify(
         ok=True,
+        degraded=any(b["state"] != "closed" for b in breakers.values()),
+        breakers=breakers,
         env=current_app.config.get("ENVIRONMENT"),
         version=current_app.config.get("VERSION"),
     )
+
+
+@bp.get("/metrics")
+def metrics():
+    """
+    Prometheus形式のメトリクスを返します（全gunicornワーカー分を合算）。
+    METRICS_TOKEN が設定されている場合は Bearer トークンが必要です。
+    """
+    from ..utils.metrics import render_latest
+
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return Response("forbidden\n", status=403, mimetype="text/plain")
+    return Response(render_latest(), mimetype="text/plain; version=0.0.4; charset=utf-8")
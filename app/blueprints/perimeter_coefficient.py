@@ -5,6 +5,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify
 from app.utils.decorators import require_roles, require_app_enabled
 from app.utils.db import get_db_connection
+from app.utils import char_perimeter
 
 perimeter_coefficient_bp = Blueprint('perimeter_coefficient', __name__, url_prefix='/perimeter_coefficient')
 
@@ -85,6 +86,7 @@ def new():
             ''', (char_type, coefficient, description, tenant_id))
             
             conn.commit()
+            char_perimeter.invalidate_coefficients(tenant_id)
             flash('文字周長係数を登録しました', 'success')
             return redirect(url_for('perimeter_coefficient.index'))
         except Exception as e:
@@ -141,6 +143,7 @@ def edit(coefficient_id):
                 return redirect(url_for('perimeter_coefficient.index'))
             
             conn.commit()
+            char_perimeter.invalidate_coefficients(tenant_id)
             flash('文字周長係数を更新しました', 'success')
             return redirect(url_for('perimeter_coefficient.index'))
         except Exception as e:
@@ -197,6 +200,7 @@ def delete(coefficient_id):
             flash('デフォルト係数は削除できません', 'error')
         else:
             conn.commit()
+            char_perimeter.invalidate_coefficients(tenant_id)
             flash('文字周長係数を削除しました', 'success')
     except Exception as e:
         conn.rollback()
@@ -318,3 +322,27 @@ def api_coefficients():
     ]
     
     return jsonify({'success': True, 'coefficients': result})
+
+@perimeter_coefficient_bp.route('/api/estimate', methods=['POST'])
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def api_estimate():
+    """推定周長API（フォント計測インデックスまたは1文字ずつの文字種類判定、見積もり作成画面で使用）"""
+    tenant_id = session.get('tenant_id')
+    if not tenant_id:
+        return jsonify({'success': False, 'error': 'ログインが必要です'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    text = data.get('text') or ''
+    try:
+        height = float(data.get('height'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': '文字高さは数値を入力してください'}), 400
+    
+    conn = get_db_connection()
+    try:
+        coefficients = char_perimeter.load_coefficients(conn, tenant_id)
+    finally:
+        conn.close()
+    
+    return jsonify({'success': True, 'data': char_perimeter.estimate_text(text, height, coefficients, data.get('font'))})
@@ -4,6 +4,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify
 from app.utils.decorators import require_roles, require_app_enabled
 from app.utils.db import get_db, _sql
+from app.utils import char_perimeter, font_metrics, material_match, nesting
 from datetime import datetime
 import math
 
@@ -122,16 +123,16 @@ def calculate_price(material_id, width_mm, height_mm, quantity):
             discounted_unit_price = disc_price
             discount_rate = ((unit_price - disc_price) / unit_price) * 100 if unit_price > 0 else 0
     
-    # 割引後の価格を計算
+    # 割引後の価格を計算（basis は単価を掛ける量: ㎡ / kg / ㎥）
     if price_type == 'area':
-        discounted_base_price = area_m2 * discounted_unit_price
+        basis = area_m2
     elif price_type == 'weight':
-        discounted_base_price = weight_kg * discounted_unit_price
+        basis = weight_kg
     elif price_type == 'volume':
-        volume_m3 = area_m2 * (thickness / 1000)
-        discounted_base_price = volume_m3 * discounted_unit_price
+        basis = area_m2 * (thickness / 1000)
     else:
-        discounted_base_price = 0
+        basis = 0
+    discounted_base_price = basis * discounted_unit_price
     
     # 小計（数量を掛ける）
     subtotal = discounted_base_price * quantity
@@ -150,6 +151,7 @@ def calculate_price(material_id, width_mm, height_mm, quantity):
         'unit_price': unit_price,
         'discount_rate': discount_rate,
         'discounted_unit_price': discounted_unit_price,
+        'basis': basis,
         'subtotal': subtotal,
         'tax_rate': tax_rate,
         'tax_amount': tax_amount,
@@ -157,6 +159,42 @@ def calculate_price(material_id, width_mm, height_mm, quantity):
     }
 
 
+def nest_material_sheets(items, sheet_sizes=None):
+    """
+    同じ材質の明細を定尺板に板取りし、材質ごとの枚数・歩留まり・板単位の材料費を返す
+    
+    Args:
+        items: [{'material_id', 'width', 'height', 'quantity', 'ref'(任意)}]
+        sheet_sizes: [(幅, 高さ)]（None で STOCK_SHEET_SIZES）
+    
+    Returns:
+        dict: 材質ID -> {'layout': nesting.nest の best, 'candidates', 'sheet_cost', 'sheet_discount_rate'}
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(item['material_id'], []).append(item)
+    
+    result = {}
+    for material_id, group in groups.items():
+        nested = nesting.nest(group, sheet_sizes)
+        layout = nested['best']
+        sheet_cost = 0
+        sheet_discount_rate = 0
+        if layout['sheet_count']:
+            # 定尺板を部材とみなして価格計算（枚数でボリュームディスカウントを適用）
+            sheet_calc = calculate_price(material_id, layout['sheet_width'], layout['sheet_height'],
+                                         layout['sheet_count'])
+            sheet_cost = sheet_calc['subtotal']
+            sheet_discount_rate = sheet_calc['discount_rate']
+        result[material_id] = {
+            'layout': layout,
+            'candidates': nested['candidates'],
+            'sheet_cost': sheet_cost,
+            'sheet_discount_rate': sheet_discount_rate,
+        }
+    return result
+
+
 @bp.route('/')
 @require_app_enabled('signboard')
 @require_roles('tenant_admin', 'admin')
@@ -260,6 +298,79 @@ def materials():
     return render_template('signboard_materials.html', materials=materials)
 
 
+def _parse_range(prefix, default_min, default_max, default_step):
+    """
+    クエリ文字列の {prefix}_min / _max / _step から寸法の配列を作る
+
+    配列を作る前に件数を price_matrix.MAX_CELLS で打ち切る（極端に細かい step で
+    巨大なリストを作らせない）
+    """
+    from app.utils import price_matrix
+    
+    start = float(request.args.get(f'{prefix}_min', default_min))
+    stop = float(request.args.get(f'{prefix}_max', default_max))
+    step = float(request.args.get(f'{prefix}_step', default_step))
+    if not all(math.isfinite(v) for v in (start, stop, step)) or step <= 0 or start <= 0 or stop < start:
+        raise ValueError(f'{prefix} の範囲指定が不正です')
+    count = (stop - start) // step + 1
+    if count > price_matrix.MAX_CELLS:
+        raise ValueError(f'{prefix} の範囲が大きすぎます（最大{price_matrix.MAX_CELLS}件）')
+    count = int(count)
+    if price_matrix.np is None:
+        return [start + i * step for i in range(count)]
+    return start + step * price_matrix.np.arange(count)
+
+
+@bp.route('/materials/<int:material_id>/price_matrix')
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def material_price_matrix(material_id):
+    """
+    材質の価格マトリクス（幅×高さ×数量）をCSV/JSONで返す
+    
+    例: /signboard/materials/3/price_matrix?w_min=300&w_max=3000&w_step=100
+        &h_min=300&h_max=1800&h_step=100&quantities=1,5,10,50&format=csv
+    """
+    from flask import Response
+    from app.utils import price_matrix
+    
+    tenant_id = session.get('tenant_id')
+    
+    try:
+        widths = _parse_range('w', 300, 3000, 100)
+        heights = _parse_range('h', 300, 1800, 100)
+        quantities = [int(q) for q in request.args.get('quantities', '1,5,10,50').split(',') if q.strip()]
+        if not quantities or min(quantities) < 1:
+            raise ValueError('数量の指定が不正です')
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    if len(widths) * len(heights) * len(quantities) > price_matrix.MAX_CELLS:
+        return jsonify({'success': False, 'error': f'計算範囲が大きすぎます（最大{price_matrix.MAX_CELLS}件）'}), 400
+    
+    conn = get_db()
+    try:
+        rules = price_matrix.load_pricing_rules(conn, material_id, tenant_id)
+    finally:
+        conn.close()
+    
+    if not rules:
+        return jsonify({'success': False, 'error': '材質が見つかりません'}), 404
+    
+    try:
+        grid = price_matrix.price_grid(rules, widths, heights, quantities)
+    except (ValueError, RuntimeError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    if request.args.get('format', 'json') == 'csv':
+        return Response(
+            price_matrix.iter_csv(grid),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename=price_matrix_{material_id}.csv'}
+        )
+    return Response(price_matrix.iter_json(grid, material_id, rules['name']), mimetype='application/json')
+
+
 @bp.route('/materials/new', methods=['GET', 'POST'])
 @require_app_enabled('signboard')
 @require_roles('tenant_admin')
@@ -306,6 +417,7 @@ def material_new():
         ))
         conn.commit()
         conn.close()
+        material_match.invalidate(tenant_id)
         
         flash('材質を登録しました', 'success')
         return redirect(url_for('signboard.materials'))
@@ -366,6 +478,7 @@ def material_edit(material_id):
         ))
         conn.commit()
         conn.close()
+        material_match.invalidate(tenant_id)
         
         flash('材質を更新しました', 'success')
         return redirect(url_for('signboard.materials'))
@@ -434,6 +547,9 @@ def estimate_new():
                 item_id = key.split('[')[1].split(']')[0]
                 item_ids.add(item_id)
         
+        # 文字周長係数（文字加工のある明細が出てきた時点で1回だけ読み込む）
+        coefficients = None
+        
         # 各明細の価格を計算
         for item_id in item_ids:
             try:
@@ -441,6 +557,7 @@ def estimate_new():
                 width_str = request.form.get(f'items[{item_id}][width]')
                 height_str = request.form.get(f'items[{item_id}][height]')
                 quantity_str = request.form.get(f'items[{item_id}][quantity]', '1')
+                shape_type = request.form.get(f'items[{item_id}][shape_type]', 'square')
                 
                 if not material_id_str or not width_str or not height_str:
                     flash(f'明細{item_id}の入力が不完全です', 'error')
@@ -460,45 +577,54 @@ def estimate_new():
             text_width = request.form.get(f'items[{item_id}][text_width]')
             text_height = request.form.get(f'items[{item_id}][text_height]')
             character_type_id = request.form.get(f'items[{item_id}][character_type_id]')
+            font = request.form.get(f'items[{item_id}][font]')
             actual_perimeter = request.form.get(f'items[{item_id}][actual_perimeter]')
             perimeter_unit_price = request.form.get(f'items[{item_id}][perimeter_unit_price]')
             
             text_processing_data = None
             processing_cost = 0
             
-            if text_processing_mode and text_content and text_height and character_type_id:
+            if text_processing_mode and text_content and text_height:
                 try:
-                    # 推定周長を計算
-                    conn_temp = get_db()
-                    cur_temp = conn_temp.cursor()
-                    sql_coeff = _sql(conn_temp, 'SELECT "係数" FROM "T_文字周長係数" WHERE "ID" = %s')
-                    cur_temp.execute(sql_coeff, (int(character_type_id),))
-                    coeff_row = cur_temp.fetchone()
-                    conn_temp.close()
+                    if coefficients is None:
+                        conn_temp = get_db()
+                        try:
+                            coefficients = char_perimeter.load_coefficients(conn_temp, tenant_id)
+                        finally:
+                            conn_temp.close()
                     
-                    if coeff_row:
-                        coefficient = float(coeff_row[0])
+                    # 推定周長を計算（文字種類の指定があれば全文字にその係数、
+                    # なければフォント計測インデックス → 1文字ずつの自動判定）
+                    selected = coefficients['by_id'].get(int(character_type_id)) if character_type_id else None
+                    if selected:
+                        coefficient = selected[1]
                         character_count = len(text_content)
                         estimated_perimeter = float(text_height) * character_count * coefficient
-                        
-                        # 実測周長があればそれを優先
-                        final_perimeter = float(actual_perimeter) if actual_perimeter else estimated_perimeter
-                        
-                        # 加工賃を計算
-                        if perimeter_unit_price:
-                            processing_cost = int(final_perimeter * float(perimeter_unit_price))
-                        
-                        text_processing_data = {
-                            'mode': text_processing_mode,
-                            'content': text_content,
-                            'width': float(text_width) if text_width else None,
-                            'height': float(text_height),
-                            'character_type_id': int(character_type_id),
-                            'estimated_perimeter': estimated_perimeter,
-                            'actual_perimeter': float(actual_perimeter) if actual_perimeter else None,
-                            'perimeter_unit_price': float(perimeter_unit_price) if perimeter_unit_price else None,
-                            'processing_cost': processing_cost
-                        }
+                    else:
+                        estimate = char_perimeter.estimate_text(text_content, text_height, coefficients, font)
+                        estimated_perimeter = estimate['perimeter']
+                        # 文字幅が未入力ならフォントの送り幅から補完
+                        if not text_width and estimate['width']:
+                            text_width = round(estimate['width'], 1)
+                    
+                    # 実測周長があればそれを優先
+                    final_perimeter = float(actual_perimeter) if actual_perimeter else estimated_perimeter
+                    
+                    # 加工賃を計算
+                    if perimeter_unit_price:
+                        processing_cost = int(final_perimeter * float(perimeter_unit_price))
+                    
+                    text_processing_data = {
+                        'mode': text_processing_mode,
+                        'content': text_content,
+                        'width': float(text_width) if text_width else None,
+                        'height': float(text_height),
+                        'character_type_id': int(character_type_id) if selected else None,
+                        'estimated_perimeter': estimated_perimeter,
+                        'actual_perimeter': float(actual_perimeter) if actual_perimeter else None,
+                        'perimeter_unit_price': float(perimeter_unit_price) if perimeter_unit_price else None,
+                        'processing_cost': processing_cost
+                    }
                 except (ValueError, TypeError) as e:
                     flash(f'明細{item_id}の文字加工情報の処理エラー: {str(e)}', 'error')
                     return redirect(url_for('signboard.estimate_new'))
@@ -510,6 +636,7 @@ def estimate_new():
                     'width': width,
                     'height': height,
                     'quantity': quantity,
+                    'shape_type': shape_type,
                     'calc': calc,
                     'text_processing': text_processing_data,
                     'processing_cost': processing_cost
@@ -523,6 +650,46 @@ def estimate_new():
             flash('明細が入力されていません', 'error')
             return redirect(url_for('signboard.estimate_new'))
         
+        # 板取り計算（定尺板の消費枚数で材料費を計算）
+        if request.form.get('price_by_sheet'):
+            sheet_items = [item for item in items_data if item['shape_type'] == 'square']
+            try:
+                nested = nest_material_sheets(sheet_items)
+            except ValueError as e:
+                flash(f'板取り計算エラー: {str(e)}', 'error')
+                return redirect(url_for('signboard.estimate_new'))
+            
+            nesting_notes = []
+            for material_id, nest_result in nested.items():
+                layout = nest_result['layout']
+                group = [item for item in sheet_items if item['material_id'] == material_id]
+                if layout['unplaced']:
+                    flash(f'定尺板に収まらない部材があるため、材質ID {material_id} は面積で計算しました', 'warning')
+                    continue
+                # 板の材料費を各明細の面積比で配分
+                group_area = sum(item['calc']['area'] * item['quantity'] for item in group)
+                for item in group:
+                    calc = item['calc']
+                    share = calc['area'] * item['quantity'] / group_area if group_area else 0
+                    calc['subtotal'] = nest_result['sheet_cost'] * share
+                    # 明細の単価・割引後単価も板の材料費から逆算する
+                    # （割引率は定尺板の枚数で決まったもの。単価×(1-割引率)×量×数量 = 小計）
+                    basis_total = float(calc['basis'] or 0) * item['quantity']
+                    if basis_total:
+                        discount_rate = float(nest_result['sheet_discount_rate'] or 0)
+                        calc['discounted_unit_price'] = float(calc['subtotal']) / basis_total
+                        calc['discount_rate'] = discount_rate
+                        calc['unit_price'] = (calc['discounted_unit_price'] / (1 - discount_rate / 100)
+                                              if discount_rate < 100 else calc['discounted_unit_price'])
+                nesting_notes.append(
+                    f"材質ID {material_id}: {layout['sheet_width']:g}×{layout['sheet_height']:g} "
+                    f"{layout['sheet_count']}枚（歩留まり {layout['yield'] * 100:.1f}%）"
+                )
+            
+            total_subtotal = sum(item['calc']['subtotal'] + item['processing_cost'] for item in items_data)
+            if nesting_notes:
+                notes = '\n'.join(filter(None, [notes, '【板取り】'] + nesting_notes))
+        
         # 合計金額を計算
         tax_rate = 0.10
         tax_amount = int(total_subtotal * tax_rate)
@@ -696,7 +863,8 @@ def estimate_new():
     return render_template('signboard_estimate_new.html', 
                          materials=materials, 
                          subtype_info=subtype_info,
-                         perimeter_coefficients=perimeter_coefficients)
+                         perimeter_coefficients=perimeter_coefficients,
+                         fonts=font_metrics.available_fonts())
 
 
 @bp.route('/<int:estimate_id>')
@@ -761,7 +929,7 @@ def estimate_detail(estimate_id):
     auto_estimate_id = estimate[20]  # 自動見積もりIDは21番目のカラム
     if auto_estimate_id:
         sql = _sql(conn,
-            'SELECT "ID", "ファイル名", "ファイルパス" '
+            'SELECT "ID", "ファイル名", "ファイルパス", "content_hash" '
             'FROM "T_設計図ファイル" '
             'WHERE "自動見積もりID" = %s '
             'ORDER BY "ID"'
@@ -809,6 +977,54 @@ def api_calculate():
         }), 400
 
 
+@bp.route('/api/nesting', methods=['POST'])
+@require_app_enabled('signboard')
+@require_roles('tenant_admin', 'admin')
+def api_nesting():
+    """明細の板取り（定尺板の枚数・歩留まり・板単位の材料費）をAPIで計算"""
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        items = [
+            {
+                'ref': item.get('ref'),
+                'material_id': int(item['material_id']),
+                'width': float(item['width']),
+                'height': float(item['height']),
+                'quantity': int(item.get('quantity', 1)),
+            }
+            for item in data.get('items', [])
+        ]
+        sheet_sizes = nesting.parse_sheet_sizes(data['sheet_sizes']) if data.get('sheet_sizes') else None
+        nested = nest_material_sheets(items, sheet_sizes)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    result = []
+    for material_id, nest_result in nested.items():
+        layout = nest_result['layout']
+        result.append({
+            'material_id': material_id,
+            'sheet_width': layout['sheet_width'],
+            'sheet_height': layout['sheet_height'],
+            'sheet_count': layout['sheet_count'],
+            'yield': round(layout['yield'], 4),
+            'sheet_cost': int(nest_result['sheet_cost']),
+            'unplaced': layout['unplaced'],
+            'candidates': [
+                {
+                    'sheet_width': c['sheet_width'],
+                    'sheet_height': c['sheet_height'],
+                    'sheet_count': c['sheet_count'],
+                    'yield': round(c['yield'], 4),
+                }
+                for c in nest_result['candidates']
+            ],
+        })
+    
+    return jsonify({'success': True, 'data': result})
+
+
 @bp.route('/<int:estimate_id>/edit', methods=['GET', 'POST'])
 @require_app_enabled('signboard')
 @require_roles('tenant_admin', 'admin')
@@ -1078,6 +1294,7 @@ def perimeter_coefficient_new():
         ''')
         cur.execute(sql, (name, coefficient, display_order, is_active))
         conn.commit()
+        char_perimeter.invalidate_coefficients()
         conn.close()
         
         flash(f'文字周長係数「{name}」を登録しました', 'success')
@@ -1119,6 +1336,7 @@ def perimeter_coefficient_edit(coefficient_id):
         ''')
         cur.execute(sql, (name, coefficient, display_order, is_active, coefficient_id))
         conn.commit()
+        char_perimeter.invalidate_coefficients()
         conn.close()
         
         flash(f'文字周長係数「{name}」を更新しました', 'success')
@@ -1158,6 +1376,7 @@ def perimeter_coefficient_delete(coefficient_id):
     sql = _sql(conn, 'DELETE FROM "T_文字周長係数" WHERE id = %s')
     cur.execute(sql, (coefficient_id,))
     conn.commit()
+    char_perimeter.invalidate_coefficients()
     conn.close()
     
     flash(f'文字周長係数「{name}」を削除しました', 'success')
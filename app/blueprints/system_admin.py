@@ -3,7 +3,7 @@
 システム管理者ダッシュボード（SQLAlchemy版）
 """
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, send_file
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, send_file, make_response
 from werkzeug.security import generate_password_hash, check_password_hash
 from app.db import SessionLocal
 from app.models_login import TKanrisha, TJugyoin, TTenant, TTenpo, TKanrishaTenpo, TJugyoinTenpo, TTenantAppSetting, TTenpoAppSetting, TTenantAdminTenant, TSystemAdminTenant
@@ -12,6 +12,8 @@ from ..utils.decorators import ROLES
 from ..utils.decorators import require_roles
 from ..blueprints.tenant_admin import AVAILABLE_APPS
 import os
+import threading
+from datetime import datetime, timezone
 import markdown
 
 bp = Blueprint('system_admin', __name__, url_prefix='/system_admin')
@@ -307,61 +309,157 @@ def docs():
     return render_template('sys_docs.html', docs=docs_list)
 
 
+DOC_FILES = ['MIGRATION_GUIDE.md', 'AVAILABLE_APPS_GUIDE.md', 'README.md']
+DOCS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'docs')
+
+# 変換済みドキュメントのキャッシュ: filename -> {'key': (mtime, size), 'title', 'html'}
+_doc_cache = {}
+_doc_cache_lock = threading.Lock()
+
+
+def _render_doc(filename):
+    """
+    MarkdownをHTMLに変換して返す（(ファイル名, mtime, サイズ) でキャッシュ）
+    
+    Returns:
+        dict: {'key', 'title', 'html'}、ファイルが無い場合はNone
+    """
+    doc_path = os.path.join(DOCS_DIR, filename)
+    try:
+        stat = os.stat(doc_path)
+    except OSError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+    
+    cached = _doc_cache.get(filename)
+    if cached and cached['key'] == key:
+        return cached
+    
+    with _doc_cache_lock:
+        cached = _doc_cache.get(filename)
+        if cached and cached['key'] == key:
+            return cached
+        
+        with open(doc_path, 'r', encoding='utf-8') as f:
+            md_content = f.read()
+        
+        html_content = markdown.markdown(md_content, extensions=['tables', 'fenced_code', 'codehilite'])
+        
+        # タイトルを取得（最初の#行）
+        title = filename.replace('.md', '')
+        for line in md_content.split('\n'):
+            if line.startswith('# '):
+                title = line.replace('# ', '').strip()
+                break
+        
+        cached = {'key': key, 'title': title, 'html': html_content}
+        _doc_cache[filename] = cached
+        return cached
+
+
+def _prerender_docs():
+    """起動時にバックグラウンドで全ドキュメントを変換しておく"""
+    for filename in DOC_FILES:
+        try:
+            _render_doc(filename)
+        except Exception:
+            pass
+
+
+@bp.record_once
+def _warm_doc_cache(state):
+    threading.Thread(target=_prerender_docs, name='doc-prerender', daemon=True).start()
+
+
 @bp.route('/docs/<filename>')
 @require_roles(ROLES["SYSTEM_ADMIN"])
 def doc_view(filename):
     """ドキュメント閲覧"""
     # セキュリティ: ファイル名のバリデーション
-    allowed_files = ['MIGRATION_GUIDE.md', 'AVAILABLE_APPS_GUIDE.md', 'README.md']
-    if filename not in allowed_files:
+    if filename not in DOC_FILES:
         flash('指定されたドキュメントは存在しません', 'error')
         return redirect(url_for('system_admin.docs'))
     
-    # ドキュメントファイルのパスを取得
-    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    doc_path = os.path.join(base_dir, 'docs', filename)
+    doc = _render_doc(filename)
     
     # ファイルが存在しない場合
-    if not os.path.exists(doc_path):
+    if doc is None:
         flash('ドキュメントファイルが見つかりません', 'error')
         return redirect(url_for('system_admin.docs'))
     
-    # Markdownファイルを読み込んでHTMLに変換
-    with open(doc_path, 'r', encoding='utf-8') as f:
-        md_content = f.read()
-    
-    html_content = markdown.markdown(md_content, extensions=['tables', 'fenced_code', 'codehilite'])
-    
-    # タイトルを取得（最初の#行）
-    title = filename.replace('.md', '')
-    for line in md_content.split('\n'):
-        if line.startswith('# '):
-            title = line.replace('# ', '').strip()
-            break
-    
-    return render_template('sys_doc_view.html', title=title, content=html_content, filename=filename)
+    # 本文からETagを付け、変更がなければ304を返す
+    response = make_response(render_template('sys_doc_view.html', title=doc['title'], content=doc['html'], filename=filename))
+    response.last_modified = datetime.fromtimestamp(doc['key'][0] / 1e9, tz=timezone.utc)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @bp.route('/docs/<filename>/download')
 @require_roles(ROLES["SYSTEM_ADMIN"])
 def doc_download(filename):
-    """ドキュメントダウンロード"""
+    """ドキュメントダウンロード（If-None-Match / If-Modified-Since / Range 対応）"""
     # セキュリティ: ファイル名のバリデーション
-    allowed_files = ['MIGRATION_GUIDE.md', 'AVAILABLE_APPS_GUIDE.md', 'README.md']
-    if filename not in allowed_files:
+    if filename not in DOC_FILES:
         flash('指定されたドキュメントは存在しません', 'error')
         return redirect(url_for('system_admin.docs'))
     
-    # ドキュメントファイルのパスを取得
-    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    doc_path = os.path.join(base_dir, 'docs', filename)
+    doc_path = os.path.join(DOCS_DIR, filename)
     
     # ファイルが存在しない場合
     if not os.path.exists(doc_path):
         flash('ドキュメントファイルが見つかりません', 'error')
         return redirect(url_for('system_admin.docs'))
     
-    return send_file(doc_path, as_attachment=True, download_name=filename)
+    return send_file(doc_path, as_attachment=True, download_name=filename,
+                     conditional=True, etag=True, max_age=0)
+
+
+@bp.route('/slow_queries', methods=['GET', 'POST'])
+@require_roles(ROLES["SYSTEM_ADMIN"])
+def slow_queries():
+    """スロークエリ一覧（このワーカーで記録されたもの）"""
+    from ..utils import slow_query
+    from flask import current_app
+
+    if request.method == 'POST':
+        slow_query.clear()
+        flash('スロークエリの記録を消去しました', 'success')
+        return redirect(url_for('system_admin.slow_queries'))
+
+    return render_template(
+        'sys_slow_queries.html',
+        enabled=current_app.config.get('SLOW_QUERY_ENABLED', False),
+        threshold_ms=slow_query.THRESHOLD_MS,
+        offenders=slow_query.top_offenders(),
+        recent=slow_query.get_records()[:50],
+    )
+
+
+@bp.route('/ai_usage')
+@require_roles(ROLES["SYSTEM_ADMIN"])
+def ai_usage():
+    """AI利用状況（テナント別、tenant_id 指定でそのテナントの日別・モデル別）"""
+    from ..utils import usage
+    from ..utils.db import get_db_connection
+
+    days = min(max(request.args.get('days', 30, type=int), 1), 365)
+    tenant_id = request.args.get('tenant_id', type=int)
+    conn = get_db_connection()
+    try:
+        if tenant_id:
+            return render_template('tenant_admin_ai_usage.html',
+                                   report=usage.tenant_report(conn, tenant_id, days),
+                                   days=days,
+                                   tenant_id=tenant_id,
+                                   rate_per_minute=usage.RATE_PER_MINUTE,
+                                   back_url=url_for('system_admin.ai_usage', days=days))
+        tenants = usage.system_report(conn, days)
+    finally:
+        conn.close()
+
+    return render_template('sys_ai_usage.html', tenants=tenants, days=days)
 
 
 # ========================================
@@ -10,6 +10,9 @@ from app.models_login import TKanrisha, TJugyoin, TTenant, TTenpo, TKanrishaTenp
 from sqlalchemy import func, and_, or_
 from ..utils.decorators import ROLES
 from ..utils.decorators import require_roles
+import logging
+
+logger = logging.getLogger(__name__)
 
 bp = Blueprint('tenant_admin', __name__, url_prefix='/tenant_admin')
 
@@ -55,21 +58,17 @@ def dashboard():
         # AVAILABLE_APPSからテナントレベルのアプリをフィルタリング
         from ..blueprints.tenant_admin import AVAILABLE_APPS
         
-        # 有効化されたアプリのみを取得
-        tenant_apps = []
-        for app in AVAILABLE_APPS:
-            if app.get('scope') == 'tenant':
-                # TTenantAppSettingでenabled=1のアプリのみ追加
-                app_setting = db.query(TTenantAppSetting).filter(
-                    and_(
-                        TTenantAppSetting.tenant_id == tenant_id,
-                        TTenantAppSetting.app_id == app.get('name'),
-                        TTenantAppSetting.enabled == 1
-                    )
-                ).first()
-                
-                if app_setting:
-                    tenant_apps.append(app)
+        # 有効化されたアプリのみを取得（TTenantAppSettingでenabled=1のものを1回で取得）
+        enabled_app_ids = {
+            row.app_id for row in db.query(TTenantAppSetting.app_id).filter(
+                and_(
+                    TTenantAppSetting.tenant_id == tenant_id,
+                    TTenantAppSetting.enabled == 1
+                )
+            ).all()
+        }
+        tenant_apps = [app for app in AVAILABLE_APPS
+                       if app.get('scope') == 'tenant' and app.get('name') in enabled_app_ids]
         
         return render_template('tenant_admin_dashboard.html', 
                              tenant_id=tenant_id,
@@ -231,6 +230,32 @@ def tenant_info():
         db.close()
 
 
+@bp.route('/ai_usage')
+@require_roles(ROLES["TENANT_ADMIN"], ROLES["SYSTEM_ADMIN"])
+def ai_usage():
+    """AI利用状況（日別・モデル別の呼び出し回数・トークン数・概算費用）"""
+    from ..utils import usage
+    from ..utils.db import get_db_connection
+
+    tenant_id = session.get('tenant_id')
+    if not tenant_id:
+        flash('テナントIDが取得できません', 'error')
+        return redirect(url_for('tenant_admin.dashboard'))
+
+    days = min(max(request.args.get('days', 30, type=int), 1), 365)
+    conn = get_db_connection()
+    try:
+        report = usage.tenant_report(conn, tenant_id, days)
+    finally:
+        conn.close()
+
+    return render_template('tenant_admin_ai_usage.html',
+                           report=report,
+                           days=days,
+                           rate_per_minute=usage.RATE_PER_MINUTE,
+                           back_url=url_for('tenant_admin.dashboard'))
+
+
 @bp.route('/tenant_detail')
 @require_roles(ROLES["TENANT_ADMIN"], ROLES["SYSTEM_ADMIN"])
 def tenant_detail():
@@ -705,7 +730,7 @@ def store_delete(store_id):
 def tenant_admins():
     """テナント管理者一覧"""
     tenant_id = session.get('tenant_id')
-    print(f"DEBUG: tenant_id = {tenant_id}")
+    logger.debug(f"tenant_admins: tenant_id={tenant_id}")
     db = SessionLocal()
     
     try:
@@ -713,28 +738,38 @@ def tenant_admins():
         relations = db.query(TTenantAdminTenant).filter(
             TTenantAdminTenant.tenant_id == tenant_id
         ).all()
-        print(f"DEBUG: relations count = {len(relations)}")
-        for rel in relations:
-            print(f"DEBUG: relation - admin_id={rel.admin_id}, tenant_id={rel.tenant_id}, is_owner={rel.is_owner}")
-        
-        admins_data = []
-        for rel in relations:
-            admin = db.query(TKanrisha).filter(
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"tenant_admins: relations={[(rel.admin_id, rel.tenant_id, rel.is_owner) for rel in relations]}")
+        
+        # 管理者・所属テナントはそれぞれ1回のクエリでまとめて取得する
+        admin_ids = [rel.admin_id for rel in relations]
+        admin_map = {}
+        tenant_relations_by_admin = {}
+        tenant_map = {}
+        if admin_ids:
+            admin_map = {a.id: a for a in db.query(TKanrisha).filter(
                 and_(
-                    TKanrisha.id == rel.admin_id,
+                    TKanrisha.id.in_(admin_ids),
                     TKanrisha.role == ROLES["TENANT_ADMIN"]
                 )
-            ).first()
+            ).all()}
+            for tenant_rel in db.query(TTenantAdminTenant).filter(
+                TTenantAdminTenant.admin_id.in_(list(admin_map))
+            ).order_by(TTenantAdminTenant.id).all():
+                tenant_relations_by_admin.setdefault(tenant_rel.admin_id, []).append(tenant_rel)
+            tenant_ids = {r.tenant_id for rels in tenant_relations_by_admin.values() for r in rels}
+            if tenant_ids:
+                tenant_map = {t.id: t for t in db.query(TTenant).filter(TTenant.id.in_(tenant_ids)).all()}
+        
+        admins_data = []
+        for rel in relations:
+            admin = admin_map.get(rel.admin_id)
             
             if admin:
-                # 所属テナント情報を取得
-                tenant_relations = db.query(TTenantAdminTenant).filter(
-                    TTenantAdminTenant.admin_id == admin.id
-                ).all()
-                
+                # 所属テナント情報
                 tenants = []
-                for tenant_rel in tenant_relations:
-                    tenant_info = db.query(TTenant).filter(TTenant.id == tenant_rel.tenant_id).first()
+                for tenant_rel in tenant_relations_by_admin.get(admin.id, []):
+                    tenant_info = tenant_map.get(tenant_rel.tenant_id)
                     if tenant_info:
                         tenants.append({
                             'id': tenant_info.id,
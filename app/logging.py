@@ -1,25 +1,131 @@
+import atexit
+import copy
 import json
 import logging
+import logging.handlers
+import queue
+import random
 import sys
+import uuid
+
+_listener = None
+
 
 class JsonFormatter(logging.Formatter):
     def format(self, record):
         base = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
             "level": record.levelname,
             "message": record.getMessage(),
             "logger": record.name,
+            "request_id": getattr(record, "request_id", None),
         }
         if record.exc_info:
             base["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # QueueHandler で呼び出し元スレッドのうちに文字列にしたもの
+            base["exc_info"] = record.exc_text
+        if record.stack_info:
+            base["stack_info"] = self.formatStack(record.stack_info)
         return json.dumps(base, ensure_ascii=False)
 
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    レコードを整形せずにキューへ渡す QueueHandler です。
+    標準の prepare() は呼び出し元スレッドで既定の形式に整形し、トレースバックを message に
+    混ぜて exc_info を消すため、JsonFormatter が exc_info を出せなくなります。
+    ここでは例外だけを文字列にし（トレースバックのフレームを別スレッドに渡さない）、
+    msg / args はそのまま残して整形はリスナーのスレッドに任せます。
+    """
+    _exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    レコードに request_id を付与します（リクエスト外では "-"）。
+    呼び出し元スレッドで実行されるよう QueueHandler 側に付けます。
+    """
+    def filter(self, record):
+        record.request_id = get_request_id()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    大量に出るメッセージを間引きます。
+    logger.debug("...", extra={"sample_rate": 0.01}) のように指定すると
+    その割合だけ出力されます（WARNING 以上は常に出力）。
+    """
+    def filter(self, record):
+        rate = getattr(record, "sample_rate", None)
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+
+def get_request_id() -> str:
+    """現在のリクエストID（X-Request-ID ヘッダー、無ければ生成）"""
+    try:
+        from flask import g, has_request_context, request
+    except ImportError:
+        return "-"
+    if not has_request_context():
+        return "-"
+    request_id = getattr(g, "request_id", None)
+    if request_id is None:
+        request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+        g.request_id = request_id
+    return request_id
+
+
 def setup_logging(debug: bool = False) -> None:
     """
     ルートロガーを初期化して、標準出力にJSON形式でログを流します。
+    整形と書き込みは QueueListener のスレッドで行い、リクエスト処理を待たせません。
     """
+    global _listener
+
     root = logging.getLogger()
     root.handlers.clear()
     root.setLevel(logging.DEBUG if debug else logging.INFO)
-    handler = logging.StreamHandler(stream=sys.stdout)
-    handler.setFormatter(JsonFormatter())
-    root.addHandler(handler)
+
+    _stop_listener()
+
+    stream_handler = logging.StreamHandler(stream=sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = RecordQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    queue_handler.addFilter(RequestIdFilter())
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_listener() -> None:
+    """キューに残ったログを書き出してリスナーを止めます。"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+def init_request_id(app) -> None:
+    """レスポンスに X-Request-ID を返し、ログと突き合わせられるようにします。"""
+    @app.after_request
+    def _add_request_id_header(response):
+        response.headers["X-Request-ID"] = get_request_id()
+        return response
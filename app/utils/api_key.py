@@ -3,9 +3,12 @@
 OpenAI APIキー取得ユーティリティ
 """
 
+import logging
 import os
 from .db import get_db_connection, _sql
 
+logger = logging.getLogger(__name__)
+
 
 def get_openai_api_key(store_id=None, tenant_id=None, app_name=None):
     """
@@ -100,7 +103,7 @@ def get_openai_api_key(store_id=None, tenant_id=None, app_name=None):
         
         conn.close()
     except Exception as e:
-        print(f"Error getting OpenAI API key from database: {e}")
+        logger.warning(f"Error getting OpenAI API key from database: {e}")
     
     # 6. 環境変数を確認
     api_key = os.environ.get('OPENAI_API_KEY')
@@ -123,13 +126,26 @@ def get_openai_client(store_id=None, tenant_id=None, app_name=None):
     try:
         from openai import OpenAI
     except ImportError:
-        print("Error: openai package is not installed")
+        logger.error("openai package is not installed")
         return None
     
+    from app.utils import resilience, transport
+    
+    if transport.MODE == 'replay':
+        # 記録した応答を返すだけなのでAPIキーは不要
+        return transport.wrap_openai(None)
+    
     api_key = get_openai_api_key(store_id=store_id, tenant_id=tenant_id, app_name=app_name)
     
     if not api_key:
-        print("Error: OpenAI API key not found")
+        logger.warning("OpenAI API key not found")
         return None
     
-    return OpenAI(api_key=api_key, base_url='https://api.openai.com/v1')
+    # TRANSPORT_MODE=record のときは応答を記録する（送信量も集計）
+    # 障害時にワーカーが長時間ふさがらないよう、タイムアウトを明示する
+    return transport.wrap_openai(OpenAI(
+        api_key=api_key,
+        base_url='https://api.openai.com/v1',
+        timeout=resilience.openai_timeout(),
+        max_retries=resilience.OPENAI_MAX_RETRIES
+    ))
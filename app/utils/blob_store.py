@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+設計図ファイルの内容アドレス保存（SHA-256 による重複排除）
+
+設計図の実体は内容の SHA-256（content_hash）をキーに T_設計図ブロブ に1件だけ保存し、
+T_設計図ファイル（アップロードごとの行）は content_hash で実体を参照します（migrations/009）。
+
+- 同じ内容が保存済みならアップロードを省き、参照数を増やすだけにする
+- 保存先（app/utils/storage.py）でのキーもハッシュにするので、同じ内容の
+  同時アップロードは同じ場所に保存されるだけで重複しない
+- 参照数が0になって BLOB_GC_GRACE_HOURS 経った実体は collect_garbage で削除する
+  （gc_blueprints.py から定期実行）
+
+T_自動見積もり を削除する場合は、先に release で参照を外します。外し忘れや
+ON DELETE CASCADE で消えた参照は collect_garbage が実際の参照から数え直します。
+content_hash の無い（このマイグレーションより前の）行は従来どおり個別のファイルのままです。
+"""
+
+import hashlib
+import logging
+import os
+from contextlib import contextmanager
+
+from app.utils import derivatives, storage, tiles
+from app.utils.db import _is_pg, manual_commit
+from app.utils.metrics import inc_counter
+
+logger = logging.getLogger(__name__)
+
+# 参照数が0になってから実体を削除するまでの時間（直後の再アップロードで使い回せるように）
+GC_GRACE_HOURS = float(os.getenv('BLOB_GC_GRACE_HOURS', '24'))
+# collect_garbage が1回に削除する件数の上限
+GC_BATCH_SIZE = int(os.getenv('BLOB_GC_BATCH_SIZE', '200'))
+
+_CHUNK_SIZE = 1024 * 1024
+# content_hash ごとのアドバイザリロックの名前空間（pg_advisory_lock の1つ目のキー）
+_LOCK_NAMESPACE = 0x626c6f62
+
+
+def content_hash(file):
+    """
+    ファイルの SHA-256（16進）を少しずつ読んで計算する（読み終えたら先頭に戻す）
+
+    Args:
+        file: read() / seek() できるもの（FileStorage など）
+    """
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in storage.iter_chunks(file, _CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def _file_size(file):
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    return size
+
+
+@contextmanager
+def _digest_lock(cur, digest):
+    """
+    content_hash ごとのアドバイザリロック（acquire の保存と collect_garbage の実体の削除を直列にする）
+
+    トランザクション中ならコミット・ロールバックまで、autocommit の接続ならブロックを抜けるまで保持します。
+    """
+    if not _is_pg(cur.connection):
+        yield
+        return
+    if not cur.connection.autocommit:
+        cur.execute('SELECT pg_advisory_xact_lock(%s, hashtext(%s))', (_LOCK_NAMESPACE, digest))
+        yield
+        return
+    cur.execute('SELECT pg_advisory_lock(%s, hashtext(%s))', (_LOCK_NAMESPACE, digest))
+    try:
+        yield
+    finally:
+        cur.execute('SELECT pg_advisory_unlock(%s, hashtext(%s))', (_LOCK_NAMESPACE, digest))
+
+
+def acquire(cur, file, file_ext, backend=None, fallback=True, digest=None):
+    """
+    設計図の実体を保存して参照数を1増やす（保存済みの内容ならアップロードしない）
+
+    Args:
+        cur: カーソル（呼び出し側のトランザクションで実行、コミットは呼び出し側）
+        file: 設計図ファイル（FileStorage など）
+        file_ext: 拡張子（pdf / png / jpg / jpeg）
+        backend: 保存先の名前（省略時は STORAGE_BACKEND）
+        fallback: False なら保存先に書き込めないときに STORAGE_FALLBACK に保存しない
+        digest: 計算済みの content_hash（省略時はファイルを読んで計算する）
+
+    Returns:
+        tuple: (content_hash, ファイルパス)
+    """
+    digest = digest or content_hash(file)
+    cur.execute('''
+        UPDATE "T_設計図ブロブ"
+        SET "参照数" = "参照数" + 1, "最終参照日時" = CURRENT_TIMESTAMP
+        WHERE "content_hash" = %s
+        RETURNING "ファイルパス"
+    ''', (digest,))
+    row = cur.fetchone()
+    if row:
+        inc_counter('blob_dedup_hits_total')
+        return digest, row[0]
+
+    # 保存先のキーは内容で決まるので、collect_garbage が同じ実体を消している最中に
+    # 保存し直さないよう、登録を終えるまで content_hash のロックを持つ
+    with _digest_lock(cur, digest):
+        backend, filepath = storage.put(f"{digest}.{file_ext}", file, file_ext, backend, fallback)
+        # 同じ内容が同時にアップロードされた場合は先に登録された方を使う
+        cur.execute('''
+            INSERT INTO "T_設計図ブロブ" ("content_hash", "保存先", "ファイルパス", "ファイルタイプ", "サイズ", "参照数")
+            VALUES (%s, %s, %s, %s, %s, 1)
+            ON CONFLICT ("content_hash") DO UPDATE
+            SET "参照数" = "T_設計図ブロブ"."参照数" + 1, "最終参照日時" = CURRENT_TIMESTAMP
+            RETURNING "ファイルパス"
+        ''', (digest, backend, filepath, file_ext, _file_size(file)))
+        return digest, cur.fetchone()[0]
+
+
+def release(cur, auto_estimate_id):
+    """
+    自動見積もりの設計図ファイルが参照している実体の参照数を減らす
+    （T_自動見積もり / T_設計図ファイル を削除する前に同じトランザクションで呼ぶ）
+
+    Args:
+        auto_estimate_id: 自動見積もりID（複数の場合はリスト）
+
+    Returns:
+        list: 参照数が0になった実体の content_hash
+    """
+    ids = list(auto_estimate_id) if isinstance(auto_estimate_id, (list, tuple)) else [auto_estimate_id]
+    cur.execute('''
+        UPDATE "T_設計図ブロブ" b
+        SET "参照数" = GREATEST(b."参照数" - f."件数", 0), "最終参照日時" = CURRENT_TIMESTAMP
+        FROM (
+            SELECT "content_hash", COUNT(*) AS "件数"
+            FROM "T_設計図ファイル"
+            WHERE "自動見積もりID" = ANY(%s) AND "content_hash" IS NOT NULL
+            GROUP BY "content_hash"
+        ) f
+        WHERE b."content_hash" = f."content_hash"
+        RETURNING b."content_hash", b."参照数"
+    ''', (ids,))
+    return [digest for digest, refs in cur.fetchall() if refs == 0]
+
+
+def _delete_objects(digest, targets, stats):
+    """削除した行の実体・派生画像・タイルを保存先から消す（失敗は stats['errors'] に数える）"""
+    if targets['blob']:
+        filepath, size = targets['blob']
+        try:
+            storage.delete(filepath)
+        except Exception as e:
+            # 行は削除済みなので、残った実体は同じ内容の次のアップロードで再利用される
+            logger.warning(f"設計図の実体を削除できませんでした: {digest[:12]} {e}")
+            stats['errors'] += 1
+        else:
+            stats['deleted'] += 1
+            stats['bytes'] += size or 0
+    for filepath, size in targets['derivatives']:
+        try:
+            storage.delete(filepath)
+        except Exception as e:
+            logger.warning(f"派生画像を削除できませんでした: {filepath} {e}")
+            stats['errors'] += 1
+            continue
+        stats['derivatives'] += 1
+        stats['bytes'] += size or 0
+    for page, backend in targets['tiles']:
+        try:
+            tiles.remove(digest, page, backend)
+        except Exception as e:
+            logger.warning(f"タイルを削除できませんでした: {digest[:12]} p{page} {e}")
+            stats['errors'] += 1
+
+
+def collect_garbage(conn, grace_hours=None, limit=None, dry_run=False, only=None):
+    """
+    参照されなくなった実体を削除する
+
+    参照数を実際の T_設計図ファイル の件数に合わせ直してから、参照数0のまま
+    grace_hours 経った実体を limit 件まで、その派生画像（app/utils/derivatives.py）・
+    タイル（app/utils/tiles.py）と一緒に削除します。行を先に削除してコミットし、
+    その後で保存先の実体を消します。保存先のキーは内容で決まるので、コミットの後に
+    同じ内容がアップロードされると同じ場所に保存し直されます。そのため実体ごとに
+    acquire と同じロックを取り、行が登録し直されていないことを確かめてから消します。
+
+    接続が autocommit でも、数え直しから行の削除までは1つのトランザクションで行い、
+    dry_run のときはロールバックして何も変更しません。
+
+    Args:
+        only: 指定した content_hash だけを、経過時間に関係なく対象にする
+              （app/utils/reaper.py が放置された見積もりの実体を消すとき、参照数の数え直しは省く）
+
+    Returns:
+        dict: {'reconciled', 'candidates', 'deleted', 'bytes', 'derivatives', 'errors'}
+    """
+    grace_hours = GC_GRACE_HOURS if grace_hours is None else grace_hours
+    limit = limit or (len(only) if only else GC_BATCH_SIZE)
+    if only is not None:
+        condition, param = '"content_hash" = ANY(%s)', list(only)
+    else:
+        condition, param = '"最終参照日時" < CURRENT_TIMESTAMP - make_interval(secs => %s)', grace_hours * 3600
+    stats = {'reconciled': 0, 'candidates': 0, 'deleted': 0, 'bytes': 0, 'derivatives': 0, 'errors': 0}
+    with manual_commit(conn):
+        cur = conn.cursor()
+        try:
+            if only is None:
+                # 全体の参照数の数え直し（only の実体は release で減らした直後なので不要）
+                cur.execute('''
+                    UPDATE "T_設計図ブロブ" b
+                    SET "参照数" = r."件数"
+                    FROM (
+                        SELECT b2."content_hash",
+                               (SELECT COUNT(*) FROM "T_設計図ファイル" f WHERE f."content_hash" = b2."content_hash") AS "件数"
+                        FROM "T_設計図ブロブ" b2
+                    ) r
+                    WHERE b."content_hash" = r."content_hash" AND b."参照数" <> r."件数"
+                ''')
+                stats['reconciled'] = cur.rowcount
+
+            if dry_run:
+                cur.execute('''
+                    SELECT COUNT(*), COALESCE(SUM("サイズ"), 0)
+                    FROM "T_設計図ブロブ"
+                    WHERE "参照数" = 0 AND {condition}
+                '''.format(condition=condition), (param,))
+                stats['candidates'], stats['bytes'] = cur.fetchone()
+                conn.rollback()
+                return stats
+
+            cur.execute('''
+                DELETE FROM "T_設計図ブロブ"
+                WHERE "content_hash" IN (
+                    SELECT "content_hash" FROM "T_設計図ブロブ"
+                    WHERE "参照数" = 0 AND {condition}
+                    ORDER BY "最終参照日時"
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM "T_設計図ファイル" f WHERE f."content_hash" = "T_設計図ブロブ"."content_hash"
+                )
+                RETURNING "content_hash", "ファイルパス", "サイズ"
+            '''.format(condition=condition), (param, limit))
+            removed = cur.fetchall()
+            # 削除した実体（と以前に削除した実体）の派生画像
+            removed_digests = [row[0] for row in removed] if only is not None else None
+            removed_derivatives = derivatives.sweep(cur, grace_hours, removed_digests)
+            removed_tiles = tiles.sweep(cur, grace_hours, removed_digests)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            cur.close()
+            raise
+        stats['candidates'] = len(removed)
+
+        targets = {}
+        for digest, filepath, size in removed:
+            targets.setdefault(digest, {'blob': None, 'derivatives': [], 'tiles': []})['blob'] = (filepath, size)
+        for digest, filepath, size in removed_derivatives:
+            targets.setdefault(digest, {'blob': None, 'derivatives': [], 'tiles': []})['derivatives'].append((filepath, size))
+        for digest, page, backend in removed_tiles:
+            targets.setdefault(digest, {'blob': None, 'derivatives': [], 'tiles': []})['tiles'].append((page, backend))
+        try:
+            for digest, digest_targets in targets.items():
+                with _digest_lock(cur, digest):
+                    cur.execute('SELECT 1 FROM "T_設計図ブロブ" WHERE "content_hash" = %s', (digest,))
+                    if cur.fetchone():
+                        # コミットの後に同じ内容がアップロードされ、同じキーに保存し直されている
+                        logger.info(f"再登録された設計図の実体は削除しません: {digest[:12]}")
+                    else:
+                        _delete_objects(digest, digest_targets, stats)
+                # ロック（pg_advisory_xact_lock）を外す
+                conn.commit()
+        finally:
+            cur.close()
+    inc_counter('blob_gc_deleted_total', stats['deleted'])
+    inc_counter('blob_gc_bytes_total', stats['bytes'])
+    return stats
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+文字周長の推定（1文字ずつ文字種類を判定）
+
+文字内容の各文字を Unicode の範囲表で分類し（ひらがな・カタカナ・
+漢字は画数帯・英数字の大文字/小文字・記号）、文字種類ごとの係数を
+合計して推定周長 = 文字高さ × Σ係数 を求めます。
+
+係数は T_文字周長係数 からテナントごとに1回だけ読み込んでキャッシュします
+（テナント固有の係数がデフォルト（テナントID IS NULL）より優先）。
+
+フォント計測インデックス（font_metrics）がある場合は、グリフのある文字は
+実際のアウトライン長を使い、係数はグリフの無い文字にだけ使います。
+"""
+
+import os
+import threading
+import time
+import unicodedata
+from bisect import bisect_right
+from functools import lru_cache
+
+from . import font_metrics
+from .db import _sql
+
+HIRAGANA = 'ひらがな'
+KATAKANA = 'カタカナ'
+KANJI_SIMPLE = '漢字（簡単）'
+KANJI_NORMAL = '漢字（普通）'
+KANJI_COMPLEX = '漢字（複雑）'
+ALNUM_UPPER = '英数字（大文字）'
+ALNUM_LOWER = '英数字（小文字）'
+SYMBOL = '記号'
+
+CLASSES = (HIRAGANA, KATAKANA, KANJI_SIMPLE, KANJI_NORMAL, KANJI_COMPLEX, ALNUM_UPPER, ALNUM_LOWER, SYMBOL)
+
+# T_文字周長係数 に行が無い場合の係数（migrations/006 の初期値）
+DEFAULT_COEFFICIENTS = {
+    HIRAGANA: 6.0,
+    KATAKANA: 5.5,
+    KANJI_SIMPLE: 7.0,
+    KANJI_NORMAL: 8.5,
+    KANJI_COMPLEX: 10.0,
+    ALNUM_UPPER: 5.0,
+    ALNUM_LOWER: 4.5,
+    SYMBOL: 4.0,
+}
+
+_KANJI = '漢字'
+
+# Unicode 範囲表（開始, 終了, 文字種類）。開始位置で昇順
+_RANGES = sorted([
+    (0x0030, 0x0039, ALNUM_UPPER),     # 0-9
+    (0x0041, 0x005A, ALNUM_UPPER),     # A-Z
+    (0x0061, 0x007A, ALNUM_LOWER),     # a-z
+    (0x3005, 0x3005, KANJI_SIMPLE),    # 々
+    (0x3041, 0x309F, HIRAGANA),
+    (0x30A0, 0x30FF, KATAKANA),        # ー を含む
+    (0x31F0, 0x31FF, KATAKANA),        # 小書きカタカナ拡張
+    (0x3400, 0x4DBF, _KANJI),          # CJK拡張A
+    (0x4E00, 0x9FFF, _KANJI),          # CJK統合漢字
+    (0xF900, 0xFAFF, _KANJI),          # CJK互換漢字
+])
+_RANGE_STARTS = [r[0] for r in _RANGES]
+
+# 画数帯: 5画以下は簡単、16画以上は複雑、それ以外は普通
+SIMPLE_MAX_STROKES = 5
+COMPLEX_MIN_STROKES = 16
+
+# 画数表が無い場合に使う代表的な漢字（5画以下 / 16画以上）
+_SIMPLE_KANJI = set(
+    '一乙二十人入八九七力刀丁了又三上下口山川小大土女子千工才万与寸夕久丸弓己巾干'
+    '日月火水木中王天五六円今午手文方犬比引心分不切内太友少毛止化公区元収氏反片牛父予支井互'
+    '本田目右左四出生白石立正玉半北古外市世皮皿申由甲代付他必平母民用末未札令以失央広打可司台史号功加占去'
+)
+_COMPLEX_KANJI = set(
+    '頭館親橋機薬録整築燃輸頼薫衛縦獲激憲鋼興樹操奮壁磨隣錦薔'
+    '覧講謝績厳優縮聴環鮮齢療'
+    '観験題額類顔曜織職難臨簡贈鎖騎藤癖'
+    '願鏡識警韻麗艶蘭響議護競籍譲騰鐘露躍艦魔鶴驚襲鑑鬱'
+)
+
+# Unihan の kTotalStrokes 形式（"U+4E00<TAB>kTotalStrokes<TAB>1"）のファイルがあれば画数表として使う
+KANJI_STROKES_PATH = os.getenv('KANJI_STROKES_PATH')
+
+
+@lru_cache(maxsize=1)
+def _stroke_table():
+    table = {}
+    if not KANJI_STROKES_PATH or not os.path.exists(KANJI_STROKES_PATH):
+        return table
+    with open(KANJI_STROKES_PATH, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) >= 3 and parts[1] == 'kTotalStrokes' and parts[0].startswith('U+'):
+                table[int(parts[0][2:], 16)] = int(parts[2].split()[0])
+    return table
+
+
+def _kanji_class(ch):
+    strokes = _stroke_table().get(ord(ch))
+    if strokes is None:
+        if ch in _SIMPLE_KANJI:
+            return KANJI_SIMPLE
+        if ch in _COMPLEX_KANJI:
+            return KANJI_COMPLEX
+        return KANJI_NORMAL
+    if strokes <= SIMPLE_MAX_STROKES:
+        return KANJI_SIMPLE
+    if strokes >= COMPLEX_MIN_STROKES:
+        return KANJI_COMPLEX
+    return KANJI_NORMAL
+
+
+@lru_cache(maxsize=8192)
+def classify_char(ch):
+    """
+    1文字の文字種類を返す（空白はNone）
+
+    全角英数・半角カナは NFKC で正規化してから判定します。
+    """
+    normalized = unicodedata.normalize('NFKC', ch)
+    if len(normalized) == 1:
+        ch = normalized
+    if ch.isspace():
+        return None
+    code = ord(ch[0])
+    i = bisect_right(_RANGE_STARTS, code) - 1
+    if i >= 0:
+        start, end, cls = _RANGES[i]
+        if start <= code <= end:
+            return _kanji_class(ch[0]) if cls == _KANJI else cls
+    return SYMBOL
+
+
+# ===========================
+# 係数のテナント別キャッシュ
+# ===========================
+CACHE_TTL = float(os.getenv('PERIMETER_COEFFICIENT_CACHE_TTL', '300'))
+
+_cache = {}     # tenant_id -> (loaded_at, coefficients)
+_cache_lock = threading.Lock()
+
+
+def load_coefficients(conn, tenant_id):
+    """
+    テナントの係数を返す（キャッシュ済みならDBに問い合わせない）
+
+    Returns:
+        dict: {'by_class': {文字種類: 係数}, 'by_id': {ID: (文字種類, 係数)}}
+    """
+    now = time.monotonic()
+    cached = _cache.get(tenant_id)
+    if cached and now - cached[0] < CACHE_TTL:
+        return cached[1]
+
+    cur = conn.cursor()
+    cur.execute(_sql(conn,
+        'SELECT "ID", "文字種類", "係数", "テナントID" FROM "T_文字周長係数" '
+        'WHERE "テナントID" IS NULL OR "テナントID" = %s'
+    ), (tenant_id,))
+    rows = cur.fetchall()
+
+    by_class = dict(DEFAULT_COEFFICIENTS)
+    by_id = {}
+    # デフォルト → テナント固有の順に上書き
+    for row_id, char_type, coefficient, row_tenant_id in sorted(rows, key=lambda r: r[3] is not None):
+        by_class[char_type] = float(coefficient)
+        by_id[row_id] = (char_type, float(coefficient))
+
+    coefficients = {'by_class': by_class, 'by_id': by_id}
+    with _cache_lock:
+        _cache[tenant_id] = (now, coefficients)
+    return coefficients
+
+
+def invalidate_coefficients(tenant_id=None):
+    """係数マスタ更新時にキャッシュを破棄（tenant_id=None で全テナント）"""
+    with _cache_lock:
+        if tenant_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(tenant_id, None)
+
+
+def estimate_perimeter(text, height, coefficients):
+    """
+    文字内容と文字高さから推定周長を求める
+
+    Args:
+        text: 文字内容
+        height: 文字高さ（mm）
+        coefficients: load_coefficients の戻り値
+
+    Returns:
+        dict: {'perimeter', 'character_count', 'breakdown': [{'character_type', 'count', 'coefficient', 'perimeter'}]}
+    """
+    by_class = coefficients['by_class']
+    counts = {}
+    for ch in text or '':
+        cls = classify_char(ch)
+        if cls is not None:
+            counts[cls] = counts.get(cls, 0) + 1
+
+    breakdown = []
+    total = 0.0
+    for cls in CLASSES:
+        count = counts.get(cls)
+        if not count:
+            continue
+        coefficient = by_class.get(cls, DEFAULT_COEFFICIENTS[cls])
+        perimeter = float(height) * count * coefficient
+        total += perimeter
+        breakdown.append({
+            'character_type': cls,
+            'count': count,
+            'coefficient': coefficient,
+            'perimeter': perimeter,
+        })
+
+    return {
+        'perimeter': total,
+        'character_count': sum(counts.values()),
+        'breakdown': breakdown,
+    }
+
+
+def estimate_text(text, height, coefficients, font=None):
+    """
+    フォント計測インデックスがあればグリフの実測値、無い文字は係数で推定する
+
+    Args:
+        text: 文字内容
+        height: 文字高さ（mm）
+        coefficients: load_coefficients の戻り値
+        font: フォント計測インデックス名（None で既定のフォント、空文字でフォントを使わない）
+
+    Returns:
+        dict: estimate_perimeter の戻り値に 'width'（全文字のグリフがある場合のみ）と
+              'source'（'font' / 'coefficient' / 'mixed'）を加えたもの
+    """
+    index = font_metrics.get_index(font) if font != '' else None
+    if index is None:
+        result = estimate_perimeter(text, height, coefficients)
+        result.update({'width': None, 'source': 'coefficient'})
+        return result
+
+    measured = index.measure(text, height)
+    missing = measured['missing']
+    result = estimate_perimeter(''.join(missing), height, coefficients)
+    result['perimeter'] += measured['perimeter']
+    result['character_count'] = sum(1 for ch in text or '' if not ch.isspace())
+    result['width'] = None if missing else measured['width']
+    result['source'] = 'mixed' if missing and measured['perimeter'] else ('coefficient' if missing else 'font')
+    return result
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+設計図の分割・再開可能アップロード
+
+大きなPDFを1回のリクエストで送ると、回線の遅い現場ではタイムアウトして最初から
+やり直しになるので、ブラウザから CHUNK_SIZE ずつ送ってディスクに書き溜めます。
+
+    1. init      : ファイル名とサイズを登録して upload_id とチャンクサイズを返す
+    2. append    : チャンク番号ごとに本文を送る（X-Chunk-SHA256 ヘッダーに SHA-256）
+                   受け取り済みのチャンクは status で分かるので、切断後は残りだけ送ればよい
+    3. complete  : 全チャンクが揃ったら全体の SHA-256 を計算して確定する
+                   （ブラウザが計算した全体の SHA-256 を送れば一致するか確かめる）
+
+確定したファイルは auto_estimate.new / analyze_image に upload_ids で渡すと、
+ディスクから読みながら保存先（app/utils/storage.py）に送り、PDFの解析もファイルの
+パスのまま行います（メモリに全体を読み込まない）。
+
+チャンクはいったん chunks/ の一時ファイルに受け取り、長さとチェックサムが合ってから
+UPLOAD_SPOOL_DIR/<upload_id>/data の該当位置に写して chunks/<番号> を作ります。
+同じ upload_id のチャンクを並行して送っても競合せず、壊れた再送で受け取り済みの
+チャンクが上書きされることもありません。
+複数の dyno / ノードで動かす場合は、同じノードにリクエストが届くようにする
+（Heroku の http-session-affinity）か、UPLOAD_SPOOL_DIR を共有ディスクにしてください。
+UPLOAD_SESSION_TTL_HOURS 以上更新の無いアップロードは init のたびに削除します。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR') or os.path.join(tempfile.gettempdir(), 'signboard-uploads')
+# 1チャンクのバイト数（ブラウザは init の応答の値を使う）
+CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+# 1ファイルの上限
+MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(500 * 1024 * 1024)))
+# 更新が無くなってから削除するまでの時間
+SESSION_TTL_HOURS = float(os.getenv('UPLOAD_SESSION_TTL_HOURS', '24'))
+
+_UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+_COPY_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """アップロードの要求の誤り（status は HTTP ステータス）"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _path(upload_id, *parts):
+    if not _UPLOAD_ID_RE.match(upload_id or ''):
+        raise UploadError('アップロードIDが正しくありません', 404)
+    return os.path.join(SPOOL_DIR, upload_id, *parts)
+
+
+def _write_meta(upload_id, meta):
+    path = _path(upload_id, 'meta.json')
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _chunk_length(meta, index):
+    return min(meta['chunk_size'], meta['size'] - index * meta['chunk_size'])
+
+
+def init(tenant_id, filename, size, allowed_extensions):
+    """
+    アップロードを開始する
+
+    Args:
+        filename: secure_filename 済みのファイル名
+        size: ファイル全体のバイト数
+        allowed_extensions: 受け付ける拡張子
+
+    Returns:
+        dict: meta（upload_id, filename, file_ext, size, chunk_size, chunks, ...）
+    """
+    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
+        raise UploadError('対応していないファイル形式です')
+    if size <= 0:
+        raise UploadError('ファイルが空です')
+    if size > MAX_BYTES:
+        raise UploadError(f'ファイルが大きすぎます（上限 {MAX_BYTES // (1024 * 1024)} MB）', 413)
+
+    sweep()
+    upload_id = secrets.token_hex(16)
+    os.makedirs(_path(upload_id, 'chunks'))
+    # 書き込む位置が決まっているので、先に全体の大きさのファイルを作る
+    with open(_path(upload_id, 'data'), 'wb') as f:
+        f.truncate(size)
+    meta = {
+        'upload_id': upload_id,
+        'tenant_id': tenant_id,
+        'filename': filename,
+        'file_ext': filename.rsplit('.', 1)[1].lower(),
+        'size': size,
+        'chunk_size': CHUNK_SIZE,
+        'chunks': (size + CHUNK_SIZE - 1) // CHUNK_SIZE,
+        'sha256': None,
+    }
+    _write_meta(upload_id, meta)
+    return meta
+
+
+def load(upload_id, tenant_id):
+    """
+    アップロードの情報（他のテナントのものは見つからない扱い）
+
+    Raises:
+        UploadError: 見つからない場合（404）
+    """
+    try:
+        with open(_path(upload_id, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        raise UploadError('アップロードが見つかりません（期限切れの可能性があります）', 404)
+    if meta['tenant_id'] != tenant_id:
+        raise UploadError('アップロードが見つかりません（期限切れの可能性があります）', 404)
+    return meta
+
+
+def received(upload_id):
+    """受け取り済みのチャンク番号（昇順）"""
+    return sorted(int(name) for name in os.listdir(_path(upload_id, 'chunks')) if name.isdigit())
+
+
+def status(upload_id, tenant_id):
+    """
+    再開用の状態
+
+    Returns:
+        dict: {'upload_id', 'size', 'chunk_size', 'chunks', 'received', 'complete'}
+    """
+    meta = load(upload_id, tenant_id)
+    return {
+        'upload_id': upload_id,
+        'size': meta['size'],
+        'chunk_size': meta['chunk_size'],
+        'chunks': meta['chunks'],
+        'received': received(upload_id),
+        'complete': meta['sha256'] is not None,
+    }
+
+
+def append(upload_id, tenant_id, index, stream, checksum):
+    """
+    チャンクを受け取って所定の位置に書く（同じチャンクの再送は上書き）
+
+    Args:
+        index: チャンク番号（0始まり）
+        stream: 本文を読めるもの（request.stream）
+        checksum: チャンクの SHA-256（16進）
+
+    Raises:
+        UploadError: 番号・長さ・チェックサムが合わない場合
+    """
+    meta = load(upload_id, tenant_id)
+    if meta['sha256'] is not None:
+        raise UploadError('アップロードは確定済みです', 409)
+    if not 0 <= index < meta['chunks']:
+        raise UploadError('チャンク番号が範囲外です')
+    checksum = (checksum or '').lower()
+    if not _SHA256_RE.match(checksum):
+        raise UploadError('X-Chunk-SHA256 ヘッダーにチャンクの SHA-256 を指定してください')
+
+    expected = _chunk_length(meta, index)
+    digest = hashlib.sha256()
+    written = 0
+    # 検証が済むまでは data に書かない（失敗した再送で受け取り済みのチャンクを壊さない）
+    with tempfile.NamedTemporaryFile(dir=_path(upload_id, 'chunks'), prefix=f"{index}.", suffix='.tmp') as tmp:
+        while written <= expected:
+            # 長すぎる本文を検出できるよう1バイト多く読む
+            data = stream.read(min(_COPY_SIZE, expected - written + 1))
+            if not data:
+                break
+            if written + len(data) > expected:
+                raise UploadError('チャンクの長さが正しくありません')
+            tmp.write(data)
+            digest.update(data)
+            written += len(data)
+        if written != expected:
+            raise UploadError('チャンクの長さが正しくありません（途中で切断された可能性があります）')
+        if digest.hexdigest() != checksum:
+            raise UploadError('チャンクのチェックサムが一致しません', 422)
+
+        # 写している間に切断されても受け取り済みに見えないよう、先に印を外す
+        marker = _path(upload_id, 'chunks', str(index))
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+        tmp.seek(0)
+        with open(_path(upload_id, 'data'), 'r+b') as f:
+            f.seek(index * meta['chunk_size'])
+            shutil.copyfileobj(tmp, f, _COPY_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+    with open(marker, 'w') as f:
+        f.write(checksum)
+
+
+def _clear_chunks(upload_id):
+    """受け取り済みの印をすべて外す（最初から送り直してもらう）"""
+    for index in received(upload_id):
+        try:
+            os.remove(_path(upload_id, 'chunks', str(index)))
+        except FileNotFoundError:
+            pass
+
+
+def complete(upload_id, tenant_id, sha256=None):
+    """
+    全チャンクが揃っていれば全体の SHA-256 を計算して確定する（確定済みならそのまま返す）
+
+    Args:
+        sha256: ブラウザが計算したファイル全体の SHA-256（16進、省略可）。一致しなければ確定せず、
+                受け取り済みのチャンクを破棄する（別のファイルのチャンクが混ざった場合など）
+
+    Returns:
+        dict: meta（sha256 入り）
+
+    Raises:
+        UploadError: 足りないチャンクがある場合、sha256 が一致しない場合（どちらも 409）
+    """
+    if sha256 is not None:
+        sha256 = str(sha256).lower()
+        if not _SHA256_RE.match(sha256):
+            raise UploadError('ファイル全体の SHA-256 が正しくありません')
+    meta = load(upload_id, tenant_id)
+    if meta['sha256'] is not None:
+        if sha256 is not None and sha256 != meta['sha256']:
+            raise UploadError('ファイル全体のチェックサムが一致しません', 409)
+        return meta
+    missing = sorted(set(range(meta['chunks'])) - set(received(upload_id)))
+    if missing:
+        raise UploadError(f"受け取っていないチャンクがあります: {missing[:10]}", 409)
+
+    digest = hashlib.sha256()
+    with open(_path(upload_id, 'data'), 'rb') as f:
+        for chunk in iter(lambda: f.read(_COPY_SIZE), b''):
+            digest.update(chunk)
+    if sha256 is not None and digest.hexdigest() != sha256:
+        _clear_chunks(upload_id)
+        logger.warning(f"分割アップロードのチェックサムが一致しません: {upload_id}")
+        raise UploadError('ファイル全体のチェックサムが一致しません。最初からアップロードし直してください', 409)
+    meta['sha256'] = digest.hexdigest()
+    _write_meta(upload_id, meta)
+    return meta
+
+
+def claim(upload_id, tenant_id):
+    """
+    確定したアップロードのファイルを使う
+
+    Returns:
+        tuple: (meta, ファイルのパス)
+
+    Raises:
+        UploadError: 確定していない場合（409）
+    """
+    meta = load(upload_id, tenant_id)
+    if meta['sha256'] is None:
+        raise UploadError('アップロードが完了していません', 409)
+    return meta, _path(upload_id, 'data')
+
+
+def discard(upload_id):
+    """アップロードのファイルを削除する（保存先に保存した後）"""
+    shutil.rmtree(_path(upload_id), ignore_errors=True)
+
+
+def sweep(ttl_hours=None):
+    """
+    ttl_hours 以上更新の無いアップロードを削除する
+
+    Returns:
+        int: 削除した件数
+    """
+    ttl_hours = SESSION_TTL_HOURS if ttl_hours is None else ttl_hours
+    cutoff = time.time() - ttl_hours * 3600
+    removed = 0
+    try:
+        names = os.listdir(SPOOL_DIR)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if not _UPLOAD_ID_RE.match(name):
+            continue
+        try:
+            # チャンクを受け取るたびに chunks の更新日時が変わる
+            updated = max(os.path.getmtime(_path(name, 'meta.json')), os.path.getmtime(_path(name, 'chunks')))
+        except OSError:
+            # 作成中・壊れたものはディレクトリの更新日時で判定する
+            try:
+                updated = os.path.getmtime(_path(name))
+            except OSError:
+                continue
+        if updated < cutoff:
+            discard(name)
+            removed += 1
+    if removed:
+        logger.info(f"期限切れのアップロードを削除しました: {removed}件")
+    return removed
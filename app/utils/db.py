@@ -3,17 +3,132 @@
 データベース接続
 """
 
+import logging
 import os
 import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, List
 from urllib.parse import urlparse
 
 # ---- psycopg2 の有無 ----
 try:
     import psycopg2
+    import psycopg2.extensions
 except Exception:
     psycopg2 = None
 
 
+logger = logging.getLogger(__name__)
+
+# 接続ごとに出る大量ログの出力割合
+LOG_SAMPLE_RATE = float(os.getenv("DB_LOG_SAMPLE_RATE", "0.01"))
+
+
+# ===========================
+# クエリ計測フック
+# ===========================
+@dataclass
+class QueryEvent:
+    """実行済みSQL 1件分の情報（リスナーへ渡される）"""
+    statement: str
+    params: Any
+    duration: float          # 秒
+    source: str              # 'db'（get_db） / 'sqlalchemy'
+    connection: Any = None   # DB-API 接続（EXPLAIN 等の追加クエリ用）
+
+
+_query_listeners: List[Callable[[QueryEvent], None]] = []
+
+
+def add_query_listener(listener: Callable[[QueryEvent], None]) -> None:
+    """SQL 実行ごとに呼ばれるリスナーを登録（重複登録は無視）"""
+    if listener not in _query_listeners:
+        _query_listeners.append(listener)
+
+
+def remove_query_listener(listener: Callable[[QueryEvent], None]) -> None:
+    """リスナーの登録を解除"""
+    if listener in _query_listeners:
+        _query_listeners.remove(listener)
+
+
+def _notify_query(event: QueryEvent) -> None:
+    """登録済みリスナーへ通知（リスナーの例外は本処理に影響させない）"""
+    for listener in list(_query_listeners):
+        try:
+            listener(event)
+        except Exception:
+            pass
+
+
+if psycopg2:
+    class _InstrumentedPgCursor(psycopg2.extensions.cursor):
+        """実行時間を計測して通知する psycopg2 カーソル"""
+
+        def execute(self, query, vars=None):
+            start = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                _notify_query(QueryEvent(query, vars, time.perf_counter() - start, 'db', self.connection))
+
+        def executemany(self, query, vars_list):
+            start = time.perf_counter()
+            try:
+                return super().executemany(query, vars_list)
+            finally:
+                _notify_query(QueryEvent(query, None, time.perf_counter() - start, 'db', self.connection))
+
+
+class _InstrumentedSqliteCursor(sqlite3.Cursor):
+    """実行時間を計測して通知する SQLite カーソル"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _notify_query(QueryEvent(sql, parameters, time.perf_counter() - start, 'db', self.connection))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _notify_query(QueryEvent(sql, None, time.perf_counter() - start, 'db', self.connection))
+
+
+class _InstrumentedSqliteConnection(sqlite3.Connection):
+    """cursor() が計測付きカーソルを返す SQLite 接続"""
+
+    def cursor(self, factory=_InstrumentedSqliteCursor):
+        return super().cursor(factory)
+
+
+def instrument_engine(engine) -> None:
+    """SQLAlchemy エンジンの SQL 実行を同じリスナーへ流す"""
+    from sqlalchemy import event
+
+    if getattr(engine, '_query_hooks_installed', False):
+        return
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('query_start_time')
+        if not starts:
+            return
+        duration = time.perf_counter() - starts.pop()
+        _notify_query(QueryEvent(statement, parameters, duration, 'sqlalchemy', conn.connection.dbapi_connection))
+
+    engine._query_hooks_installed = True
+
+
 def _is_pg(conn) -> bool:
     """PostgreSQL/SQLite 判定"""
     return conn.__class__.__module__.startswith("psycopg2")
@@ -24,6 +139,26 @@ def _sql(conn, text: str) -> str:
     return text if _is_pg(conn) else text.replace("%s", "?")
 
 
+@contextmanager
+def manual_commit(conn):
+    """
+    autocommit を切り、ブロック内を呼び出し側の commit / rollback までの1つのトランザクションにする
+
+    get_db の PostgreSQL 接続は autocommit なので、FOR UPDATE のロック・アドバイザリロック
+    （pg_advisory_xact_lock）や rollback に頼る処理はこの中で実行します。
+    ブロックを抜けるときに未コミットの変更は破棄し、autocommit を元に戻します。
+    """
+    if not _is_pg(conn) or not conn.autocommit:
+        yield conn
+        return
+    conn.autocommit = False
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        conn.autocommit = True
+
+
 def get_db_connection():
     """
     データベース接続を返す（get_dbのエイリアス）
@@ -57,17 +192,20 @@ def get_db():
                 host=url.hostname,
                 port=url.port,
                 sslmode=sslmode,
-                application_name="login_system"
+                application_name="login_system",
+                cursor_factory=_InstrumentedPgCursor
             )
             conn.autocommit = True
-            print(f"✅ PostgreSQL 接続成功: {url.hostname}:{url.port}/{url.path[1:]}")
+            logger.debug(f"PostgreSQL 接続成功: {url.hostname}:{url.port}/{url.path[1:]}",
+                         extra={"sample_rate": LOG_SAMPLE_RATE})
             return conn
         except Exception as e:
-            print(f"⚠️ PostgreSQL接続失敗 → SQLiteへフォールバック: {e}")
+            logger.warning(f"PostgreSQL接続失敗 → SQLiteへフォールバック: {e}")
 
     # --- SQLite フォールバック ---
     os.makedirs("database", exist_ok=True)
-    conn = sqlite3.connect("database/login_auth.db", detect_types=sqlite3.PARSE_DECLTYPES)
+    conn = sqlite3.connect("database/login_auth.db", detect_types=sqlite3.PARSE_DECLTYPES,
+                           factory=_InstrumentedSqliteConnection)
     conn.row_factory = sqlite3.Row
-    print("⚠️ SQLite にフォールバック: database/login_auth.db")
+    logger.debug("SQLite にフォールバック: database/login_auth.db", extra={"sample_rate": LOG_SAMPLE_RATE})
     return conn
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+設計図のサムネイル・プレビュー（派生画像）のキャッシュ
+
+一覧や解析画面で設計図を表示するために、元の写真やPDFをそのまま読み込ませず、
+縮小したJPEG（PDFは1ページ目）を返します。
+
+- 派生画像は (content_hash, サイズ) ごとに1回だけ作り、保存先（app/utils/storage.py）に
+  保存して T_設計図派生 に登録する（migrations/010）
+- 内容が同じなら同じ派生画像なので、URL（/auto_estimate/derivative/<ハッシュ>/<サイズ>.jpg）は
+  変わらず、ブラウザに immutable でキャッシュさせられる
+- アップロード直後に schedule でバックグラウンドで作っておき、まだ無ければ要求時に作る
+
+参照されなくなった実体の派生画像は blob_store.collect_garbage が一緒に削除します。
+"""
+
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.utils import storage
+from app.utils.metrics import inc_counter
+
+try:
+    from PIL import Image, ImageOps
+except Exception:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# サイズ名=長辺のピクセル数
+SIZES = {
+    name.strip(): int(edge)
+    for name, _, edge in (part.partition('=') for part in os.getenv('DERIVATIVE_SIZES', 'thumb=400,preview=1200').split(','))
+}
+QUALITY = int(os.getenv('DERIVATIVE_QUALITY', '80'))
+# アップロード直後に作っておくか（0 で要求時だけ作る）
+PRECOMPUTE = os.getenv('DERIVATIVE_PRECOMPUTE', '1') == '1'
+# バックグラウンドで作るスレッド数（ワーカーごと）
+WORKERS = int(os.getenv('DERIVATIVE_WORKERS', '1'))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# 同じ派生画像を同時に作らないためのロック（(ハッシュ, サイズ) ごと）
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def render(content, file_ext, edge):
+    """
+    縮小したJPEGを作る
+
+    Args:
+        content: 元ファイルのバイト列
+        file_ext: 元の拡張子（pdf は1ページ目）
+        edge: 長辺のピクセル数
+
+    Returns:
+        bytes: JPEG
+    """
+    if Image is None:
+        raise RuntimeError("Pillow がインストールされていません")
+    if file_ext == 'pdf':
+        from pdf2image import convert_from_bytes
+        # 表示サイズで直接レンダリングする（高解像度で変換してから縮小しない）
+        image = convert_from_bytes(content, size=edge, first_page=1, last_page=1)[0]
+    else:
+        image = Image.open(io.BytesIO(content))
+        # JPEG は縮小しながら読み込む（大きな写真を全画素デコードしない）
+        image.draft('RGB', (edge, edge))
+        image = ImageOps.exif_transpose(image)
+
+    if image.mode not in ('RGB', 'L'):
+        # 透過部分は白で塗りつぶす（設計図の背景は白）
+        background = Image.new('RGB', image.size, 'white')
+        rgba = image.convert('RGBA')
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        image = background
+    image.thumbnail((edge, edge), Image.LANCZOS)
+
+    buffered = io.BytesIO()
+    image.save(buffered, format='JPEG', quality=QUALITY, optimize=True, progressive=True)
+    return buffered.getvalue()
+
+
+def _lookup(cur, digest, size):
+    cur.execute('''
+        SELECT "ファイルパス" FROM "T_設計図派生"
+        WHERE "content_hash" = %s AND "サイズ" = %s
+    ''', (digest, size))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _lock_for(digest, size):
+    with _locks_lock:
+        return _locks.setdefault((digest, size), threading.Lock())
+
+
+def get(digest, size, source, file_ext, content=None):
+    """
+    派生画像を返す（無ければ作ってキャッシュする）
+
+    Args:
+        digest: 元ファイルの content_hash
+        size: サイズ名（SIZES のキー）
+        source: 元ファイルのファイルパス
+        file_ext: 元の拡張子
+        content: 元ファイルのバイト列（読み込み済みなら）
+
+    Returns:
+        bytes: JPEG
+    """
+    from app.utils.db import get_db_connection
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        location = _lookup(cur, digest, size)
+        if location:
+            inc_counter('derivative_requests_total', result='hit')
+            return storage.read(location)
+
+        with _lock_for(digest, size):
+            # 待っている間に他のスレッドが作った場合
+            location = _lookup(cur, digest, size)
+            if location:
+                inc_counter('derivative_requests_total', result='hit')
+                return storage.read(location)
+
+            inc_counter('derivative_requests_total', result='miss')
+            if content is None:
+                content = storage.read(source)
+            data = render(content, file_ext, SIZES[size])
+            _, location = storage.put(f"derivatives/{digest}_{size}.jpg", io.BytesIO(data), 'jpg')
+            cur.execute('''
+                INSERT INTO "T_設計図派生" ("content_hash", "サイズ", "ファイルパス", "バイト数")
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT ("content_hash", "サイズ") DO NOTHING
+            ''', (digest, size, location, len(data)))
+            conn.commit()
+            return data
+    finally:
+        with _locks_lock:
+            lock = _locks.get((digest, size))
+            if lock is not None and not lock.locked():
+                _locks.pop((digest, size), None)
+        cur.close()
+        conn.close()
+
+
+def precompute(digest, source, file_ext):
+    """まだ無いサイズの派生画像を作る（元ファイルは1回だけ読む）"""
+    from app.utils.db import get_db_connection
+
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT "サイズ" FROM "T_設計図派生" WHERE "content_hash" = %s', (digest,))
+            existing = {row[0] for row in cur.fetchall()}
+        finally:
+            cur.close()
+            conn.close()
+        missing = [size for size in SIZES if size not in existing]
+        if not missing:
+            return
+        content = storage.read(source)
+        for size in missing:
+            get(digest, size, source, file_ext, content)
+    except Exception as e:
+        # 表示時に作り直すので、ここでの失敗は記録だけ
+        logger.warning(f"派生画像を作れませんでした: {digest[:12]} {e}")
+
+
+def schedule(digest, source, file_ext):
+    """アップロード直後に派生画像をバックグラウンドで作る"""
+    global _executor, _executor_pid
+    if not PRECOMPUTE or Image is None:
+        return
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='derivatives')
+                _executor_pid = os.getpid()
+    _executor.submit(precompute, digest, source, file_ext)
+
+
+def sweep(cur, grace_hours, digests=None):
+    """
+    実体が無くなった派生画像の行を削除する（保存先のファイルは呼び出し側で削除）
+
+    アップロード中（実体の登録がまだコミットされていない）の派生画像を消さないよう、
+    grace_hours より前に作ったものだけを対象にします。digests（同じトランザクションで
+    削除した実体）の派生画像は経過時間に関係なく対象にします。
+
+    Returns:
+        list: 削除した行の (content_hash, ファイルパス, バイト数)
+    """
+    cur.execute('''
+        DELETE FROM "T_設計図派生" d
+        WHERE NOT EXISTS (SELECT 1 FROM "T_設計図ブロブ" b WHERE b."content_hash" = d."content_hash")
+          AND (d."作成日時" < CURRENT_TIMESTAMP - make_interval(secs => %s) OR d."content_hash" = ANY(%s))
+        RETURNING "content_hash", "ファイルパス", "バイト数"
+    ''', (grace_hours * 3600, list(digests or [])))
+    return cur.fetchall()
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+設計図からの明細抽出（OpenAI の構造化出力）
+
+画像・PDFテキストの解析で共通のプロンプトと JSON Schema を使い、
+応答を検証して数値を正規化します（"1,800" → 1800、"1.8m" → 1800 など）。
+応答が壊れていた場合や一時的なエラーの場合は、そのページだけを
+EXTRACTION_MAX_ATTEMPTS 回まで再試行します。1リクエスト全体の再試行回数は
+RetryBudget で上限を設けます。
+
+プロンプトは名前とバージョンで登録し（register_prompt）、結果には
+使ったプロンプトの "名前/バージョン" を記録します。
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from app.utils.metrics import track_external_call
+
+logger = logging.getLogger(__name__)
+
+MODEL = os.getenv('EXTRACTION_MODEL', 'gpt-4.1-mini')
+MAX_TOKENS = int(os.getenv('EXTRACTION_MAX_TOKENS', '1000'))
+# 応答が途中で切れた場合に再試行で増やす max_tokens の上限
+MAX_TOKENS_LIMIT = int(os.getenv('EXTRACTION_MAX_TOKENS_LIMIT', '4000'))
+# 1ページあたりの試行回数（初回を含む）
+MAX_ATTEMPTS = int(os.getenv('EXTRACTION_MAX_ATTEMPTS', '3'))
+# 1リクエスト（複数ページ）全体での再試行回数の上限
+RETRY_BUDGET = int(os.getenv('EXTRACTION_RETRY_BUDGET', '5'))
+RETRY_BACKOFF = float(os.getenv('EXTRACTION_RETRY_BACKOFF', '0.5'))
+# 0 にすると response_format（構造化出力）を使わずに応答から JSON を取り出す
+STRUCTURED_OUTPUT = os.getenv('EXTRACTION_STRUCTURED_OUTPUT', '1') != '0'
+# 画像・テキストに使うプロンプトのバージョン（未指定は最新）
+PROMPT_VERSIONS = {
+    'blueprint_image': os.getenv('EXTRACTION_PROMPT_IMAGE_VERSION'),
+    'blueprint_text': os.getenv('EXTRACTION_PROMPT_TEXT_VERSION'),
+}
+
+# 再試行しても結果が変わらないエラー（リクエスト不正・認証）
+_NON_RETRYABLE_STATUS = (400, 401, 403, 404, 422)
+_TEXT_LIMIT = 20000
+
+
+class ExtractionError(Exception):
+    """再試行しても明細を抽出できなかった"""
+
+
+# ===========================
+# JSON Schema
+# ===========================
+RESULT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'customer_name': {'type': ['string', 'null']},
+        'items': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'material_name': {'type': 'string'},
+                    # "1,800" や "1.8m" のような文字列も受け取り、validate で数値にする
+                    'width': {'anyOf': [{'type': 'number'}, {'type': 'string'}]},
+                    'height': {'anyOf': [{'type': 'number'}, {'type': 'string'}]},
+                    'quantity': {'anyOf': [{'type': 'integer'}, {'type': 'string'}]},
+                    'description': {'type': 'string'},
+                },
+                'required': ['material_name', 'width', 'height', 'quantity', 'description'],
+                'additionalProperties': False,
+            },
+        },
+    },
+    'required': ['customer_name', 'items'],
+    'additionalProperties': False,
+}
+
+_RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {'name': 'signboard_items', 'strict': True, 'schema': RESULT_SCHEMA},
+}
+
+
+# ===========================
+# プロンプト
+# ===========================
+_PROMPTS = {}       # (名前, バージョン) -> テンプレート
+
+
+def register_prompt(name, version, template):
+    """プロンプトを登録する（テキスト用は {text} に本文が入る）"""
+    _PROMPTS[(name, version)] = template
+
+
+def prompt_versions(name):
+    """登録済みのバージョン一覧（古い順）"""
+    return sorted(v for n, v in _PROMPTS if n == name)
+
+
+def get_prompt(name, version=None):
+    """
+    Returns:
+        tuple: ("名前/バージョン", テンプレート)
+
+    Raises:
+        KeyError: 登録されていない場合
+    """
+    version = version or PROMPT_VERSIONS.get(name) or prompt_versions(name)[-1]
+    return f"{name}/{version}", _PROMPTS[(name, version)]
+
+
+_INSTRUCTIONS = """以下の情報をJSON形式で返してください：
+{
+  "customer_name": "顧客名（あれば）",
+  "items": [
+    {
+      "material_name": "材質名（アルミ、鉄骨、アクリルなど）",
+      "width": 幅（mm、数値のみ）,
+      "height": 高さ（mm、数値のみ）,
+      "quantity": 数量（数値のみ）,
+      "description": "備考（あれば）"
+    }
+  ]
+}
+
+- 複数の看板がある場合は、itemsに複数のオブジェクトを含めてください
+- 数値は単位を除いた数字のみを返してください
+- 材質が不明な場合は"不明"としてください
+- 寸法が読み取れない場合は0としてください"""
+
+register_prompt('blueprint_image', 'v1', "この設計図から看板の情報を抽出してください。\n\n" + _INSTRUCTIONS)
+register_prompt('blueprint_text', 'v1', (
+    "以下はCADから書き出した設計図PDFのテキストです（各行の先頭は [x,y] ページ上の位置）。\n"
+    "看板の情報を抽出してください。\n\n" + _INSTRUCTIONS.replace('{', '{{').replace('}', '}}') +
+    "\n\nテキスト:\n{text}"
+))
+
+
+# ===========================
+# 検証・正規化
+# ===========================
+_UNIT_SCALE = {'mm': 1.0, 'ミリ': 1.0, 'cm': 10.0, 'センチ': 10.0, 'm': 1000.0, 'メートル': 1000.0}
+_NUMBER_RE = re.compile(r'(\d+(?:\.\d+)?)\s*(mm|cm|m(?![a-z])|ミリ|センチ|メートル)?')
+_THOUSANDS_RE = re.compile(r'(?<=\d),(?=\d{3}(?!\d))')
+
+
+def to_mm(value):
+    """
+    寸法を mm の数値にする（"1,800" → 1800.0、"1.8m" → 1800.0、"W 900mm" → 900.0）
+
+    Returns:
+        float: mm、読み取れない場合は 0.0
+    """
+    if isinstance(value, bool) or value is None:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value) if value > 0 else 0.0
+    text = _THOUSANDS_RE.sub('', unicodedata.normalize('NFKC', str(value)).lower())
+    m = _NUMBER_RE.search(text)
+    if not m:
+        return 0.0
+    return float(m.group(1)) * _UNIT_SCALE.get(m.group(2), 1.0)
+
+
+def to_quantity(value):
+    """数量を1以上の整数にする（"2枚" → 2、読み取れない場合は 1）"""
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, float)):
+        return max(1, int(round(value)))
+    m = re.search(r'\d+', unicodedata.normalize('NFKC', str(value)).replace(',', ''))
+    return max(1, int(m.group(0))) if m else 1
+
+
+def parse_json(text):
+    """応答テキストから JSON を取り出す（```json ... ``` で囲まれている場合にも対応）"""
+    text = (text or '').strip()
+    if '```json' in text:
+        text = text.split('```json')[1].split('```')[0].strip()
+    elif '```' in text:
+        text = text.split('```')[1].split('```')[0].strip()
+    return json.loads(text)
+
+
+def validate(data):
+    """
+    応答を検証して正規化する
+
+    Returns:
+        dict: {'customer_name', 'items': [{'material_name', 'width', 'height', 'quantity', 'description'}]}
+
+    Raises:
+        ExtractionError: 構造が不正な場合
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('items', []), list):
+        raise ExtractionError("応答の形式が不正です")
+    items = []
+    for raw in data.get('items') or []:
+        if not isinstance(raw, dict):
+            raise ExtractionError("明細の形式が不正です")
+        items.append({
+            'material_name': str(raw.get('material_name') or raw.get('material') or '不明').strip() or '不明',
+            'width': to_mm(raw.get('width')),
+            'height': to_mm(raw.get('height')),
+            'quantity': to_quantity(raw.get('quantity')),
+            'description': str(raw.get('description') or raw.get('notes') or '').strip(),
+        })
+    customer_name = data.get('customer_name')
+    return {'customer_name': str(customer_name).strip() if customer_name else None, 'items': items}
+
+
+# ===========================
+# 抽出（再試行付き）
+# ===========================
+class RetryBudget:
+    """1リクエストで使える再試行回数（スレッド間で共有可）"""
+
+    def __init__(self, retries=RETRY_BUDGET):
+        self.remaining = retries
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+def _retryable(error):
+    if getattr(error, 'retryable', True) is False:
+        # テナントのレート制限など、呼び出し側が再試行しないよう指定したもの
+        return False
+    if isinstance(error, (ExtractionError, ValueError)):
+        return True
+    return getattr(error, 'status_code', None) not in _NON_RETRYABLE_STATUS
+
+
+def _complete(client, content, prompt_id, budget=None, model=None, max_tokens=None):
+    model = model or MODEL
+    max_tokens = max_tokens or MAX_TOKENS
+    usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            options = {'response_format': _RESPONSE_FORMAT} if STRUCTURED_OUTPUT else {}
+            with track_external_call('openai'):
+                response = client.chat.completions.create(
+                    model=model,
+                    messages=[{'role': 'user', 'content': content}],
+                    max_tokens=max_tokens,
+                    **options
+                )
+            # 再試行した分も含めて集計
+            for key in usage:
+                usage[key] += getattr(getattr(response, 'usage', None), key, 0) or 0
+            choice = response.choices[0]
+            if choice.finish_reason == 'length':
+                max_tokens = min(max_tokens * 2, MAX_TOKENS_LIMIT)
+                raise ExtractionError("応答が途中で切れました")
+            if getattr(choice.message, 'refusal', None):
+                raise ExtractionError(f"応答が拒否されました: {choice.message.refusal}")
+            result = validate(parse_json(choice.message.content))
+        except Exception as e:
+            if not _retryable(e) or attempt >= MAX_ATTEMPTS or (budget is not None and not budget.take()):
+                raise ExtractionError(f"{prompt_id} 抽出失敗（{attempt}回試行）: {e}") from e
+            logger.info(f"抽出を再試行します（{prompt_id} {attempt}回目）: {e}")
+            time.sleep(RETRY_BACKOFF * (2 ** (attempt - 1)))
+            continue
+        result['prompt'] = prompt_id
+        result['model'] = model
+        result['attempts'] = attempt
+        result['usage'] = usage
+        return result
+
+
+def extract_image(client, image_content, budget=None, version=None, model=None, max_tokens=None):
+    """
+    画像から明細を抽出する
+
+    Args:
+        image_content: image_url の値（{'url': ..., 'detail': ...}）
+        budget: RetryBudget（None で1ページ内の試行回数だけを制限）
+        version, model, max_tokens: プロンプトのバージョン・モデル・max_tokens（None で設定値）
+
+    Returns:
+        dict: validate の結果に 'prompt', 'model', 'attempts', 'usage'（トークン数）を加えたもの
+
+    Raises:
+        ExtractionError: 試行回数・再試行の予算を使い切った場合
+    """
+    prompt_id, template = get_prompt('blueprint_image', version)
+    content = [
+        {'type': 'text', 'text': template},
+        {'type': 'image_url', 'image_url': image_content},
+    ]
+    return _complete(client, content, prompt_id, budget, model, max_tokens)
+
+
+def extract_text(client, text, budget=None, version=None, model=None, max_tokens=None):
+    """PDFのテキスト層（位置付き）から明細を抽出する（引数・戻り値・例外は extract_image と同じ）"""
+    prompt_id, template = get_prompt('blueprint_text', version)
+    return _complete(client, template.format(text=text[:_TEXT_LIMIT]), prompt_id, budget, model, max_tokens)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+フォント計測インデックス（切り文字・チャンネル文字の周長と文字幅）
+
+TTF/OTF フォントから各グリフのアウトライン長と送り幅を 1em あたりの値で
+事前計算し、メモリマップ可能な小さなバイナリファイルに保存します。
+見積もり時は1文字あたり O(1) で引き、文字高さ（mm、1em とみなす）を掛けて
+周長・文字幅を求めます。
+
+インデックスの作成（fonttools が必要）:
+
+    python build_font_index.py instance/fonts/gothic.fmi NotoSansJP-Bold.otf [fallback.ttf ...]
+
+複数のフォントを指定した場合は先に指定したフォントのグリフが優先されます。
+
+ファイル形式（リトルエンディアン）:
+    ヘッダー      : magic "FMI1", version(u16), reserved(u16), page_count(u32)
+    ページ表      : 0x1100 × u16（コードポイント上位ビットのページ → ページ番号+1、0は無し）
+    ページ        : page_count × 256 × (送り幅 f32, 周長 f32)（グリフが無い文字は NaN）
+"""
+
+import glob
+import math
+import mmap
+import os
+import struct
+import threading
+
+try:
+    from fontTools.pens.perimeterPen import PerimeterPen
+    from fontTools.ttLib import TTFont
+except Exception:
+    TTFont = None
+    PerimeterPen = None
+
+MAGIC = b'FMI1'
+VERSION = 1
+_HEADER = struct.Struct('<4sHHI')
+_PAGE_SIZE = 256
+_PAGE_COUNT = 0x110000 // _PAGE_SIZE
+_DIRECTORY = struct.Struct(f'<{_PAGE_COUNT}H')
+_ENTRY = struct.Struct('<ff')
+
+# インデックスの置き場所（<名前>.fmi）と既定のフォント名
+FONT_INDEX_DIR = os.getenv('FONT_INDEX_DIR', os.path.join('instance', 'fonts'))
+DEFAULT_FONT = os.getenv('FONT_INDEX_DEFAULT', 'default')
+
+# 曲線を直線で近似するときの許容誤差（em 単位のアウトライン長に対する相対値）
+OUTLINE_TOLERANCE = 0.001
+
+
+# ===========================
+# インデックス作成
+# ===========================
+def measure_font(path):
+    """
+    フォント1つの {コードポイント: (送り幅, 周長)} を 1em あたりの値で返す
+    """
+    if TTFont is None:
+        raise RuntimeError("fonttools がインストールされていません")
+
+    font = TTFont(path, lazy=True)
+    try:
+        units_per_em = float(font['head'].unitsPerEm)
+        glyph_set = font.getGlyphSet()
+        hmtx = font['hmtx']
+        measured = {}
+        metrics = {}
+        for code, glyph_name in font.getBestCmap().items():
+            if glyph_name not in measured:
+                pen = PerimeterPen(glyph_set, tolerance=OUTLINE_TOLERANCE)
+                glyph_set[glyph_name].draw(pen)
+                measured[glyph_name] = (hmtx[glyph_name][0] / units_per_em, pen.value / units_per_em)
+            metrics[code] = measured[glyph_name]
+        return metrics
+    finally:
+        font.close()
+
+
+def build_index(output_path, font_paths):
+    """
+    フォントを計測してインデックスファイルを書き出す
+
+    Returns:
+        int: 登録した文字数
+    """
+    metrics = {}
+    # 後のフォントから順に上書きし、先に指定したフォントを優先
+    for path in reversed(list(font_paths)):
+        metrics.update(measure_font(path))
+
+    pages = sorted({code // _PAGE_SIZE for code in metrics})
+    directory = [0] * _PAGE_COUNT
+    for slot, page in enumerate(pages):
+        directory[page] = slot + 1
+
+    body = bytearray(len(pages) * _PAGE_SIZE * _ENTRY.size)
+    nan_entry = _ENTRY.pack(math.nan, math.nan)
+    body[:] = nan_entry * (len(pages) * _PAGE_SIZE)
+    for code, (advance, perimeter) in metrics.items():
+        slot = directory[code // _PAGE_SIZE] - 1
+        _ENTRY.pack_into(body, (slot * _PAGE_SIZE + code % _PAGE_SIZE) * _ENTRY.size, advance, perimeter)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, len(pages)))
+        f.write(_DIRECTORY.pack(*directory))
+        f.write(body)
+    os.replace(tmp_path, output_path)
+    return len(metrics)
+
+
+# ===========================
+# 参照
+# ===========================
+class FontMetricsIndex:
+    """メモリマップしたインデックス（読み取り専用、スレッド間で共有可）"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.page_count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"フォント計測インデックスの形式が不正です: {path}")
+        self._pages_offset = _HEADER.size + _DIRECTORY.size
+
+    def lookup(self, char):
+        """1文字の (送り幅, 周長)（1em あたり）、グリフが無ければ None"""
+        code = ord(char)
+        if code >= 0x110000:
+            return None
+        slot = struct.unpack_from('<H', self._map, _HEADER.size + (code // _PAGE_SIZE) * 2)[0]
+        if not slot:
+            return None
+        offset = self._pages_offset + ((slot - 1) * _PAGE_SIZE + code % _PAGE_SIZE) * _ENTRY.size
+        advance, perimeter = _ENTRY.unpack_from(self._map, offset)
+        if math.isnan(advance):
+            return None
+        return advance, perimeter
+
+    def measure(self, text, height):
+        """
+        文字列の文字幅と周長を求める
+
+        Args:
+            text: 文字内容
+            height: 文字高さ（mm、1em とみなす）
+
+        Returns:
+            dict: {'width', 'perimeter', 'missing': グリフが無かった文字の一覧}
+        """
+        height = float(height)
+        width = 0.0
+        perimeter = 0.0
+        missing = []
+        for ch in text or '':
+            metrics = self.lookup(ch)
+            if metrics is None:
+                if not ch.isspace():
+                    missing.append(ch)
+                continue
+            width += metrics[0] * height
+            perimeter += metrics[1] * height
+        return {'width': width, 'perimeter': perimeter, 'missing': missing}
+
+    def close(self):
+        self._map.close()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def available_fonts():
+    """FONT_INDEX_DIR にあるインデックス名の一覧"""
+    return sorted(os.path.splitext(os.path.basename(p))[0]
+                  for p in glob.glob(os.path.join(FONT_INDEX_DIR, '*.fmi')))
+
+
+def get_index(name=None):
+    """
+    名前でインデックスを開く（プロセス内で1回だけ mmap する）
+
+    Returns:
+        FontMetricsIndex: インデックス、ファイルが無ければ None
+    """
+    name = os.path.basename(name or DEFAULT_FONT)
+    index = _indexes.get(name)
+    if index is not None:
+        return index
+    path = os.path.join(FONT_INDEX_DIR, f"{name}.fmi")
+    if not os.path.exists(path):
+        return None
+    with _indexes_lock:
+        index = _indexes.get(name)
+        if index is None:
+            index = _indexes[name] = FontMetricsIndex(path)
+    return index
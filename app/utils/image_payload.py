@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+画像解析（OpenAI Vision）に送る画像の軽量化
+
+スマートフォンの写真やPDFから変換したPNGをそのまま base64 で送ると、
+数MBの画像が 1.33 倍になって送信されます。送信前に
+EXIF の向きを反映 → 長辺を IMAGE_MAX_EDGE まで縮小 → ほぼ白黒ならグレースケール化
+→ JPEG/WebP（線画なら PNG と比べて小さい方）で再エンコードし、
+512px で見て細部が失われるかどうかで detail (low/high) を選びます。
+"""
+
+import base64
+import io
+import logging
+import os
+
+try:
+    from PIL import Image, ImageOps
+except Exception:
+    Image = None
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# 長辺の最大ピクセル数（OpenAI は high でも 2048px に収めてから処理する）
+MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', '2048'))
+# 再エンコード形式（jpeg / webp）と品質
+OUTPUT_FORMAT = os.getenv('IMAGE_FORMAT', 'jpeg').lower()
+QUALITY = int(os.getenv('IMAGE_QUALITY', '85'))
+# 512px で見て失われる細部の割合がこれ未満なら detail=low（細かい文字や線がほとんど無い画像）
+LOW_DETAIL_LOSS = float(os.getenv('IMAGE_LOW_DETAIL_LOSS', '0.005'))
+# detail=low で処理される解像度（これ以下の画像は常に low）
+LOW_DETAIL_EDGE = 512
+
+_MIME = {'jpeg': 'image/jpeg', 'jpg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp', 'gif': 'image/gif'}
+
+
+def _is_grayscale(image):
+    """RGBの各チャンネルの差がほとんど無いか（縮小画像で判定）"""
+    if image.mode in ('L', '1'):
+        return True
+    if np is None:
+        return False
+    sample = np.asarray(image.convert('RGB').resize((64, 64)), dtype=np.int16)
+    spread = sample.max(axis=2) - sample.min(axis=2)
+    return float(spread.mean()) < 8
+
+
+def detail_loss(image):
+    """
+    detail=low（512px）で見たときに失われる細部の割合
+
+    1024px に揃えた画像と、512px に縮小してから戻した画像で
+    輝度が大きく変わる画素の割合を返します。寸法線や小さな文字が多いほど大きくなります。
+    """
+    if np is None:
+        return 1.0
+    gray = image.convert('L')
+    gray.thumbnail((1024, 1024), Image.BOX)
+    scale = LOW_DETAIL_EDGE / max(gray.size)
+    if scale >= 1:
+        return 0.0
+    small = gray.resize((max(1, round(gray.width * scale)), max(1, round(gray.height * scale))), Image.BOX)
+    restored = small.resize(gray.size, Image.BILINEAR)
+    diff = np.abs(np.asarray(gray, dtype=np.int16) - np.asarray(restored, dtype=np.int16))
+    return float((diff > 48).mean())
+
+
+def _encode(image, fmt, **options):
+    buffered = io.BytesIO()
+    image.save(buffered, format=fmt, optimize=True, **options)
+    return buffered.getvalue()
+
+
+def optimize(source, file_ext=None, max_edge=None):
+    """
+    画像を軽量化して data URL と detail を返す
+
+    Args:
+        source: 画像のバイト列、または PIL.Image
+        file_ext: 元の拡張子（Pillow が無い場合の MIME 判定用）
+        max_edge: 長辺の最大ピクセル数（None で IMAGE_MAX_EDGE）
+
+    Returns:
+        dict: {'url': data URL, 'detail': 'low'|'high', 'original_bytes'（PIL.Image のときは None）,
+               'optimized_bytes', 'width', 'height'}
+    """
+    if Image is None:
+        if not isinstance(source, (bytes, bytearray)):
+            raise RuntimeError("Pillow がインストールされていません")
+        mime = _MIME.get((file_ext or 'jpeg').lower(), 'image/jpeg')
+        encoded = base64.b64encode(source).decode('utf-8')
+        return {
+            'url': f"data:{mime};base64,{encoded}",
+            'detail': 'high',
+            'original_bytes': len(source),
+            'optimized_bytes': len(source),
+            'width': None,
+            'height': None,
+        }
+
+    original_format = None
+    if isinstance(source, (bytes, bytearray)):
+        original_bytes = len(source)
+        image = Image.open(io.BytesIO(source))
+        original_format = image.format
+        rotated = image.getexif().get(0x0112, 1) != 1
+        if rotated:
+            image = ImageOps.exif_transpose(image)
+    else:
+        image = source
+        original_bytes = None
+        rotated = False
+    max_edge = max_edge or MAX_EDGE
+    resized = max(image.size) > max_edge
+
+    if image.mode not in ('RGB', 'L'):
+        # 透過部分は白で塗りつぶす（設計図の背景は白）
+        background = Image.new('RGB', image.size, 'white')
+        rgba = image.convert('RGBA')
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        image = background
+
+    if resized:
+        image = image.copy()
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    grayscale = image.mode == 'L' or _is_grayscale(image)
+    if grayscale and image.mode != 'L':
+        image = image.convert('L')
+
+    fmt = 'WEBP' if OUTPUT_FORMAT == 'webp' else 'JPEG'
+    candidates = [(fmt, _encode(image, fmt, quality=QUALITY))]
+    if grayscale:
+        # 線画は PNG のほうが小さく、文字もにじまないことが多い
+        candidates.append(('PNG', _encode(image, 'PNG')))
+    fmt, optimized = min(candidates, key=lambda c: len(c[1]))
+
+    # 縮小も回転も不要で元ファイルのほうが小さければ元のまま送る
+    if (not resized and not rotated and original_bytes is not None and original_bytes <= len(optimized)
+            and original_format in ('JPEG', 'PNG', 'WEBP')):
+        fmt, optimized = original_format, bytes(source)
+
+    if max(image.size) <= LOW_DETAIL_EDGE:
+        detail = 'low'
+    else:
+        detail = 'low' if detail_loss(image) < LOW_DETAIL_LOSS else 'high'
+
+    encoded = base64.b64encode(optimized).decode('utf-8')
+    if original_bytes:
+        saved = f"{original_bytes:,} → {len(optimized):,} bytes（{(1 - len(optimized) / original_bytes) * 100:.0f}%削減）"
+    else:
+        # PDFから変換したページは元のバイト列が無い
+        saved = f"{len(optimized):,} bytes"
+    logger.info(f"画像軽量化: {saved} {fmt} {image.size[0]}x{image.size[1]} detail={detail}")
+    return {
+        'url': f"data:{_MIME[fmt.lower()]};base64,{encoded}",
+        'detail': detail,
+        'original_bytes': original_bytes,
+        'optimized_bytes': len(optimized),
+        'width': image.size[0],
+        'height': image.size[1],
+    }
+
+
+def cloudinary_url(url):
+    """
+    Cloudinary の配信URLに縮小・再エンコードの変換を付ける
+
+    OpenAI にURLで渡す場合も、Cloudinary 側で縮小した画像を取得させます
+    （PDFは1ページ目がJPEGで配信されます）。Cloudinary 以外のURLはそのまま返します。
+    """
+    marker = '/upload/'
+    if 'res.cloudinary.com' not in url or marker not in url:
+        return url
+    fmt = 'webp' if OUTPUT_FORMAT == 'webp' else 'jpg'
+    transformation = f"c_limit,w_{MAX_EDGE},h_{MAX_EDGE},q_auto:good,f_{fmt}"
+    head, tail = url.split(marker, 1)
+    return f"{head}{marker}{transformation}/{tail}"
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+材質名のあいまい照合（AI抽出の材質名 → 材質マスタ）
+
+AI が読み取った "アルミ複合板 3mm" と材質マスタの "アルミ複合板(3t)" のように、
+表記ゆれのある材質名を材質マスタに対応付けます。
+
+    1. NFKC 正規化・小文字化・カタカナ→ひらがな・記号と空白の除去
+    2. 板厚の表記（t3 / 3t / 3mm / 厚3 など）を取り出して別に比較
+    3. 残りの文字列を文字 bigram の Dice 係数で比較
+
+テナントごとに材質マスタから1回だけ索引を作り（TTL 付きでキャッシュ）、
+見積もりの全明細をまとめて照合します。
+"""
+
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+from app.utils.db import _sql
+
+# これ以上のスコアの候補だけを自動で採用する（0〜1）
+MIN_SCORE = float(os.getenv('MATERIAL_MATCH_MIN_SCORE', '0.5'))
+# 確認画面に表示する候補数
+CANDIDATE_LIMIT = int(os.getenv('MATERIAL_MATCH_CANDIDATES', '3'))
+CACHE_TTL = float(os.getenv('MATERIAL_INDEX_CACHE_TTL', '300'))
+
+# 板厚が一致・不一致のときのスコア補正
+_THICKNESS_MATCH_BONUS = 0.15
+_THICKNESS_MISMATCH_FACTOR = 0.6
+_MAX_THICKNESS_MM = 100
+
+_NUM = r'(\d+(?:\.\d+)?)'
+_THICKNESS_RES = (
+    re.compile(r'(?:(?<![a-z])t|板厚|厚さ|厚)\s*[=:]?\s*' + _NUM + r'\s*(?:mm)?'),  # t3 / t=3 / 厚3mm
+    re.compile(_NUM + r'\s*(?:mm)?\s*(?:t(?![a-z])|厚)'),                          # 3t / 3mm厚
+    re.compile(_NUM + r'\s*mm'),                                                   # 3mm
+)
+
+
+def _fold(text):
+    """NFKC・小文字化・カタカナをひらがなに揃える"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return ''.join(chr(ord(ch) - 0x60) if 'ァ' <= ch <= 'ヶ' else ch for ch in text)
+
+
+def _strip_symbols(text):
+    """空白・記号を除く（長音記号は残す）"""
+    return ''.join(
+        ch for ch in text
+        if ch == 'ー' or unicodedata.category(ch)[0] not in ('P', 'Z', 'S', 'C')
+    )
+
+
+def parse(text):
+    """
+    材質名を照合用に分解する
+
+    Returns:
+        tuple: (板厚を除いた正規化済みの名前, 板厚 mm または None)
+    """
+    folded = _fold(text)
+    thickness = None
+    for pattern in _THICKNESS_RES:
+        m = pattern.search(folded)
+        if m and 0 < float(m.group(1)) <= _MAX_THICKNESS_MM:
+            thickness = float(m.group(1))
+            folded = folded[:m.start()] + ' ' + folded[m.end():]
+            break
+    return _strip_symbols(folded), thickness
+
+
+def _grams(text):
+    """文字 bigram（1文字の名前は unigram）"""
+    if len(text) < 2:
+        return Counter(text)
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+
+def _dice(a, b, size_a, size_b):
+    common = sum(min(count, b[gram]) for gram, count in a.items() if gram in b)
+    return 2.0 * common / (size_a + size_b) if size_a + size_b else 0.0
+
+
+class MaterialIndex:
+    """1テナントの材質マスタの照合用索引（読み取り専用、スレッド間で共有可）"""
+
+    def __init__(self, materials):
+        """
+        Args:
+            materials: [{'id', 'name', 'thickness', ...}]（その他の列はそのまま候補に含める）
+        """
+        self.materials = list(materials)
+        self._entries = []
+        self._by_exact = {}
+        self._postings = {}     # bigram -> [材質の位置]
+        for pos, material in enumerate(self.materials):
+            base, name_thickness = parse(material['name'])
+            grams = _grams(base)
+            thickness = material.get('thickness') or name_thickness
+            self._entries.append((base, grams, sum(grams.values()), float(thickness) if thickness else None))
+            self._by_exact.setdefault(material['name'], pos)
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(pos)
+
+    def match(self, name, limit=CANDIDATE_LIMIT):
+        """
+        材質名に近い材質を返す
+
+        Returns:
+            list: [{'material': 材質の dict, 'score': 0〜1}]（スコアの高い順）
+        """
+        if not name:
+            return []
+        exact = self._by_exact.get(name)
+        if exact is not None:
+            return [{'material': self.materials[exact], 'score': 1.0}]
+
+        base, thickness = parse(name)
+        grams = _grams(base)
+        size = sum(grams.values())
+        positions = {pos for gram in grams for pos in self._postings.get(gram, ())}
+
+        scored = []
+        for pos in positions:
+            entry_base, entry_grams, entry_size, entry_thickness = self._entries[pos]
+            score = 1.0 if base == entry_base else _dice(grams, entry_grams, size, entry_size)
+            if entry_base and base and (entry_base in base or base in entry_base):
+                # 一方がもう一方を含む（"アルミ複合板" と "アルミ複合板白" など）
+                score = max(score, min(len(base), len(entry_base)) / max(len(base), len(entry_base)) * 0.5 + 0.4)
+            if thickness is not None and entry_thickness is not None:
+                if abs(thickness - entry_thickness) < 1e-6:
+                    score = min(1.0, score + _THICKNESS_MATCH_BONUS)
+                else:
+                    score *= _THICKNESS_MISMATCH_FACTOR
+            scored.append((score, pos))
+
+        scored.sort(key=lambda s: (-s[0], s[1]))
+        return [{'material': self.materials[pos], 'score': round(score, 3)} for score, pos in scored[:limit]]
+
+    def resolve(self, names, limit=CANDIDATE_LIMIT):
+        """
+        複数の材質名をまとめて照合する（同じ名前は1回だけ計算）
+
+        Returns:
+            dict: {材質名: match の結果}
+        """
+        return {name: self.match(name, limit) for name in dict.fromkeys(names)}
+
+    def best(self, name, min_score=MIN_SCORE):
+        """スコアが min_score 以上の最上位の材質、無ければ None"""
+        candidates = self.match(name, 1)
+        if candidates and candidates[0]['score'] >= min_score:
+            return candidates[0]['material']
+        return None
+
+
+# ===========================
+# テナント別キャッシュ
+# ===========================
+_COLUMNS = ('id', 'name', 'price_type', 'unit_price_area', 'unit_price_weight', 'specific_gravity', 'thickness')
+
+_cache = {}     # tenant_id -> (loaded_at, MaterialIndex)
+_cache_lock = threading.Lock()
+
+
+def load_index(conn, tenant_id):
+    """
+    テナントの有効な材質から索引を返す（キャッシュ済みならDBに問い合わせない）
+    """
+    now = time.monotonic()
+    cached = _cache.get(tenant_id)
+    if cached and now - cached[0] < CACHE_TTL:
+        return cached[1]
+
+    cur = conn.cursor()
+    cur.execute(_sql(conn,
+        'SELECT ' + ', '.join(f'"{c}"' for c in _COLUMNS) + ' FROM "T_材質" '
+        'WHERE "tenant_id" = %s AND "active" = 1 ORDER BY "id"'
+    ), (tenant_id,))
+    index = MaterialIndex(dict(zip(_COLUMNS, row)) for row in cur.fetchall())
+    cur.close()
+
+    with _cache_lock:
+        _cache[tenant_id] = (now, index)
+    return index
+
+
+def invalidate(tenant_id=None):
+    """材質マスタ更新時にキャッシュを破棄（tenant_id=None で全テナント）"""
+    with _cache_lock:
+        if tenant_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(tenant_id, None)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+リクエスト計測（Prometheus形式の /metrics 用）
+
+- エンドポイント別のレイテンシヒストグラム
+- リクエストごとのSQL件数・SQL時間（get_db / SQLAlchemy の両方）
+- OpenAI / Cloudinary などの外部呼び出し回数・時間
+
+gunicorn の複数ワーカーに対応するため、各ワーカーは自プロセスの集計値を
+METRICS_DIR 配下の metrics_<pid>.json に定期的に書き出し、/metrics は
+ディレクトリ内の全ファイルを合算して返します。
+"""
+
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+from .db import add_query_listener, instrument_engine
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = os.getenv('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'signboard_metrics')
+FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1.0'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+EXTERNAL_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# メトリクス定義: 名前 -> (種類, 説明, バケット)
+METRICS = {
+    'http_request_duration_seconds': ('histogram', 'リクエスト処理時間（秒）', LATENCY_BUCKETS),
+    'db_queries_per_request': ('histogram', '1リクエストあたりのSQL件数', QUERY_COUNT_BUCKETS),
+    'db_queries_total': ('counter', '実行したSQL件数', None),
+    'db_query_duration_seconds_total': ('counter', 'SQL実行時間の合計（秒）', None),
+    'external_calls_total': ('counter', '外部サービス呼び出し回数', None),
+    'external_call_duration_seconds': ('histogram', '外部サービス呼び出し時間（秒）', EXTERNAL_BUCKETS),
+    'external_bytes_sent_total': ('counter', '外部サービスへの送信バイト数', None),
+    'ai_tokens_total': ('counter', 'AI呼び出しのトークン数（kind=prompt/completion）', None),
+    'rate_limit_wait_seconds_total': ('counter', 'テナント別レート制限で待った時間の合計（秒）', None),
+    'circuit_breaker_transitions_total': ('counter', 'サーキットブレーカーの状態遷移回数（state=遷移先）', None),
+    'blob_dedup_hits_total': ('counter', '保存済みの設計図と同じ内容でアップロードを省いた回数', None),
+    'blob_gc_deleted_total': ('counter', '参照されなくなって削除した設計図の実体の件数', None),
+    'blob_gc_bytes_total': ('counter', '参照されなくなって削除した設計図の実体のバイト数', None),
+    'derivative_requests_total': ('counter', '設計図の派生画像の取得回数（result=hit/miss）', None),
+    'tiles_written_total': ('counter', '作成した拡大表示用タイルの枚数', None),
+    'auto_estimate_reaped_total': ('counter', '放置されて削除した自動見積もりの件数', None),
+}
+
+_lock = threading.Lock()
+_counters = {}      # (name, labels) -> float
+_histograms = {}    # (name, labels) -> [bucket_counts..., sum, count]
+_last_flush = 0.0
+
+
+def _labels(**kwargs):
+    return tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+
+def inc_counter(name, value=1.0, **labels):
+    """カウンターを加算"""
+    key = (name, _labels(**labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def observe(name, value, **labels):
+    """ヒストグラムに値を記録"""
+    buckets = METRICS[name][2]
+    key = (name, _labels(**labels))
+    with _lock:
+        data = _histograms.get(key)
+        if data is None:
+            data = [0] * len(buckets) + [0.0, 0]
+            _histograms[key] = data
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+
+@contextmanager
+def track_external_call(service):
+    """
+    外部サービス呼び出しを計測するコンテキストマネージャ
+
+    使用例:
+        with track_external_call('openai'):
+            client.chat.completions.create(...)
+    """
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        inc_counter('external_calls_total', service=service, outcome=outcome)
+        observe('external_call_duration_seconds', time.perf_counter() - start, service=service)
+
+
+def _current_endpoint():
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'none'
+
+
+def _on_query(event):
+    """SQL 1件ごとにリクエスト単位の集計へ加算"""
+    if has_request_context():
+        g._metrics_queries = getattr(g, '_metrics_queries', 0) + 1
+        g._metrics_query_time = getattr(g, '_metrics_query_time', 0.0) + event.duration
+    endpoint = _current_endpoint()
+    inc_counter('db_queries_total', endpoint=endpoint, source=event.source)
+    inc_counter('db_query_duration_seconds_total', event.duration, endpoint=endpoint, source=event.source)
+
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+    g._metrics_queries = 0
+    g._metrics_query_time = 0.0
+
+
+def _after_request(response):
+    try:
+        start = getattr(g, '_metrics_start', None)
+        if start is not None:
+            endpoint = request.endpoint or 'unknown'
+            observe('http_request_duration_seconds', time.perf_counter() - start,
+                    endpoint=endpoint, method=request.method, status=response.status_code)
+            observe('db_queries_per_request', getattr(g, '_metrics_queries', 0), endpoint=endpoint)
+        flush(force=False)
+    except Exception as e:
+        logger.warning(f"メトリクス記録エラー: {e}")
+    return response
+
+
+# ===========================
+# ワーカー間共有（ファイル書き出し）
+# ===========================
+def _snapshot_path(pid=None):
+    return os.path.join(METRICS_DIR, f"metrics_{pid or os.getpid()}.json")
+
+
+def flush(force=True):
+    """自プロセスの集計値をファイルへ書き出す（FLUSH_INTERVAL 秒に1回まで）"""
+    global _last_flush
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        return
+    _last_flush = now
+
+    with _lock:
+        data = {
+            'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            'histograms': [[name, list(labels), values] for (name, labels), values in _histograms.items()],
+        }
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = _snapshot_path()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"メトリクス書き出しエラー: {e}")
+
+
+def _collect_all():
+    """全ワーカーのスナップショットを合算"""
+    counters = {}
+    histograms = {}
+    try:
+        filenames = [f for f in os.listdir(METRICS_DIR) if f.startswith('metrics_') and f.endswith('.json')]
+    except OSError:
+        filenames = []
+
+    for filename in filenames:
+        try:
+            with open(os.path.join(METRICS_DIR, filename), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in data.get('counters', []):
+            key = (name, tuple(tuple(l) for l in labels))
+            counters[key] = counters.get(key, 0.0) + value
+        for name, labels, values in data.get('histograms', []):
+            key = (name, tuple(tuple(l) for l in labels))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+            else:
+                histograms[key] = list(values)
+    return counters, histograms
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (list(extra) if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+def render_latest():
+    """Prometheus テキスト形式で全ワーカー分のメトリクスを返す"""
+    flush(force=True)
+    counters, histograms = _collect_all()
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == 'counter':
+            for (metric_name, labels), value in sorted(counters.items()):
+                if metric_name == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        else:
+            for (metric_name, labels), values in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                for bound, count in zip(buckets, values):
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', str(bound))])} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {values[-1]}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+    return '\n'.join(lines) + '\n'
+
+
+def init_metrics(app):
+    """Flask アプリにリクエスト計測フックを登録"""
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    add_query_listener(_on_query)
+    try:
+        from app.db import engine
+        instrument_engine(engine)
+    except Exception as e:
+        logger.warning(f"SQLAlchemy 計測フック登録エラー: {e}")
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    atexit.register(flush)
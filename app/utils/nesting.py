@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+板取り計算（定尺板への矩形ネスティング）
+
+見積もり明細のうち同じ材質の部材を、定尺板（例: 910×1820, 1220×2440）に
+MaxRects 法（Best Short Side Fit、90°回転あり）で詰め込み、
+必要枚数と歩留まりを求めます。定尺サイズごとに計算し、消費する板の
+総面積が最も小さいサイズを採用します。
+
+200部材程度なら数十ms以内で終わるため、明細の再計算ごとに実行できます。
+"""
+
+import os
+
+# 定尺サイズ（"幅x高さ" をカンマ区切り、mm）
+STOCK_SHEET_SIZES = os.getenv('STOCK_SHEET_SIZES', '910x1820,1220x2440')
+# 刃幅・切りしろ（mm）。部材ごとにこの分だけ大きく確保する
+KERF_MM = float(os.getenv('NESTING_KERF_MM', '0'))
+# 1回の計算で扱う部材数の上限（数量を展開した後の枚数）
+MAX_PIECES = int(os.getenv('NESTING_MAX_PIECES', '2000'))
+
+
+def parse_sheet_sizes(value=None):
+    """
+    "910x1820,1220x2440" 形式を [(910.0, 1820.0), (1220.0, 2440.0)] に変換
+
+    Raises:
+        ValueError: 形式が不正な場合
+    """
+    sizes = []
+    for token in (value or STOCK_SHEET_SIZES).split(','):
+        token = token.strip().lower().replace('×', 'x')
+        if not token:
+            continue
+        w, h = token.split('x')
+        w, h = float(w), float(h)
+        if w <= 0 or h <= 0:
+            raise ValueError(f"定尺サイズが不正です: {token}")
+        sizes.append((w, h))
+    return sizes
+
+
+class MaxRectsSheet:
+    """1枚の定尺板の空き領域（互いに重なり得る最大空き矩形の集合）"""
+
+    __slots__ = ('width', 'height', 'free', 'placements')
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.free = [(0.0, 0.0, width, height)]
+        self.placements = []
+
+    def find(self, w, h, allow_rotate=True):
+        """
+        置ける位置を探す（短辺の余りが最小の空き矩形）
+
+        Returns:
+            tuple: (短辺の余り, 長辺の余り, x, y, w, h)、置けなければ None
+        """
+        best = None
+        for fx, fy, fw, fh in self.free:
+            if w <= fw and h <= fh:
+                dw, dh = fw - w, fh - h
+                score = (min(dw, dh), max(dw, dh), fx, fy, w, h)
+                if best is None or score < best:
+                    best = score
+            if allow_rotate and w != h and h <= fw and w <= fh:
+                dw, dh = fw - h, fh - w
+                score = (min(dw, dh), max(dw, dh), fx, fy, h, w)
+                if best is None or score < best:
+                    best = score
+        return best
+
+    def place(self, x, y, w, h, ref):
+        self.placements.append({'x': x, 'y': y, 'width': w, 'height': h, 'ref': ref})
+        right, top = x + w, y + h
+
+        # 置いた矩形と重なる空き矩形を最大4つに分割
+        kept = []
+        split = []
+        for fx, fy, fw, fh in self.free:
+            if x >= fx + fw or right <= fx or y >= fy + fh or top <= fy:
+                kept.append((fx, fy, fw, fh))
+                continue
+            if x > fx:
+                split.append((fx, fy, x - fx, fh))
+            if right < fx + fw:
+                split.append((right, fy, fx + fw - right, fh))
+            if y > fy:
+                split.append((fx, fy, fw, y - fy))
+            if top < fy + fh:
+                split.append((fx, top, fw, fy + fh - top))
+
+        # 分割でできた矩形のうち、他の空き矩形に完全に含まれるものを除去
+        # （分割前から残っている矩形同士は既に包含関係が無い）
+        split.sort(key=lambda r: r[2] * r[3], reverse=True)
+        for r in split:
+            rx, ry, rw, rh = r
+            for px, py, pw, ph in kept:
+                if rx >= px and ry >= py and rx + rw <= px + pw and ry + rh <= py + ph:
+                    break
+            else:
+                kept.append(r)
+        self.free = kept
+
+
+def pack(pieces, sheet_width, sheet_height, kerf=KERF_MM, allow_rotate=True):
+    """
+    部材を1種類の定尺板に詰め込む
+
+    Args:
+        pieces: [(幅, 高さ, 参照)] のリスト（数量は展開済み）
+        sheet_width, sheet_height: 定尺サイズ（mm）
+        kerf: 切りしろ（mm）
+        allow_rotate: 90°回転を許可するか
+
+    Returns:
+        dict: {'sheet_width', 'sheet_height', 'sheet_count', 'used_area', 'sheet_area',
+               'yield', 'sheets': [[配置]], 'unplaced': [参照]}
+    """
+    sheets = []
+    unplaced = []
+    used_area = 0.0
+
+    # 大きい部材から順に（長辺 → 面積の降順）
+    order = sorted(pieces, key=lambda p: (max(p[0], p[1]), p[0] * p[1]), reverse=True)
+    for w, h, ref in order:
+        pw, ph = w + kerf, h + kerf
+        fits = (pw <= sheet_width and ph <= sheet_height) or \
+               (allow_rotate and ph <= sheet_width and pw <= sheet_height)
+        if not fits:
+            unplaced.append(ref)
+            continue
+
+        best = None
+        best_sheet = None
+        for sheet in sheets:
+            found = sheet.find(pw, ph, allow_rotate)
+            if found is not None and (best is None or found < best):
+                best, best_sheet = found, sheet
+                if found[0] == 0:
+                    break
+        if best is None:
+            best_sheet = MaxRectsSheet(sheet_width, sheet_height)
+            sheets.append(best_sheet)
+            best = best_sheet.find(pw, ph, allow_rotate)
+
+        _, _, x, y, fw, fh = best
+        best_sheet.place(x, y, fw, fh, ref)
+        used_area += w * h
+
+    sheet_area = sheet_width * sheet_height * len(sheets)
+    return {
+        'sheet_width': sheet_width,
+        'sheet_height': sheet_height,
+        'sheet_count': len(sheets),
+        'used_area': used_area,
+        'sheet_area': sheet_area,
+        'yield': (used_area / sheet_area) if sheet_area else 0.0,
+        'sheets': [s.placements for s in sheets],
+        'unplaced': unplaced,
+    }
+
+
+def nest(items, sheet_sizes=None, kerf=KERF_MM, allow_rotate=True):
+    """
+    明細（数量付き）を各定尺サイズで計算し、最も無駄の少ない結果を返す
+
+    Args:
+        items: [{'width', 'height', 'quantity', 'ref'(任意)}]
+        sheet_sizes: [(幅, 高さ)]（None で STOCK_SHEET_SIZES）
+
+    Returns:
+        dict: {'best': pack の結果, 'candidates': [pack の結果（配置なし）]}
+
+    Raises:
+        ValueError: 部材数が多すぎる場合
+    """
+    pieces = []
+    for i, item in enumerate(items):
+        ref = item.get('ref', i)
+        for _ in range(int(item.get('quantity') or 1)):
+            pieces.append((float(item['width']), float(item['height']), ref))
+    if len(pieces) > MAX_PIECES:
+        raise ValueError(f"部材数が多すぎます（最大{MAX_PIECES}枚）")
+
+    results = [pack(pieces, w, h, kerf, allow_rotate) for w, h in (sheet_sizes or parse_sheet_sizes())]
+    # 全部材が載るものを優先し、その中で消費面積 → 枚数の少ない順
+    best = min(results, key=lambda r: (len(r['unplaced']), r['sheet_area'], r['sheet_count']))
+    candidates = [{k: v for k, v in r.items() if k != 'sheets'} for r in results]
+    return {'best': best, 'candidates': candidates}
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+白紙ページ・重複ページの検出（画像解析の前処理）
+
+設計図PDFには表紙や白紙、改訂版で同じ図面が何度も入っていることがあります。
+ページごとにインク被覆率（暗い画素を含むマス目の割合）と知覚ハッシュ（dHash と pHash）を
+NumPy で計算し、白紙はスキップ、同じリクエスト内でほぼ同じページは
+最初のページだけを解析します。
+"""
+
+import hashlib
+import io
+import os
+import re
+
+try:
+    import numpy as np
+    from PIL import Image
+except Exception:
+    np = None
+    Image = None
+
+# 暗い画素を含むマス目の割合がこれ未満なら白紙とみなす
+BLANK_INK_COVERAGE = float(os.getenv('PAGE_BLANK_INK_COVERAGE', '0.002'))
+# dHash / pHash（各64ビット）のハミング距離がどちらもこれ以下なら重複とみなす
+DHASH_THRESHOLD = int(os.getenv('PAGE_DHASH_THRESHOLD', '4'))
+PHASH_THRESHOLD = int(os.getenv('PAGE_PHASH_THRESHOLD', '6'))
+
+_INK_LEVEL = 200      # これより暗い画素をインクとみなす（0-255）
+_INK_GRID = 256       # インク被覆率を数えるマス目の数（縦横それぞれ）
+_PHASH_SIZE = 32
+_PHASH_LOW = 8
+_WS_RE = re.compile(r'\s+')
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0, :] = np.sqrt(1.0 / n)
+    return matrix
+
+
+_DCT = _dct_matrix(_PHASH_SIZE) if np is not None else None
+
+
+def _gray(image, size):
+    return np.asarray(image.convert('L').resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+def ink_coverage(image):
+    """
+    インク被覆率（ページを _INK_GRID × _INK_GRID のマス目に分け、暗い画素を含むマスの割合）
+
+    先に縮小すると 1〜2px の細線は背景と平均されて消え、図面が白紙と判定されるので、
+    原寸のまま暗い画素を判定してからマス目ごとにまとめる（最小値で縮小するのと同じ）。
+    """
+    dark = np.asarray(image.convert('L')) < _INK_LEVEL
+    height, width = dark.shape
+    cell_h = -(-height // _INK_GRID)
+    cell_w = -(-width // _INK_GRID)
+    rows = -(-height // cell_h)
+    cols = -(-width // cell_w)
+    dark = np.pad(dark, ((0, rows * cell_h - height), (0, cols * cell_w - width)))
+    return float(dark.reshape(rows, cell_h, cols, cell_w).any(axis=(1, 3)).mean())
+
+
+def _to_int(bits):
+    return int(''.join('1' if b else '0' for b in bits.ravel()), 2)
+
+
+def dhash(image):
+    """差分ハッシュ（隣り合う画素の明暗、64ビット）"""
+    pixels = _gray(image, (9, 8))
+    return _to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image):
+    """DCT ハッシュ（低周波成分が中央値より大きいか、64ビット）"""
+    pixels = _gray(image, (_PHASH_SIZE, _PHASH_SIZE))
+    low = (_DCT @ pixels @ _DCT.T)[:_PHASH_LOW, :_PHASH_LOW]
+    median = np.median(low.ravel()[1:])
+    return _to_int(low > median)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class PageDeduplicator:
+    """
+    1リクエスト内のページを順に判定する
+
+    使用例:
+        dedup = PageDeduplicator()
+        for image in pages:
+            status, original = dedup.check_image(image)
+            if status == 'new':
+                ...解析...
+    """
+
+    def __init__(self):
+        self._hashes = []      # [(dHash, pHash, ラベル)]
+        self._texts = {}       # テキストのハッシュ -> ラベル
+        self.skipped = {'blank': 0, 'duplicate': 0}
+
+    def check_image(self, image, label=None):
+        """
+        Args:
+            image: PIL.Image、または画像のバイト列
+
+        Returns:
+            tuple: ('blank', None) / ('duplicate', 最初のページのラベル) / ('new', label)
+        """
+        if np is None:
+            return 'new', label
+        if isinstance(image, (bytes, bytearray)):
+            try:
+                image = Image.open(io.BytesIO(image))
+                # JPEG の縮小デコードは 1/2 まで（それ以上縮めると細線が薄くなりインクと判定できない）
+                image.draft('L', (image.width // 2, image.height // 2))
+            except Exception:
+                return 'new', label
+        if ink_coverage(image) < BLANK_INK_COVERAGE:
+            self.skipped['blank'] += 1
+            return 'blank', None
+
+        d, p = dhash(image), phash(image)
+        for seen_d, seen_p, seen_label in self._hashes:
+            if hamming(d, seen_d) <= DHASH_THRESHOLD and hamming(p, seen_p) <= PHASH_THRESHOLD:
+                self.skipped['duplicate'] += 1
+                return 'duplicate', seen_label
+        self._hashes.append((d, p, label))
+        return 'new', label
+
+    def check_text(self, text, label=None):
+        """テキスト層のあるページを空白を無視した完全一致で判定する"""
+        normalized = _WS_RE.sub('', text)
+        if not normalized:
+            self.skipped['blank'] += 1
+            return 'blank', None
+        key = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        if key in self._texts:
+            self.skipped['duplicate'] += 1
+            return 'duplicate', self._texts[key]
+        self._texts[key] = label
+        return 'new', label
+
+    @property
+    def skipped_total(self):
+        return self.skipped['blank'] + self.skipped['duplicate']
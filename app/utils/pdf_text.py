@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+ベクターPDFのテキスト層から寸法・材質を抽出
+
+CADから書き出したPDFには "W1800" "H600" "アルミ複合板 t3" のような
+文字がテキストとして入っています。poppler の pdftotext（pdf2image と同じ
+poppler に含まれる）で単語と位置を取り出し、正規表現で寸法・数量・材質の
+注記を拾って、近いもの同士を組み合わせて明細にします。
+
+テキスト層に寸法の注記が無いページ（スキャン画像・OCR層だけのPDF、表題欄だけが文字で
+寸法はアウトライン化されたCAD出力など）は画像に変換してAI解析に回します。
+"""
+
+import logging
+import math
+import os
+import re
+import shutil
+import subprocess
+import unicodedata
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+PDFTOTEXT = os.getenv('PDFTOTEXT_PATH') or shutil.which('pdftotext')
+PDFTOTEXT_TIMEOUT = float(os.getenv('PDFTOTEXT_TIMEOUT', '20'))
+
+# 寸法として扱う範囲（mm）
+MIN_DIMENSION_MM = 10
+MAX_DIMENSION_MM = 50000
+
+# 材質名のキーワード（長いものから照合）
+MATERIAL_KEYWORDS = (
+    'アルミ複合板', 'アルミ', 'ステンレス', 'スチール', 'ガルバ', '鉄骨', '鉄',
+    'アクリル', 'ポリカ', '塩ビ', 'PVC', 'カルプ', 'ターポリン', 'FFシート', '木',
+)
+
+_NUM = r'(\d+(?:\.\d+)?)\s*(mm|cm|m(?![a-z]))?'
+_PAIR_RE = re.compile(r'(?<![A-Za-z\d.])(?:W\s*[:=]?\s*)?' + _NUM + r'\s*[x×X*]\s*(?:H\s*[:=]?\s*)?' + _NUM)
+_WIDTH_RE = re.compile(r'(?:(?<![A-Za-z])W|幅|横)\s*[:=]?\s*' + _NUM)
+_HEIGHT_RE = re.compile(r'(?:(?<![A-Za-z])H|高さ|高|縦)\s*[:=]?\s*' + _NUM)
+_QUANTITY_RE = re.compile(r'(?:数量|(?<![A-Za-z])(?:qty|QTY))\s*[:=]?\s*(\d{1,4})|(\d{1,4})\s*(?:枚|台|個|セット|set|式|面)')
+_THICKNESS_RE = re.compile(r'(?:(?<![A-Za-z])t|厚)\s*[:=]?\s*(\d+(?:\.\d+)?)')
+_THOUSANDS_RE = re.compile(r'(?<=\d),(?=\d{3}(?!\d))')
+
+_UNIT_SCALE = {None: 1.0, 'mm': 1.0, 'cm': 10.0, 'm': 1000.0}
+# ベクターのページとみなす注記（寸法）
+_DIMENSION_KINDS = ('pair', 'width', 'height')
+
+
+def available():
+    """pdftotext が使えるか"""
+    return bool(PDFTOTEXT)
+
+
+def _normalize(text):
+    """全角英数を半角にし、桁区切りのカンマを除く"""
+    return _THOUSANDS_RE.sub('', unicodedata.normalize('NFKC', text))
+
+
+def _to_mm(value, unit):
+    mm = float(value) * _UNIT_SCALE[unit]
+    return mm if MIN_DIMENSION_MM <= mm <= MAX_DIMENSION_MM else None
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def read_pages(pdf):
+    """
+    PDFの各ページの行と位置を取り出す
+
+    Args:
+        pdf: PDFのバイト列、またはファイルのパス（os.PathLike、分割アップロードしたファイル）
+
+    Returns:
+        list: [{'page': 1始まり, 'width', 'height', 'lines': [{'text', 'bbox': (x0, y0, x1, y1)}]}]、
+              pdftotext が使えない・失敗した場合は None
+    """
+    if not PDFTOTEXT:
+        return None
+    # パスならメモリに読み込まずに pdftotext に読ませる
+    source, data = (os.fspath(pdf), None) if isinstance(pdf, os.PathLike) else ('-', pdf)
+    try:
+        proc = subprocess.run(
+            [PDFTOTEXT, '-bbox-layout', '-enc', 'UTF-8', source, '-'],
+            input=data, capture_output=True, timeout=PDFTOTEXT_TIMEOUT, check=True,
+        )
+        root = ET.fromstring(proc.stdout)
+    except (OSError, subprocess.SubprocessError, ET.ParseError) as e:
+        logger.warning(f"pdftotext 実行エラー: {e}")
+        return None
+
+    pages = []
+    for page in root.iter():
+        if _local(page.tag) != 'page':
+            continue
+        lines = []
+        for line in page.iter():
+            if _local(line.tag) != 'line':
+                continue
+            words = [w.text or '' for w in line if _local(w.tag) == 'word']
+            text = ' '.join(w for w in words if w)
+            if text.strip():
+                bbox = tuple(float(line.get(k, 0)) for k in ('xMin', 'yMin', 'xMax', 'yMax'))
+                lines.append({'text': text, 'bbox': bbox})
+        pages.append({
+            'page': len(pages) + 1,
+            'width': float(page.get('width', 0)),
+            'height': float(page.get('height', 0)),
+            'lines': lines,
+        })
+    return pages
+
+
+def _center(bbox):
+    return ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+
+
+def _distance(a, b):
+    (ax, ay), (bx, by) = _center(a), _center(b)
+    return math.hypot(ax - bx, ay - by)
+
+
+def find_annotations(lines, material_names=()):
+    """
+    行から寸法・数量・板厚・材質の注記を拾う
+
+    Returns:
+        list: [{'kind': 'pair'|'width'|'height'|'quantity'|'thickness'|'material', 'value', 'text', 'bbox', 'line'}]
+    """
+    keywords = sorted(set(MATERIAL_KEYWORDS) | {n for n in material_names if n}, key=len, reverse=True)
+    annotations = []
+    for line_no, line in enumerate(lines):
+        text = _normalize(line['text'])
+        bbox = line['bbox']
+
+        def add(kind, value, match_text):
+            annotations.append({'kind': kind, 'value': value, 'text': match_text, 'bbox': bbox, 'line': line_no})
+
+        rest = text
+        for m in _PAIR_RE.finditer(text):
+            w, h = _to_mm(m.group(1), m.group(2)), _to_mm(m.group(3), m.group(4))
+            if w and h:
+                add('pair', (w, h), m.group(0))
+                rest = rest.replace(m.group(0), ' ')
+        for m in _WIDTH_RE.finditer(rest):
+            w = _to_mm(m.group(1), m.group(2))
+            if w:
+                add('width', w, m.group(0))
+        for m in _HEIGHT_RE.finditer(rest):
+            h = _to_mm(m.group(1), m.group(2))
+            if h:
+                add('height', h, m.group(0))
+        for m in _QUANTITY_RE.finditer(text):
+            add('quantity', int(m.group(1) or m.group(2)), m.group(0))
+        for m in _THICKNESS_RE.finditer(text):
+            add('thickness', float(m.group(1)), m.group(0))
+        for keyword in keywords:
+            if _normalize(keyword) in text:
+                add('material', keyword, keyword)
+                break
+    return annotations
+
+
+def build_items(annotations):
+    """
+    注記を組み合わせて明細にする
+
+    W×H の組はそのまま、単独の W と H は位置の近いもの同士を組にします。
+    材質はページ内で最も近い材質注記、数量は同じ行にある場合だけ採用します。
+    """
+    by_kind = {}
+    for a in annotations:
+        by_kind.setdefault(a['kind'], []).append(a)
+
+    dims = [(a['value'][0], a['value'][1], a['bbox'], a['line'], [a['text']]) for a in by_kind.get('pair', [])]
+    heights = list(by_kind.get('height', []))
+    for w in by_kind.get('width', []):
+        if not heights:
+            break
+        h = min(heights, key=lambda h: (h['line'] != w['line'], _distance(w['bbox'], h['bbox'])))
+        heights.remove(h)
+        bbox = (min(w['bbox'][0], h['bbox'][0]), min(w['bbox'][1], h['bbox'][1]),
+                max(w['bbox'][2], h['bbox'][2]), max(w['bbox'][3], h['bbox'][3]))
+        dims.append((w['value'], h['value'], bbox, w['line'], [w['text'], h['text']]))
+
+    materials = by_kind.get('material', [])
+    thicknesses = by_kind.get('thickness', [])
+    items = []
+    for width, height, bbox, line_no, texts in dims:
+        material = min(materials, key=lambda m: _distance(bbox, m['bbox'])) if materials else None
+        quantity = next((a['value'] for a in by_kind.get('quantity', []) if a['line'] == line_no), 1)
+        # 板厚は寸法と同じ行、無ければ材質注記と同じ行（"アルミ複合板 t3" など）
+        thickness_lines = (line_no, material['line']) if material else (line_no,)
+        thickness = next((a['value'] for line in thickness_lines for a in thicknesses if a['line'] == line), None)
+        material = material['value'] if material else '不明'
+        description = ' '.join(t.strip() for t in texts)
+        if thickness:
+            description += f" t{thickness:g}"
+        items.append({
+            'material_name': material,
+            'width': width,
+            'height': height,
+            'quantity': quantity,
+            'description': description,
+            'source': 'pdf_text',
+            'bbox': [round(v, 1) for v in bbox],
+        })
+    return items
+
+
+def extract(pdf, material_names=()):
+    """
+    PDFのテキスト層から明細を抽出する
+
+    Args:
+        pdf: PDFのバイト列、またはファイルのパス（read_pages と同じ）
+
+    Returns:
+        list: ページごとの {'page', 'vector': テキスト層に寸法の注記があるか, 'items', 'text'}、
+              pdftotext が使えない場合は None
+    """
+    pages = read_pages(pdf)
+    if pages is None:
+        return None
+    result = []
+    for page in pages:
+        annotations = find_annotations(page['lines'], material_names)
+        items = build_items(annotations)
+        for item in items:
+            item['page'] = page['page']
+        result.append({
+            'page': page['page'],
+            # 文字があっても寸法が読めないページ（OCR層・表題欄だけ）は画像で解析する
+            'vector': any(a['kind'] in _DIMENSION_KINDS for a in annotations),
+            'items': items,
+            'text': '\n'.join(
+                f"[{line['bbox'][0]:.0f},{line['bbox'][1]:.0f}] {line['text']}" for line in page['lines']
+            ),
+        })
+    return result
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+価格マトリクス計算（NumPy）
+
+signboard.calculate_price と同じ規則（面積/重量/体積単価、
+ボリュームディスカウント、消費税10%）を 幅×高さ×数量 のグリッド全体に
+まとめて適用します。材質情報とディスカウントはDBから1回だけ読み込みます。
+"""
+
+from .db import _sql
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+TAX_RATE = 0.10
+MAX_CELLS = 200000
+
+
+def load_pricing_rules(conn, material_id, tenant_id):
+    """
+    材質の単価規則とボリュームディスカウントを読み込む
+
+    Returns:
+        dict: 単価規則、材質が見つからない場合はNone
+    """
+    cur = conn.cursor()
+    cur.execute(_sql(conn,
+        'SELECT "name", "price_type", "unit_price_area", "unit_price_weight", '
+        '"unit_price_volume", "specific_gravity", "thickness" FROM "T_材質" '
+        'WHERE "id" = %s AND "tenant_id" = %s'
+    ), (material_id, tenant_id))
+    material = cur.fetchone()
+    if not material:
+        return None
+
+    cur.execute(_sql(conn,
+        'SELECT "min_quantity", "max_quantity", "discount_type", "discount_rate", "discount_price" '
+        'FROM "T_材質ボリュームディスカウント" WHERE "material_id" = %s '
+        'ORDER BY "min_quantity" DESC'
+    ), (material_id,))
+    discounts = cur.fetchall()
+
+    name, price_type, unit_price_area, unit_price_weight, unit_price_volume, specific_gravity, thickness = material
+    return {
+        'name': name,
+        'price_type': price_type,
+        'unit_price_area': unit_price_area,
+        'unit_price_weight': unit_price_weight,
+        'unit_price_volume': unit_price_volume,
+        'specific_gravity': specific_gravity,
+        'thickness': thickness,
+        'discounts': [tuple(d) for d in discounts],
+    }
+
+
+def _discounted_unit_prices(rules, unit_price, quantities):
+    """数量ごとの (割引率, 割引後単価) を返す（calculate_price と同じ優先順位）"""
+    rates = np.zeros(len(quantities))
+    prices = np.full(len(quantities), float(unit_price))
+    for i, quantity in enumerate(quantities):
+        # min_quantity の降順に並んでいるので最初に該当した段階を採用
+        for min_q, max_q, discount_type, disc_rate, disc_price in rules['discounts']:
+            if min_q <= quantity and (max_q is None or max_q >= quantity):
+                if discount_type == 'rate' and disc_rate:
+                    rates[i] = disc_rate
+                    prices[i] = unit_price * (1 - disc_rate / 100)
+                elif discount_type == 'price' and disc_price:
+                    prices[i] = disc_price
+                    rates[i] = ((unit_price - disc_price) / unit_price) * 100 if unit_price > 0 else 0
+                break
+    return rates, prices
+
+
+def price_grid(rules, widths, heights, quantities):
+    """
+    幅×高さ×数量のグリッド全体の価格を計算する
+
+    Args:
+        rules: load_pricing_rules の戻り値
+        widths: 幅（mm）の配列
+        heights: 高さ（mm）の配列
+        quantities: 数量の配列
+
+    Returns:
+        dict: 各値の配列（形状は (数量, 幅, 高さ)、単価類は (数量,)）
+
+    Raises:
+        ValueError: 単価規則が不完全な場合
+    """
+    if np is None:
+        raise RuntimeError("numpy がインストールされていません")
+
+    widths = np.asarray(widths, dtype=float)
+    heights = np.asarray(heights, dtype=float)
+    quantities = [int(q) for q in quantities]
+
+    # 面積（㎡） shape: (幅, 高さ)
+    area_m2 = (widths[:, None] / 1000) * (heights[None, :] / 1000)
+
+    price_type = rules['price_type']
+    thickness = rules['thickness']
+    weight_kg = None
+    if price_type == 'area':
+        unit_price = rules['unit_price_area'] or 0
+        measure = area_m2
+    elif price_type == 'weight':
+        if not (rules['specific_gravity'] and thickness):
+            raise ValueError("重量単価の材質には比重と板厚が必要です")
+        unit_price = rules['unit_price_weight'] or 0
+        weight_kg = area_m2 * rules['specific_gravity'] * thickness
+        measure = weight_kg
+    elif price_type == 'volume':
+        if not thickness:
+            raise ValueError("体積単価の材質には板厚が必要です")
+        unit_price = rules['unit_price_volume'] or 0
+        measure = area_m2 * (thickness / 1000)
+    else:
+        raise ValueError("不明な単価タイプです")
+
+    discount_rates, discounted_unit_prices = _discounted_unit_prices(rules, unit_price, quantities)
+
+    # (数量, 幅, 高さ) にブロードキャスト
+    q = np.asarray(quantities, dtype=float)[:, None, None]
+    discounted_base = measure[None, :, :] * discounted_unit_prices[:, None, None]
+    subtotal = discounted_base * q
+    tax_amount = np.floor(subtotal * TAX_RATE)
+    total_amount = subtotal + tax_amount
+
+    return {
+        'price_type': price_type,
+        'widths': widths,
+        'heights': heights,
+        'quantities': quantities,
+        'area': area_m2,
+        'weight': weight_kg,
+        'unit_price': unit_price,
+        'discount_rate': discount_rates,
+        'discounted_unit_price': discounted_unit_prices,
+        'subtotal': subtotal,
+        'tax_amount': tax_amount,
+        'total_amount': total_amount,
+    }
+
+
+def iter_csv(grid):
+    """グリッドをCSV行として順に返す（ストリーミング用）"""
+    yield 'width,height,quantity,area,unit_price,discount_rate,discounted_unit_price,subtotal,tax_amount,total_amount\n'
+    unit_price = grid['unit_price']
+    for qi, quantity in enumerate(grid['quantities']):
+        rate = round(float(grid['discount_rate'][qi]), 2)
+        dup = int(grid['discounted_unit_price'][qi])
+        subtotal = grid['subtotal'][qi]
+        tax = grid['tax_amount'][qi]
+        total = grid['total_amount'][qi]
+        lines = []
+        for wi, width in enumerate(grid['widths']):
+            for hi, height in enumerate(grid['heights']):
+                lines.append(
+                    f"{width:g},{height:g},{quantity},{grid['area'][wi, hi]:.4f},{int(unit_price)},{rate},{dup},"
+                    f"{int(subtotal[wi, hi])},{int(tax[wi, hi])},{int(total[wi, hi])}\n"
+                )
+        yield ''.join(lines)
+
+
+def iter_json(grid, material_id, material_name):
+    """グリッドをJSONとして少しずつ返す（ストリーミング用）"""
+    import json
+
+    header = {
+        'material_id': material_id,
+        'material_name': material_name,
+        'price_type': grid['price_type'],
+        'unit_price': int(grid['unit_price']),
+        'widths': [float(w) for w in grid['widths']],
+        'heights': [float(h) for h in grid['heights']],
+    }
+    head = json.dumps(header, ensure_ascii=False)
+    yield head[:-1] + ', "quantities": ['
+    for qi, quantity in enumerate(grid['quantities']):
+        entry = {
+            'quantity': quantity,
+            'discount_rate': round(float(grid['discount_rate'][qi]), 2),
+            'discounted_unit_price': int(grid['discounted_unit_price'][qi]),
+            # total_amount[幅のindex][高さのindex]
+            'subtotal': grid['subtotal'][qi].astype(np.int64).tolist(),
+            'total_amount': grid['total_amount'][qi].astype(np.int64).tolist(),
+        }
+        yield ('' if qi == 0 else ', ') + json.dumps(entry)
+    yield ']}'
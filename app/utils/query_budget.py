@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+クエリ件数の予算チェックと N+1 検出（開発・テスト用）
+
+QUERY_DEBUG=1 のとき、リクエストごとにSQLを数え、同じ形のSQLが
+N_PLUS_ONE_THRESHOLD 回以上繰り返された場合は N+1 の疑いとして
+ループ箇所のスタックトレース付きで警告ログを出します。
+レスポンスには X-Query-Count ヘッダーを付けます。
+
+テストでは tests/conftest.py の pytest フィクスチャ assert_max_queries を使えます
+（max_queries の pytest 版。計測フックは最初に使ったときに登録されます）:
+
+    def test_tenant_admins(tenant_admin_client, assert_max_queries):
+        with assert_max_queries(10):
+            tenant_admin_client.get("/tenant_admin/tenant_admins")
+"""
+
+import logging
+import os
+import threading
+import traceback
+from contextlib import contextmanager
+
+from flask import g, request
+
+from .db import add_query_listener, instrument_engine
+from .slow_query import normalize_sql
+
+logger = logging.getLogger(__name__)
+
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', '5'))
+
+_APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SKIP_FILES = (os.path.abspath(__file__), os.path.join(_APP_DIR, 'utils', 'db.py'))
+
+_local = threading.local()
+_install_lock = threading.Lock()
+_installed = False
+
+
+def _active_collectors():
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    return _local.collectors
+
+
+def _app_stack():
+    """アプリ内のフレームだけを残したスタック（ライブラリ・計測コードは除外）"""
+    frames = []
+    for frame in traceback.extract_stack()[:-1]:
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(_APP_DIR) and filename not in _SKIP_FILES:
+            frames.append(frame)
+    return frames
+
+
+class QueryCollector:
+    """スコープ内で実行されたSQLを記録する"""
+
+    def __init__(self, capture_stack=True):
+        self.capture_stack = capture_stack
+        self.queries = []      # [(正規化SQL, スタック or None)]
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def add(self, statement):
+        stack = _app_stack() if self.capture_stack else None
+        self.queries.append((normalize_sql(statement), stack))
+
+    def repeated(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """threshold 回以上繰り返された同形SQL（N+1 の疑い）を多い順に返す"""
+        groups = {}
+        for sql, stack in self.queries:
+            entry = groups.setdefault(sql, {'sql': sql, 'count': 0, 'stack': stack})
+            entry['count'] += 1
+        found = [e for e in groups.values() if e['count'] >= threshold]
+        return sorted(found, key=lambda e: e['count'], reverse=True)
+
+    def report(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """件数と N+1 の疑いを人が読める形にまとめる"""
+        lines = [f"SQL {self.count}件"]
+        for entry in self.repeated(threshold):
+            lines.append(f"  N+1の疑い: {entry['count']}回 {entry['sql'][:200]}")
+            if entry['stack']:
+                lines.extend('    ' + line.rstrip('\n').replace('\n', '\n    ')
+                             for line in traceback.format_list(entry['stack'][-6:]))
+        return '\n'.join(lines)
+
+
+def install():
+    """SQL の計測フックを登録する（何度呼んでもよい）"""
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        add_query_listener(_on_query)
+        try:
+            from app.db import engine
+            instrument_engine(engine)
+        except Exception as e:
+            logger.warning(f"SQLAlchemy 計測フック登録エラー: {e}")
+        _installed = True
+
+
+@contextmanager
+def collect_queries(capture_stack=True):
+    """
+    スコープ内のSQLを記録するコンテキストマネージャ
+
+    使用例:
+        with collect_queries() as collector:
+            client.get('/signboard/estimates')
+        print(collector.count)
+    """
+    install()
+    collector = QueryCollector(capture_stack=capture_stack)
+    collectors = _active_collectors()
+    collectors.append(collector)
+    try:
+        yield collector
+    finally:
+        collectors.remove(collector)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """クエリ件数が予算を超えた"""
+
+
+@contextmanager
+def max_queries(limit, allow_n_plus_one=False, threshold=N_PLUS_ONE_THRESHOLD):
+    """
+    スコープ内のSQLが limit 件以下であることを保証する
+
+    allow_n_plus_one=False のときは同形SQLの繰り返しも失敗扱いにします。
+    """
+    with collect_queries() as collector:
+        yield collector
+    problems = []
+    if collector.count > limit:
+        problems.append(f"SQL件数が予算を超えました: {collector.count} > {limit}")
+    if not allow_n_plus_one and collector.repeated(threshold):
+        problems.append("同じ形のSQLがループ内で繰り返されています")
+    if problems:
+        raise QueryBudgetExceeded('\n'.join(problems + [collector.report(threshold)]))
+
+
+def _on_query(event):
+    for collector in _active_collectors():
+        collector.add(event.statement)
+
+
+def _before_request():
+    collector = QueryCollector()
+    _active_collectors().append(collector)
+    g._query_collector = collector
+
+
+def _after_request(response):
+    collector = getattr(g, '_query_collector', None)
+    if collector is None:
+        return response
+    response.headers['X-Query-Count'] = str(collector.count)
+    if collector.repeated():
+        logger.warning(f"[{request.endpoint}] {collector.report()}")
+    return response
+
+
+def _teardown_request(exc):
+    collector = getattr(g, '_query_collector', None)
+    collectors = _active_collectors()
+    if collector in collectors:
+        collectors.remove(collector)
+
+
+def init_query_debug(app):
+    """QUERY_DEBUG のときだけリクエスト単位の N+1 検出を有効化（それ以外は何も登録しない）"""
+    if not app.config.get('QUERY_DEBUG'):
+        return
+    install()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    logger.info(f"N+1 検出を有効化（閾値 {N_PLUS_ONE_THRESHOLD}回）")
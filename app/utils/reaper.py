@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+放置された自動見積もりの削除
+
+AI解析（auto_estimate.analyze_image）は解析を始める前に、顧客名が空でステータスが
+「解析中」の T_自動見積もり を作ります。解析に失敗したり、途中で画面を閉じたりすると、
+その行と T_設計図ファイル・保存先のファイルが残り続けるので、REAPER_MAX_AGE_HOURS より
+長く更新されていないものを reap でまとめて削除します（reap_auto_estimates.py から定期実行）。
+
+- 手動見積もり（T_看板見積もり.自動見積もりID）から参照されているもの、明細があるものは残す
+- BATCH_SIZE 件ずつロックして削除し、バッチごとにコミットする（SKIP LOCKED なので
+  同時に開かれている見積もりや、並行して動く別の削除処理とは競合しない）。get_db の接続は
+  autocommit なので、db.manual_commit でバッチを1つのトランザクションにする
+- 削除の時点でも対象の条件を満たすか確かめ、選んだ後で手動見積もりから参照されたものが
+  あればそのバッチは取り消して選び直す（T_看板見積もり.自動見積もりID には外部キーが無く、
+  行のロックでは参照の追加を止められない）
+- 実体（T_設計図ブロブ）の参照は blob_store.release で外し、参照数が0になった実体は
+  猶予時間を待たずに blob_store.collect_garbage で削除する
+- content_hash の無い（migrations/009 より前の）ファイルは行の削除後に保存先から消す
+
+OpenAI の障害中に保存だけした設計図（解析は後で再開）も「解析中」のままなので、
+REAPER_MAX_AGE_HOURS は障害が復旧するまでの時間より十分長くしてください。
+"""
+
+import logging
+import os
+
+from app.utils import blob_store, storage
+from app.utils.db import manual_commit
+from app.utils.metrics import inc_counter
+
+logger = logging.getLogger(__name__)
+
+# 最後に更新されてから削除するまでの時間
+MAX_AGE_HOURS = float(os.getenv('REAPER_MAX_AGE_HOURS', '72'))
+# 1回のトランザクションで削除する見積もりの件数
+BATCH_SIZE = int(os.getenv('REAPER_BATCH_SIZE', '100'))
+# 1回の実行で処理するバッチ数の上限
+MAX_BATCHES = int(os.getenv('REAPER_MAX_BATCHES', '50'))
+
+_STALE_CONDITION = '''
+    a."ステータス" = '解析中'
+    AND COALESCE(a."顧客名", '') = ''
+    AND a."更新日時" < CURRENT_TIMESTAMP - make_interval(secs => %s)
+    AND NOT EXISTS (SELECT 1 FROM "T_看板見積もり" e WHERE e."自動見積もりID" = a."ID")
+    AND NOT EXISTS (SELECT 1 FROM "T_自動見積もり明細" i WHERE i."自動見積もりID" = a."ID")
+'''
+
+
+def count_stale(cur, max_age_hours=None):
+    """
+    削除対象の件数
+
+    Returns:
+        tuple: (見積もりの件数, 設計図ファイルの件数)
+    """
+    max_age_hours = MAX_AGE_HOURS if max_age_hours is None else max_age_hours
+    cur.execute(f'''
+        SELECT COUNT(DISTINCT a."ID"), COUNT(f."ID")
+        FROM "T_自動見積もり" a
+        LEFT JOIN "T_設計図ファイル" f ON f."自動見積もりID" = a."ID"
+        WHERE {_STALE_CONDITION}
+    ''', (max_age_hours * 3600,))
+    return cur.fetchone()
+
+
+def _delete_legacy_file(filepath):
+    """
+    content_hash の無いファイルを保存先から削除する
+
+    Returns:
+        int: 削除したバイト数（ローカル以外はサイズが分からないので 0）
+    """
+    size = os.path.getsize(filepath) if storage.backend_for(filepath).name == 'local' and os.path.exists(filepath) else 0
+    storage.delete(filepath)
+    return size
+
+
+def reap_batch(conn, max_age_hours=None, batch_size=None):
+    """
+    放置された自動見積もりを batch_size 件まで削除する
+
+    Returns:
+        dict: {'estimates', 'files', 'released', 'conflicts', 'legacy_deleted', 'bytes', 'errors'}
+              released は参照数が0になった実体の content_hash のリスト、conflicts は
+              選んだ後で対象外になった件数（バッチは取り消したので選び直す）
+    """
+    max_age_hours = MAX_AGE_HOURS if max_age_hours is None else max_age_hours
+    batch_size = batch_size or BATCH_SIZE
+    stats = {'estimates': 0, 'files': 0, 'released': [], 'conflicts': 0, 'legacy_deleted': 0, 'bytes': 0, 'errors': 0}
+    with manual_commit(conn):
+        cur = conn.cursor()
+        try:
+            cur.execute(f'''
+                SELECT a."ID" FROM "T_自動見積もり" a
+                WHERE {_STALE_CONDITION}
+                ORDER BY a."更新日時"
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ''', (max_age_hours * 3600, batch_size))
+            ids = [row[0] for row in cur.fetchall()]
+            if not ids:
+                conn.rollback()
+                return stats
+
+            cur.execute('''
+                SELECT "ファイルパス", "content_hash" IS NULL
+                FROM "T_設計図ファイル"
+                WHERE "自動見積もりID" = ANY(%s)
+            ''', (ids,))
+            files = cur.fetchall()
+            released = blob_store.release(cur, ids)
+            # T_設計図ファイル・T_自動見積もり明細 は ON DELETE CASCADE で一緒に消える
+            cur.execute(f'''
+                DELETE FROM "T_自動見積もり" a
+                WHERE a."ID" = ANY(%s) AND {_STALE_CONDITION}
+                RETURNING a."ID"
+            ''', (ids, max_age_hours * 3600))
+            deleted = cur.fetchall()
+            if len(deleted) != len(ids):
+                # 参照数は選んだ全件分減らしたので、バッチごと取り消す
+                conn.rollback()
+                stats['conflicts'] = len(ids) - len(deleted)
+                logger.info(f"削除対象から外れた自動見積もりがあるため選び直します: {stats['conflicts']}件")
+                return stats
+            stats['released'] = released
+            stats['estimates'] = len(deleted)
+            stats['files'] = len(files)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+    for filepath, legacy in files:
+        if not legacy:
+            continue
+        try:
+            stats['bytes'] += _delete_legacy_file(filepath)
+        except Exception as e:
+            # 行は削除済みなので、残ったファイルはどこからも参照されない
+            logger.warning(f"設計図ファイルを削除できませんでした: {filepath} {e}")
+            stats['errors'] += 1
+            continue
+        stats['legacy_deleted'] += 1
+    logger.info(f"放置された自動見積もりを削除しました: {stats['estimates']}件（ID {ids[0]}〜）")
+    return stats
+
+
+def reap(conn, max_age_hours=None, batch_size=None, max_batches=None):
+    """
+    放置された自動見積もりを、対象が無くなるか max_batches 回までバッチで削除する
+
+    Returns:
+        dict: {'estimates', 'files', 'legacy_deleted', 'blobs_deleted', 'derivatives', 'bytes', 'errors'}
+    """
+    max_batches = max_batches or MAX_BATCHES
+    total = {'estimates': 0, 'files': 0, 'legacy_deleted': 0, 'blobs_deleted': 0, 'derivatives': 0,
+             'bytes': 0, 'errors': 0}
+    for _ in range(max_batches):
+        stats = reap_batch(conn, max_age_hours, batch_size)
+        if stats['conflicts']:
+            continue
+        if not stats['estimates']:
+            break
+        for key in ('estimates', 'files', 'legacy_deleted', 'bytes', 'errors'):
+            total[key] += stats[key]
+        if stats['released']:
+            # 放置された見積もりだけが参照していた実体は猶予を待たずに消す
+            gc = blob_store.collect_garbage(conn, only=stats['released'])
+            total['blobs_deleted'] += gc['deleted']
+            total['derivatives'] += gc['derivatives']
+            total['bytes'] += gc['bytes']
+            total['errors'] += gc['errors']
+        if stats['estimates'] < (batch_size or BATCH_SIZE):
+            break
+    inc_counter('auto_estimate_reaped_total', total['estimates'])
+    return total
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+外部サービス（OpenAI・Cloudinary）のタイムアウトとサーキットブレーカー
+
+障害中のサービスをライブラリ既定のタイムアウトまで待ち続けると、gunicorn の
+ワーカーが全て埋まってアプリ全体が応答しなくなります。そこで
+
+- 接続・読み込みのタイムアウトを明示する（openai_timeout / cloudinary_timeout）
+- サービスごとのサーキットブレーカーで、連続して失敗したら BREAKER_RESET_SECONDS の間は
+  呼び出さずに CircuitOpen を送出する（呼び出し側はローカル保存や解析待ちに切り替える）
+- 時間が経ったら半開状態で BREAKER_HALF_OPEN_PROBES 件だけ試し、成功すれば閉じる
+
+ブレーカーの状態はワーカープロセスごとで、/healthz で確認できます。
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from app.utils.metrics import inc_counter
+
+logger = logging.getLogger(__name__)
+
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5'))
+OPENAI_READ_TIMEOUT = float(os.getenv('OPENAI_READ_TIMEOUT', '60'))
+# OpenAI SDK 内の再試行回数（抽出の再試行は extraction が予算付きで行う）
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '0'))
+CLOUDINARY_CONNECT_TIMEOUT = float(os.getenv('CLOUDINARY_CONNECT_TIMEOUT', '5'))
+CLOUDINARY_READ_TIMEOUT = float(os.getenv('CLOUDINARY_READ_TIMEOUT', '30'))
+
+# 連続してこの回数失敗したら開く
+FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+# 開いてから半開にするまでの秒数
+RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', '30'))
+# 半開状態で同時に通す呼び出し数
+HALF_OPEN_PROBES = int(os.getenv('BREAKER_HALF_OPEN_PROBES', '1'))
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+# cloudinary.exceptions のうち、リクエスト側の問題を表すもの（status_code を持たない）
+_CLIENT_ERRORS = ('BadRequest', 'AuthorizationRequired', 'NotAllowed', 'NotFound', 'AlreadyExists')
+
+
+class CircuitOpen(Exception):
+    """サーキットブレーカーが開いているため呼び出さなかった"""
+    status_code = 503
+    # 待たずに再試行しても同じ結果になる
+    retryable = False
+
+    def __init__(self, service, retry_after):
+        super().__init__(f"{service} は一時的に利用できません（約{int(retry_after) + 1}秒後に再開）")
+        self.service = service
+        self.retry_after = retry_after
+
+
+def openai_timeout():
+    """OpenAI クライアントの timeout（httpx が無ければ読み込みのタイムアウトの秒数）"""
+    try:
+        import httpx
+    except ImportError:
+        return OPENAI_READ_TIMEOUT
+    return httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+
+
+def cloudinary_timeout():
+    """cloudinary.uploader の timeout（urllib3 が無ければ読み込みのタイムアウトの秒数）"""
+    try:
+        import urllib3
+    except ImportError:
+        return CLOUDINARY_READ_TIMEOUT
+    return urllib3.Timeout(connect=CLOUDINARY_CONNECT_TIMEOUT, read=CLOUDINARY_READ_TIMEOUT)
+
+
+def is_failure(error):
+    """
+    サービス側の障害とみなすエラーか
+
+    接続エラー・タイムアウト（status_code なし）、5xx、429 は障害、
+    それ以外の 4xx（リクエスト不正・認証・記録なし）はサービス自体は応答しているので数えない。
+    """
+    if isinstance(error, CircuitOpen) or type(error).__name__ in _CLIENT_ERRORS:
+        return False
+    # OpenAI SDK は status_code、urllib の HTTPError は status
+    status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+    if not isinstance(status, int):
+        return True
+    return status >= 500 or status in (408, 429)
+
+
+class CircuitBreaker:
+    """1サービス分のサーキットブレーカー（スレッド間で共有可）"""
+
+    def __init__(self, service, failure_threshold=FAILURE_THRESHOLD, reset_seconds=RESET_SECONDS,
+                 half_open_probes=HALF_OPEN_PROBES):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None       # time.monotonic()
+        self.last_error = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+        logger.warning(f"サーキットブレーカー {self.service}: {self.state} → {state}")
+        inc_counter('circuit_breaker_transitions_total', service=self.service, state=state)
+        self.state = state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        if state == HALF_OPEN:
+            self._probes = 0
+
+    def retry_after(self):
+        """呼び出せるようになるまでの秒数（閉じていれば 0）"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+    def is_open(self):
+        """今呼び出すと CircuitOpen になるか（半開の試行待ちは含めない）"""
+        return self.state == OPEN and self.retry_after() > 0
+
+    def before_call(self):
+        """
+        Raises:
+            CircuitOpen: 開いている、または半開で試行中の呼び出しが上限に達している場合
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if self.retry_after() > 0:
+                    raise CircuitOpen(self.service, self.retry_after())
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    raise CircuitOpen(self.service, self.reset_seconds)
+                self._probes += 1
+
+    def on_success(self):
+        with self._lock:
+            self.failures = 0
+            self._transition(CLOSED)
+
+    def on_failure(self, error):
+        with self._lock:
+            self.last_error = f"{type(error).__name__}: {error}"[:200]
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._transition(OPEN)
+
+    @contextmanager
+    def guard(self):
+        """
+        呼び出しをブレーカーで囲む
+
+        使用例:
+            with breaker('openai').guard():
+                client.chat.completions.create(...)
+        """
+        self.before_call()
+        try:
+            yield
+        except Exception as e:
+            if is_failure(e):
+                self.on_failure(e)
+            else:
+                self.on_success()
+            raise
+        except BaseException:
+            # 呼び出し側の中断（GeneratorExit など）は結果に数えず、半開の試行枠だけ返す
+            self._release()
+            raise
+        self.on_success()
+
+    def _release(self):
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def snapshot(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'retry_after': round(self.retry_after(), 1),
+            'last_error': self.last_error,
+        }
+
+
+_breakers = {}      # service -> CircuitBreaker
+_breakers_lock = threading.Lock()
+
+
+def breaker(service):
+    """サービスのサーキットブレーカー（ワーカープロセス内で共有）"""
+    cb = _breakers.get(service)
+    if cb is None:
+        with _breakers_lock:
+            cb = _breakers.setdefault(service, CircuitBreaker(service))
+    return cb
+
+
+def states():
+    """全サービスのブレーカーの状態（/healthz 用）"""
+    for service in ('openai', 'cloudinary'):
+        breaker(service)
+    return {service: cb.snapshot() for service, cb in sorted(_breakers.items())}
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+スロークエリ記録（オプトイン）
+
+SLOW_QUERY_ENABLED=1 のとき、get_db のカーソルと SQLAlchemy の両方で
+SLOW_QUERY_THRESHOLD_MS を超えたSQLをリングバッファへ記録します。
+PostgreSQL では実行計画も取得します。実行計画はリクエストの処理を待たせないよう
+バックグラウンドのスレッドが別の接続で取り、読み取り専用トランザクションの中で
+実行してロールバックします（ANALYZE は素の SELECT だけ、更新系・WITH は EXPLAIN のみ）。
+
+記録はワーカープロセスごとです（gunicornでは各ワーカーが個別に保持）。
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import has_request_context, request
+
+from .db import QueryEvent, _is_pg, add_query_listener, get_db, instrument_engine
+
+logger = logging.getLogger(__name__)
+
+THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '200'))
+BUFFER_SIZE = int(os.getenv('SLOW_QUERY_BUFFER_SIZE', '500'))
+# 同じ形のSQLに対して EXPLAIN を取り直す最短間隔（秒）
+EXPLAIN_INTERVAL = float(os.getenv('SLOW_QUERY_EXPLAIN_INTERVAL', '600'))
+
+_lock = threading.Lock()
+_records = deque(maxlen=BUFFER_SIZE)
+_last_explained = {}   # fingerprint -> monotonic time
+_local = threading.local()
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![\w\"])-?\d+(?:\.\d+)?")
+_PLACEHOLDER_RE = re.compile(r"%\(\w+\)s|%s|\?|:\w+")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_sql(statement):
+    """リテラル・プレースホルダを ? に置き換え、空白を詰めたSQLを返す"""
+    if isinstance(statement, bytes):
+        statement = statement.decode('utf-8', 'replace')
+    sql = _STRING_RE.sub('?', str(statement))
+    sql = _PLACEHOLDER_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _IN_LIST_RE.sub('(...)', sql)
+    return _WS_RE.sub(' ', sql).strip()
+
+
+def sql_fingerprint(normalized):
+    """正規化済みSQLの短いハッシュ"""
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+
+
+def params_fingerprint(params):
+    """パラメータ値そのものは残さず、型と値のハッシュだけを返す"""
+    if params is None:
+        return ''
+    if isinstance(params, dict):
+        shape = ','.join(f"{k}:{type(v).__name__}" for k, v in sorted(params.items()))
+    elif isinstance(params, (list, tuple)):
+        shape = ','.join(type(v).__name__ for v in params)
+    else:
+        shape = type(params).__name__
+    digest = hashlib.sha1(repr(params).encode('utf-8', 'replace')).hexdigest()[:8]
+    return f"{shape}#{digest}"
+
+
+def _explain(statement, params):
+    """
+    PostgreSQL の実行計画を別の接続で取得する（素の SELECT だけ ANALYZE する）
+
+    ANALYZE は文を実際に実行するので、データを変更し得る文（INSERT/UPDATE/DELETE と、
+    中に更新系を含められる WITH）には付けません。どちらも読み取り専用トランザクションで
+    実行してロールバックします。
+    """
+    if isinstance(statement, bytes):
+        statement = statement.decode('utf-8', 'replace')
+    head = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    if head == 'SELECT':
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+    elif head in ('WITH', 'INSERT', 'UPDATE', 'DELETE'):
+        prefix = 'EXPLAIN '
+    else:
+        return None
+
+    conn = get_db()
+    try:
+        if not _is_pg(conn):
+            return None
+        conn.autocommit = False
+        cur = conn.cursor()
+        try:
+            cur.execute('SET TRANSACTION READ ONLY')
+            cur.execute(prefix + statement, params)
+            return '\n'.join(row[0] for row in cur.fetchall())
+        finally:
+            cur.close()
+            conn.rollback()
+    except Exception as e:
+        return f"EXPLAIN 取得失敗: {e}"
+    finally:
+        conn.close()
+
+
+def _explain_into(record, statement, params):
+    """バックグラウンドで実行計画を取り、記録に書き込む"""
+    # この接続のクエリ自体はスロークエリとして記録しない
+    _local.busy = True
+    try:
+        plan = _explain(statement, params)
+    finally:
+        _local.busy = False
+    with _lock:
+        record['plan'] = plan
+
+
+def _schedule_explain(record, statement, params):
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-query-explain')
+                _executor_pid = os.getpid()
+    _executor.submit(_explain_into, record, statement, params)
+
+
+def _on_query(event: QueryEvent):
+    if getattr(_local, 'busy', False):
+        return
+    duration_ms = event.duration * 1000
+    if duration_ms < THRESHOLD_MS:
+        return
+
+    normalized = normalize_sql(event.statement)
+    fingerprint = sql_fingerprint(normalized)
+    view = request.endpoint if has_request_context() else None
+
+    now = time.monotonic()
+    should_explain = event.connection is not None and _is_pg(event.connection)
+    with _lock:
+        should_explain = should_explain and now - _last_explained.get(fingerprint, -EXPLAIN_INTERVAL) >= EXPLAIN_INTERVAL
+        if should_explain:
+            _last_explained[fingerprint] = now
+
+    record = {
+        'fingerprint': fingerprint,
+        'sql': normalized,
+        'params': params_fingerprint(event.params),
+        'duration_ms': round(duration_ms, 1),
+        'source': event.source,
+        'view': view or '-',
+        'plan': None,
+        'recorded_at': datetime.now(),
+    }
+    with _lock:
+        _records.append(record)
+    if should_explain:
+        _schedule_explain(record, event.statement, event.params)
+    logger.warning(f"スロークエリ {record['duration_ms']}ms [{record['view']}] {normalized[:200]}")
+
+
+def get_records():
+    """記録済みスロークエリ（新しい順）"""
+    with _lock:
+        return list(reversed(_records))
+
+
+def top_offenders(limit=20):
+    """SQLの形ごとに集計し、合計時間の大きい順に返す"""
+    groups = {}
+    for r in get_records():
+        g = groups.get(r['fingerprint'])
+        if g is None:
+            g = groups[r['fingerprint']] = {
+                'fingerprint': r['fingerprint'],
+                'sql': r['sql'],
+                'count': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'views': set(),
+                'plan': None,
+                'last_seen': r['recorded_at'],
+            }
+        g['count'] += 1
+        g['total_ms'] += r['duration_ms']
+        g['max_ms'] = max(g['max_ms'], r['duration_ms'])
+        g['views'].add(r['view'])
+        if g['plan'] is None and r['plan']:
+            g['plan'] = r['plan']
+
+    result = sorted(groups.values(), key=lambda g: g['total_ms'], reverse=True)[:limit]
+    for g in result:
+        g['avg_ms'] = round(g['total_ms'] / g['count'], 1)
+        g['total_ms'] = round(g['total_ms'], 1)
+        g['views'] = sorted(g['views'])
+    return result
+
+
+def clear():
+    """記録を消去"""
+    with _lock:
+        _records.clear()
+        _last_explained.clear()
+
+
+def init_slow_query_log(app):
+    """SLOW_QUERY_ENABLED のときだけリスナーを登録"""
+    if not app.config.get('SLOW_QUERY_ENABLED'):
+        return
+    add_query_listener(_on_query)
+    try:
+        from app.db import engine
+        instrument_engine(engine)
+    except Exception as e:
+        logger.warning(f"SQLAlchemy 計測フック登録エラー: {e}")
+    logger.info(f"スロークエリ記録を有効化（閾値 {THRESHOLD_MS}ms）")
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+設計図ファイルの保存先（ローカル・S3互換・Cloudinary）
+
+STORAGE_BACKEND で保存先を選びます（既定は cloudinary）。
+
+    cloudinary : Cloudinary（ファイルパスは配信URL）
+    s3         : S3互換のオブジェクトストレージ（ファイルパスは s3://<バケット>/<キー>）
+                 S3_ENDPOINT_URL を指定すると MinIO などのS3互換サーバーを使えます
+    local      : ローカルディスク（ファイルパスは絶対パス、1台構成・開発用）
+
+保存先に書き込めない場合は STORAGE_FALLBACK（既定は local）に保存します。
+複数の dyno / ノードで動かす場合、ローカルのファイルは他のノードから読めないので
+STORAGE_FALLBACK を空にしてください。
+
+読み込み・削除・URLの発行は、保存済みのファイルパスの形式から保存先を判定するので、
+STORAGE_BACKEND を切り替えても既存のファイルはそのまま読めます
+（ローカルのファイルの移行は migrate_blueprint_storage.py）。
+"""
+
+import io
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import threading
+
+from app.utils import transport
+from app.utils.metrics import track_external_call
+from app.utils.resilience import breaker
+
+logger = logging.getLogger(__name__)
+
+BACKEND = os.getenv('STORAGE_BACKEND', 'cloudinary').lower()
+FALLBACK = os.getenv('STORAGE_FALLBACK', 'local').lower()
+LOCAL_DIR = os.getenv('STORAGE_LOCAL_DIR', os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), 'static', 'uploads', 'blueprints'))
+CLOUDINARY_FOLDER = os.getenv('STORAGE_CLOUDINARY_FOLDER', 'signboard/blueprints')
+# Cloudinary からファイルを取得するときのタイムアウト（秒）
+FETCH_TIMEOUT = float(os.getenv('BLUEPRINT_FETCH_TIMEOUT', '30'))
+
+S3_BUCKET = os.getenv('S3_BUCKET')
+S3_PREFIX = os.getenv('S3_PREFIX', 'blueprints/')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL') or None
+S3_REGION = os.getenv('S3_REGION') or None
+# MinIO などは path（https://<endpoint>/<バケット>/<キー>）
+S3_ADDRESSING_STYLE = os.getenv('S3_ADDRESSING_STYLE', 'auto')
+# 署名付きURLの有効期間（秒）
+S3_URL_EXPIRES = int(os.getenv('S3_URL_EXPIRES', '900'))
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Cloudinary の配信URL（.../<種類>/upload/[変換/][v<版>/]<public_id>.<拡張子>）
+_CLOUDINARY_URL_RE = re.compile(r'/(image|raw|video)/upload/(?:v\d+/)?(.+?)(?:\.[A-Za-z0-9]+)?$')
+
+
+class StorageError(Exception):
+    """保存先の設定や接続の問題"""
+
+
+def content_type(file_ext):
+    return mimetypes.types_map.get(f".{file_ext}", 'application/octet-stream')
+
+
+def iter_chunks(file, chunk_size=_CHUNK_SIZE):
+    """ファイルオブジェクトを chunk_size ずつ読む"""
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        yield chunk
+
+
+class LocalStorage:
+    """ローカルディスク（ファイルパスは絶対パス）"""
+    name = 'local'
+
+    def __init__(self, root=LOCAL_DIR):
+        self.root = root
+
+    def put(self, key, file, file_ext):
+        path = os.path.join(self.root, key)
+        if os.path.exists(path):
+            # キーは内容のハッシュなので、既にあれば同じ内容
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        file.seek(0)
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(file, f, _CHUNK_SIZE)
+        os.replace(tmp_path, path)
+        return path
+
+    def open(self, location):
+        return open(location, 'rb')
+
+    def read(self, location):
+        with open(location, 'rb') as f:
+            return f.read()
+
+    def delete(self, location):
+        if os.path.exists(location):
+            os.remove(location)
+
+    def url(self, location, expires=None):
+        """直接のURLは無い（アプリから配信する）"""
+        return None
+
+    def locate(self, key):
+        """キーのファイルパス（保存済みかどうかは確認しない）"""
+        return os.path.join(self.root, key)
+
+    def delete_prefix(self, prefix):
+        """prefix（ディレクトリ）以下をまとめて削除する"""
+        shutil.rmtree(os.path.join(self.root, prefix), ignore_errors=True)
+
+
+class S3Storage:
+    """S3互換のオブジェクトストレージ（ファイルパスは s3://<バケット>/<キー>）"""
+    name = 's3'
+
+    def __init__(self, bucket=S3_BUCKET, prefix=S3_PREFIX, endpoint_url=S3_ENDPOINT_URL, region=S3_REGION,
+                 addressing_style=S3_ADDRESSING_STYLE):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.addressing_style = addressing_style
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import boto3
+                from botocore.config import Config
+            except ImportError:
+                raise StorageError('S3 を使うには boto3 が必要です')
+            with self._lock:
+                if self._client is None:
+                    # 認証情報は AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY（boto3 の既定の探索順）
+                    self._client = boto3.client(
+                        's3', endpoint_url=self.endpoint_url, region_name=self.region,
+                        config=Config(s3={'addressing_style': self.addressing_style},
+                                      connect_timeout=5, read_timeout=30, retries={'max_attempts': 2}),
+                    )
+        return self._client
+
+    def _split(self, location):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        return bucket, key
+
+    def put(self, key, file, file_ext):
+        if not self.bucket:
+            raise StorageError('S3_BUCKET が設定されていません')
+        object_key = f"{self.prefix}{key}"
+        file.seek(0)
+        with track_external_call('s3'), breaker('s3').guard():
+            # 大きいファイルはマルチパートで少しずつ送る
+            self.client.upload_fileobj(file, self.bucket, object_key,
+                                       ExtraArgs={'ContentType': content_type(file_ext)})
+        return f"s3://{self.bucket}/{object_key}"
+
+    def open(self, location):
+        """読み込み用のストリーム（read(n) / iter_chunks() できる）"""
+        bucket, key = self._split(location)
+        with track_external_call('s3'), breaker('s3').guard():
+            return self.client.get_object(Bucket=bucket, Key=key)['Body']
+
+    def read(self, location):
+        body = self.open(location)
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def delete(self, location):
+        bucket, key = self._split(location)
+        with track_external_call('s3'), breaker('s3').guard():
+            self.client.delete_object(Bucket=bucket, Key=key)
+
+    def url(self, location, expires=None):
+        """署名付きURL（expires 秒有効）"""
+        bucket, key = self._split(location)
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=expires or S3_URL_EXPIRES)
+
+    def locate(self, key):
+        return f"s3://{self.bucket}/{self.prefix}{key}"
+
+    def delete_prefix(self, prefix):
+        """prefix 以下のオブジェクトをまとめて削除する（1000件ずつ）"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        with track_external_call('s3'), breaker('s3').guard():
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}{prefix}"):
+                objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+                if objects:
+                    self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+
+
+class CloudinaryStorage:
+    """Cloudinary（ファイルパスは配信URL）"""
+    name = 'cloudinary'
+
+    def __init__(self, folder=CLOUDINARY_FOLDER):
+        self.folder = folder
+
+    def put(self, key, file, file_ext):
+        file.seek(0)
+        with track_external_call('cloudinary'):
+            upload_result = transport.upload(
+                file,
+                folder=self.folder,
+                public_id=key.rsplit('.', 1)[0],  # 拡張子を除いた名前
+                overwrite=False,  # キーは内容のハッシュなので、既にあれば同じ内容
+                resource_type="auto"  # 画像とPDFを自動判定
+            )
+        return upload_result['secure_url']
+
+    def open(self, location):
+        return io.BytesIO(self.read(location))
+
+    def read(self, location):
+        with track_external_call('cloudinary'):
+            return transport.fetch(location, FETCH_TIMEOUT)
+
+    def delete(self, location):
+        match = _CLOUDINARY_URL_RE.search(location)
+        if not match:
+            raise StorageError(f"Cloudinary のURLではありません: {location}")
+        resource_type, public_id = match.groups()
+        with track_external_call('cloudinary'):
+            transport.destroy(public_id, resource_type=resource_type, invalidate=True)
+
+    def url(self, location, expires=None):
+        return location
+
+
+_BACKENDS = {'local': LocalStorage, 's3': S3Storage, 'cloudinary': CloudinaryStorage}
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def get_backend(name=None):
+    """
+    保存先（省略時は STORAGE_BACKEND）
+
+    Raises:
+        StorageError: 不明な保存先の場合
+    """
+    name = (name or BACKEND).lower()
+    backend = _instances.get(name)
+    if backend is None:
+        if name not in _BACKENDS:
+            raise StorageError(f"不明な保存先です: {name}（{', '.join(_BACKENDS)}）")
+        with _instances_lock:
+            backend = _instances.setdefault(name, _BACKENDS[name]())
+    return backend
+
+
+def backend_for(location):
+    """保存済みのファイルパスの保存先"""
+    if location.startswith('s3://'):
+        return get_backend('s3')
+    if location.startswith('http://') or location.startswith('https://'):
+        return get_backend('cloudinary')
+    return get_backend('local')
+
+
+def put(key, file, file_ext, backend=None, fallback=True):
+    """
+    ファイルを保存する（書き込めなければ STORAGE_FALLBACK に保存）
+
+    Args:
+        key: 保存先でのキー（"<ハッシュ>.<拡張子>"）
+        file: 読み込めるファイルオブジェクト（少しずつ読んで送る）
+        backend: 保存先の名前（省略時は STORAGE_BACKEND）
+        fallback: False なら STORAGE_FALLBACK に保存せずに例外を送出する
+
+    Returns:
+        tuple: (保存先の名前, ファイルパス)
+    """
+    primary = get_backend(backend)
+    try:
+        return primary.name, primary.put(key, file, file_ext)
+    except Exception as e:
+        if not fallback or not FALLBACK or FALLBACK == primary.name:
+            raise
+        logger.warning(f"{primary.name} に保存できないため {FALLBACK} に保存します: {e}")
+        fallback = get_backend(FALLBACK)
+        return fallback.name, fallback.put(key, file, file_ext)
+
+
+def open_stream(location):
+    """読み込み用のファイルオブジェクト（S3・ローカルはストリーム）"""
+    return backend_for(location).open(location)
+
+
+def read(location):
+    return backend_for(location).read(location)
+
+
+def delete(location):
+    backend_for(location).delete(location)
+
+
+def url(location, expires=None):
+    """ブラウザ・OpenAI から取得できるURL（ローカルのファイルは None）"""
+    return backend_for(location).url(location, expires)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+設計図の拡大表示用タイル（Deep Zoom / DZI 形式のピラミッド）
+
+高解像度の図面を拡大して寸法を確認するときに、ファイル全体を読み込ませず、
+表示している範囲・倍率のタイル（TILE_SIZE 四方のJPEG）だけを返します。
+
+作成はバックグラウンドで行い（schedule）、メモリを図面の大きさに比例させないよう
+ディスク上の PPM（非圧縮の画素の並び）を帯状に読みながら進めます。
+
+1. PDF のページは pdftoppm（pdf2image）で直接 PPM に書き出す（画像は1回だけ読み込んで PPM に変換）
+2. 最大の倍率から順に、TILE_SIZE 行ずつの帯を読んでタイルに切り出し、
+   同時に 1/2 に縮小した帯を次の倍率の PPM に追記する
+3. 1×1 ピクセルになるまで繰り返す
+
+使うメモリは「幅 × TILE_SIZE 行」程度です。タイルは TILE_STORAGE_BACKEND
+（tiles/<ハッシュ>/<ページ>/<倍率>/<列>_<行>.jpg）に保存し、状態は T_設計図タイル に記録します
+（migrations/011）。Cloudinary は小さなファイルを大量に置く用途に向かないため使いません。
+"""
+
+import io
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.utils import storage
+from app.utils.metrics import inc_counter
+
+try:
+    from PIL import Image, ImageOps
+except Exception:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# タイルの一辺と重なり（Deep Zoom の既定値）
+# 帯ごとに 1/2 に縮小してつなげるため偶数にする
+TILE_SIZE = int(os.getenv('TILE_SIZE', '254')) // 2 * 2
+TILE_OVERLAP = int(os.getenv('TILE_OVERLAP', '1'))
+TILE_QUALITY = int(os.getenv('TILE_QUALITY', '80'))
+# PDF をラスタライズする解像度
+TILE_PDF_DPI = int(os.getenv('TILE_PDF_DPI', '200'))
+# タイルの保存先（local / s3、既定は STORAGE_BACKEND が s3 なら s3、それ以外は local）
+TILE_STORAGE_BACKEND = os.getenv('TILE_STORAGE_BACKEND') or ('s3' if storage.BACKEND == 's3' else 'local')
+# アップロード直後に作っておくか（0 で表示時だけ作る）
+TILE_PRECOMPUTE = os.getenv('TILE_PRECOMPUTE', '1') == '1'
+# 作成中のまま更新されない（ワーカーが落ちた）場合に作り直すまでの秒数
+TILE_STALE_SECONDS = int(os.getenv('TILE_STALE_SECONDS', '1800'))
+# 作成用の一時ファイルの置き場所（未指定は OS の一時ディレクトリ）
+TILE_WORK_DIR = os.getenv('TILE_WORK_DIR') or None
+
+READY, BUILDING, FAILED = 'ready', 'building', 'failed'
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+# ===========================
+# PPM の帯単位の読み書き
+# ===========================
+class _PPMReader:
+    """P6（RGB 8bit）の PPM から指定した行の範囲だけを読む"""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        tokens = []
+        while len(tokens) < 4:
+            line = self._file.readline()
+            if not line:
+                raise ValueError(f"PPM のヘッダーが不正です: {path}")
+            tokens.extend(line.split(b'#', 1)[0].split())
+        if tokens[0] != b'P6' or int(tokens[3]) != 255:
+            raise ValueError(f"P6（8bit）の PPM ではありません: {path}")
+        self.width, self.height = int(tokens[1]), int(tokens[2])
+        self._offset = self._file.tell()
+
+    def rows(self, top, bottom):
+        """top 行目から bottom 行目の手前までの画像"""
+        stride = self.width * 3
+        self._file.seek(self._offset + top * stride)
+        data = self._file.read((bottom - top) * stride)
+        return Image.frombytes('RGB', (self.width, bottom - top), data)
+
+    def close(self):
+        self._file.close()
+
+
+class _PPMWriter:
+    """PPM に行を追記する（1/2 に縮小した次の倍率の画像用）"""
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.width, self.height = width, height
+        self._file = open(path, 'wb')
+        self._file.write(f"P6\n{width} {height}\n255\n".encode('ascii'))
+
+    def write(self, image):
+        self._file.write(image.tobytes())
+
+    def close(self):
+        self._file.close()
+
+
+def level_count(width, height):
+    """倍率の段数（Deep Zoom では 1×1 ピクセルが倍率 0）"""
+    return int(math.ceil(math.log2(max(width, height)))) + 1
+
+
+def _tile_key(digest, page, level, col, row):
+    return f"tiles/{digest}/{page}/{level}/{col}_{row}.jpg"
+
+
+def build_pyramid(ppm_path, digest, page, backend, work_dir):
+    """
+    PPM からタイルのピラミッドを作って保存する
+
+    Returns:
+        tuple: (幅, 高さ, タイル数)
+    """
+    reader = _PPMReader(ppm_path)
+    width, height = reader.width, reader.height
+    level = level_count(width, height) - 1
+    tiles = 0
+    size, overlap = TILE_SIZE, TILE_OVERLAP
+    previous = None
+    try:
+        while True:
+            w, h = reader.width, reader.height
+            writer = None
+            if level > 0:
+                writer = _PPMWriter(os.path.join(work_dir, f"level_{level - 1}.ppm"), (w + 1) // 2, (h + 1) // 2)
+            for row in range(math.ceil(h / size)):
+                top, bottom = row * size, min(h, (row + 1) * size)
+                band_top, band_bottom = max(0, top - overlap), min(h, bottom + overlap)
+                band = reader.rows(band_top, band_bottom)
+                for col in range(math.ceil(w / size)):
+                    left, right = col * size, min(w, (col + 1) * size)
+                    tile = band.crop((max(0, left - overlap), 0, min(w, right + overlap), band_bottom - band_top))
+                    buffered = io.BytesIO()
+                    tile.save(buffered, format='JPEG', quality=TILE_QUALITY)
+                    buffered.seek(0)
+                    backend.put(_tile_key(digest, page, level, col, row), buffered, 'jpg')
+                    tiles += 1
+                if writer:
+                    # TILE_SIZE は偶数なので、帯ごとに縮小してつなげても全体を縮小したのと同じ大きさになる
+                    core = band.crop((0, top - band_top, w, bottom - band_top))
+                    writer.write(core.reduce(2))
+            reader.close()
+            if previous:
+                os.remove(previous)
+            if writer is None:
+                break
+            writer.close()
+            previous = writer.path
+            reader = _PPMReader(writer.path)
+            level -= 1
+    finally:
+        reader.close()
+    return width, height, tiles
+
+
+# ===========================
+# 作成の状態
+# ===========================
+def _claim(cur, digest, page, page_count):
+    """ページのタイル作成を引き受ける（他のワーカーが作成中・作成済みなら False）"""
+    cur.execute('''
+        INSERT INTO "T_設計図タイル" ("content_hash", "ページ", "ページ数", "状態", "保存先")
+        VALUES (%s, %s, %s, 'building', %s)
+        ON CONFLICT ("content_hash", "ページ") DO UPDATE
+        SET "状態" = 'building', "エラー" = NULL, "保存先" = EXCLUDED."保存先", "更新日時" = CURRENT_TIMESTAMP
+        WHERE "T_設計図タイル"."状態" <> 'ready'
+          AND "T_設計図タイル"."更新日時" < CURRENT_TIMESTAMP - make_interval(secs => %s)
+        RETURNING "ページ"
+    ''', (digest, page, page_count, TILE_STORAGE_BACKEND, TILE_STALE_SECONDS))
+    return cur.fetchone() is not None
+
+
+def _finish(cur, digest, page, state, width=None, height=None, error=None):
+    cur.execute('''
+        UPDATE "T_設計図タイル"
+        SET "状態" = %s, "幅" = %s, "高さ" = %s, "タイルサイズ" = %s, "重なり" = %s,
+            "エラー" = %s, "更新日時" = CURRENT_TIMESTAMP
+        WHERE "content_hash" = %s AND "ページ" = %s
+    ''', (state, width, height, TILE_SIZE, TILE_OVERLAP, error, digest, page))
+
+
+def pages(cur, digest):
+    """
+    作成の状態（ページ順）
+
+    Returns:
+        list: [{'page', 'page_count', 'state', 'width', 'height', 'tile_size', 'overlap', 'backend'}]
+    """
+    cur.execute('''
+        SELECT "ページ", "ページ数", "状態", "幅", "高さ", "タイルサイズ", "重なり", "保存先"
+        FROM "T_設計図タイル"
+        WHERE "content_hash" = %s
+        ORDER BY "ページ"
+    ''', (digest,))
+    keys = ('page', 'page_count', 'state', 'width', 'height', 'tile_size', 'overlap', 'backend')
+    return [dict(zip(keys, row)) for row in cur.fetchall()]
+
+
+def read_tile(info, digest, level, col, row):
+    """
+    タイル1枚のJPEG
+
+    Raises:
+        FileNotFoundError: 範囲外などでタイルが無い場合（ローカル）
+    """
+    backend = storage.get_backend(info['backend'])
+    return backend.read(backend.locate(_tile_key(digest, info['page'], level, col, row)))
+
+
+def descriptor(info):
+    """Deep Zoom の .dzi（XML）"""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{info["tile_size"]}" '
+        f'Overlap="{info["overlap"]}" Format="jpg">'
+        f'<Size Width="{info["width"]}" Height="{info["height"]}"/></Image>\n'
+    )
+
+
+# ===========================
+# 作成（バックグラウンド）
+# ===========================
+def _rasterize_pdf_page(pdf_path, page, work_dir):
+    """PDF の1ページを PPM に書き出す（pdftoppm が直接ファイルに書くのでメモリに展開しない）"""
+    from pdf2image import convert_from_path
+    paths = convert_from_path(pdf_path, dpi=TILE_PDF_DPI, first_page=page, last_page=page,
+                              output_folder=work_dir, fmt='ppm', paths_only=True)
+    return paths[0]
+
+
+def _image_to_ppm(image_path, work_dir):
+    """画像を RGB の PPM に変換する（デコードのため画像1枚分のメモリは使う）"""
+    with Image.open(image_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            background = Image.new('RGB', image.size, 'white')
+            rgba = image.convert('RGBA')
+            background.paste(rgba, mask=rgba.getchannel('A'))
+            image = background
+        ppm_path = os.path.join(work_dir, 'source.ppm')
+        image.save(ppm_path, format='PPM')
+    return ppm_path
+
+
+def build(digest, source, file_ext):
+    """
+    設計図の全ページのタイルを作る（作成中・作成済みのページは飛ばす）
+    """
+    from app.utils.db import get_db_connection
+
+    work_dir = tempfile.mkdtemp(prefix='tiles_', dir=TILE_WORK_DIR)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # 元ファイルも少しずつ読んでディスクに置く
+        source_path = os.path.join(work_dir, f"source.{file_ext}")
+        stream = storage.open_stream(source)
+        try:
+            with open(source_path, 'wb') as f:
+                shutil.copyfileobj(stream, f, 1024 * 1024)
+        finally:
+            stream.close()
+
+        if file_ext == 'pdf':
+            from pdf2image import pdfinfo_from_path
+            page_count = pdfinfo_from_path(source_path)['Pages']
+        else:
+            page_count = 1
+
+        backend = storage.get_backend(TILE_STORAGE_BACKEND)
+        for page in range(1, page_count + 1):
+            if not _claim(cur, digest, page, page_count):
+                conn.rollback()
+                continue
+            conn.commit()
+            page_dir = tempfile.mkdtemp(dir=work_dir)
+            try:
+                if file_ext == 'pdf':
+                    ppm_path = _rasterize_pdf_page(source_path, page, page_dir)
+                else:
+                    ppm_path = _image_to_ppm(source_path, page_dir)
+                width, height, count = build_pyramid(ppm_path, digest, page, backend, page_dir)
+                _finish(cur, digest, page, READY, width, height)
+                inc_counter('tiles_written_total', count)
+                logger.info(f"タイルを作成しました: {digest[:12]} p{page} {width}x{height} {count}枚")
+            except Exception as e:
+                logger.warning(f"タイルを作成できませんでした: {digest[:12]} p{page} {e}")
+                _finish(cur, digest, page, FAILED, error=str(e)[:500])
+            finally:
+                shutil.rmtree(page_dir, ignore_errors=True)
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"タイルを作成できませんでした: {digest[:12]} {e}")
+    finally:
+        cur.close()
+        conn.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def schedule(digest, source, file_ext, force=False):
+    """
+    タイルをバックグラウンドで作る
+
+    Args:
+        force: TILE_PRECOMPUTE=0 でも作る（表示しようとしたとき）
+    """
+    global _executor, _executor_pid
+    if (not TILE_PRECOMPUTE and not force) or Image is None:
+        return
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                # CPU を多く使うので1ワーカーに1スレッド
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tiles')
+                _executor_pid = os.getpid()
+    _executor.submit(build, digest, source, file_ext)
+
+
+def sweep(cur, grace_hours, digests=None):
+    """
+    実体が無くなったタイルの行を削除する（保存先のタイルは呼び出し側で remove で削除）
+
+    digests（同じトランザクションで削除した実体）のタイルは経過時間に関係なく対象にします。
+
+    Returns:
+        list: 削除した (content_hash, ページ, 保存先)
+    """
+    cur.execute('''
+        DELETE FROM "T_設計図タイル" t
+        WHERE NOT EXISTS (SELECT 1 FROM "T_設計図ブロブ" b WHERE b."content_hash" = t."content_hash")
+          AND (t."更新日時" < CURRENT_TIMESTAMP - make_interval(secs => %s) OR t."content_hash" = ANY(%s))
+        RETURNING "content_hash", "ページ", "保存先"
+    ''', (grace_hours * 3600, list(digests or [])))
+    return cur.fetchall()
+
+
+def remove(digest, page, backend_name):
+    """ページのタイルを保存先から削除する"""
+    storage.get_backend(backend_name).delete_prefix(f"tiles/{digest}/{page}/")
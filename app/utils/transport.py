@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+外部サービス（OpenAI・Cloudinary）の通信の差し替え（記録・再生）
+
+TRANSPORT_MODE で切り替えます。
+
+    live   : そのまま通信する（既定）
+    record : 通信して、リクエストと応答の組を TRANSPORT_CASSETTE_DIR に保存する
+    replay : 通信せず、保存した応答を返す（TRANSPORT_REPLAY_LATENCY の分だけ待つ）
+
+保存のキーはリクエスト内容の SHA-256 です（Cloudinary のアップロードは
+ファイル内容とオプション、public_id の自動見積もりIDと日時の部分は除く）。画像の縮小・再エンコードは
+決定的なので、同じ図面を同じ設定で流せば記録時と同じキーになります。
+
+どのモードでもサービスごとの送信バイト数を数え、stats() で返します
+（ベンチマーク用、/metrics の external_bytes_sent_total にも加算）。
+
+実際に通信する呼び出しはサービスごとのサーキットブレーカー（app/utils/resilience.py）で囲みます。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.request
+from types import SimpleNamespace
+
+from app.utils.metrics import inc_counter
+from app.utils.resilience import breaker, cloudinary_timeout
+
+logger = logging.getLogger(__name__)
+
+MODE = os.getenv('TRANSPORT_MODE', 'live').lower()
+CASSETTE_DIR = os.getenv('TRANSPORT_CASSETTE_DIR', os.path.join('instance', 'cassettes'))
+# 再生時の待ち時間: "recorded"（記録時の所要時間）、秒数、または "openai=1.5,cloudinary=0.2"
+REPLAY_LATENCY = os.getenv('TRANSPORT_REPLAY_LATENCY', 'recorded')
+
+# これより大きいファイルは Cloudinary に分割して送る（upload_large）
+CLOUDINARY_LARGE_UPLOAD_BYTES = int(os.getenv('CLOUDINARY_LARGE_UPLOAD_BYTES', str(20 * 1024 * 1024)))
+
+_CHUNK_SIZE = 1024 * 1024
+
+# public_id の先頭の "<自動見積もりID>_<日時>_"（実行ごとに変わる部分）
+_UNIQUE_PREFIX_RE = re.compile(r'(^|/)\d+_\d{8}_\d{6}_')
+
+
+class CassetteNotFound(Exception):
+    """再生モードで記録が見つからない（再試行しても変わらない）"""
+    status_code = 404
+
+
+# ===========================
+# 送信量の集計
+# ===========================
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _count(service, sent, received):
+    with _stats_lock:
+        entry = _stats.setdefault(service, {'calls': 0, 'bytes_sent': 0, 'bytes_received': 0})
+        entry['calls'] += 1
+        entry['bytes_sent'] += sent
+        entry['bytes_received'] += received
+    inc_counter('external_bytes_sent_total', sent, service=service)
+
+
+def stats():
+    """サービスごとの {'calls', 'bytes_sent', 'bytes_received'}"""
+    with _stats_lock:
+        return {service: dict(entry) for service, entry in _stats.items()}
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+# ===========================
+# 記録の保存・読み込み
+# ===========================
+def _key(payload):
+    data = payload if isinstance(payload, bytes) else json.dumps(payload, sort_keys=True, ensure_ascii=False,
+                                                                 default=str).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _path(service, key, ext='json'):
+    return os.path.join(CASSETTE_DIR, service, f"{key}.{ext}")
+
+
+def _latency(service, recorded):
+    value = REPLAY_LATENCY.strip()
+    if value == 'recorded':
+        return recorded
+    if '=' in value:
+        for part in value.split(','):
+            name, _, seconds = part.partition('=')
+            if name.strip() == service:
+                return float(seconds)
+        return 0.0
+    return float(value)
+
+
+def _save(service, key, request_summary, response, elapsed, body=None):
+    os.makedirs(os.path.join(CASSETTE_DIR, service), exist_ok=True)
+    if body is not None:
+        with open(_path(service, key, 'bin'), 'wb') as f:
+            f.write(body)
+    tmp_path = _path(service, key) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'request': request_summary, 'response': response, 'elapsed': elapsed},
+                  f, ensure_ascii=False, indent=1, default=str)
+    os.replace(tmp_path, _path(service, key))
+
+
+def _load(service, key, body=False):
+    path = _path(service, key)
+    if not os.path.exists(path):
+        raise CassetteNotFound(f"{service} の記録がありません: {key[:12]}（TRANSPORT_MODE=record で記録してください）")
+    with open(path, encoding='utf-8') as f:
+        cassette = json.load(f)
+    time.sleep(_latency(service, cassette.get('elapsed') or 0.0))
+    if body:
+        with open(_path(service, key, 'bin'), 'rb') as f:
+            return cassette, f.read()
+    return cassette, None
+
+
+def _to_namespace(value):
+    if isinstance(value, dict):
+        return SimpleNamespace(**{k: _to_namespace(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_to_namespace(v) for v in value]
+    return value
+
+
+# ===========================
+# OpenAI
+# ===========================
+class _Completions:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, **kwargs):
+        body = json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+        key = _key(body)
+
+        if MODE == 'replay':
+            cassette, _ = _load('openai', key)
+            response = cassette['response']
+            result = _to_namespace(response)
+        else:
+            start = time.perf_counter()
+            with breaker('openai').guard():
+                result = self._client.chat.completions.create(**kwargs)
+            elapsed = time.perf_counter() - start
+            response = result.model_dump()
+            if MODE == 'record':
+                _save('openai', key, {'model': kwargs.get('model'), 'bytes': len(body)}, response, elapsed)
+        _count('openai', len(body), len(json.dumps(response, default=str)))
+        return result
+
+
+class OpenAITransport:
+    """OpenAI クライアントの chat.completions.create だけを差し替えたもの"""
+
+    def __init__(self, client):
+        self._client = client
+        self.chat = SimpleNamespace(completions=_Completions(client))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def wrap_openai(client):
+    """
+    OpenAI クライアントを包む（replay では client が None でもよい）
+    """
+    return OpenAITransport(client)
+
+
+# ===========================
+# Cloudinary
+# ===========================
+class _KeepOpen:
+    """upload_large が送信後に閉じても、呼び出し側のファイルは閉じない"""
+
+    def __init__(self, file):
+        self._file = file
+        self.name = 'blueprint'
+
+    def __getattr__(self, name):
+        # read / tell / seek（upload_large は tell と seek で全体のサイズを測る）は元のファイルのもの
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def upload(file, **options):
+    """
+    cloudinary.uploader.upload の代わり
+
+    ファイルは少しずつ読んでハッシュを計算し、CLOUDINARY_LARGE_UPLOAD_BYTES より大きい
+    ものは upload_large で分割して送ります（全体をメモリに読み込まない）。
+
+    Args:
+        file: ファイルオブジェクト（FileStorage など、read() / seek() できるもの）
+    """
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    size = file.tell()
+    file.seek(0)
+    stable = dict(options)
+    if 'public_id' in stable:
+        stable['public_id'] = _UNIQUE_PREFIX_RE.sub(r'\1', str(stable['public_id']))
+    key = _key({'sha256': digest.hexdigest(), 'options': stable})
+
+    if MODE == 'replay':
+        cassette, _ = _load('cloudinary', key)
+        response = cassette['response']
+    else:
+        import cloudinary.uploader
+        start = time.perf_counter()
+        with breaker('cloudinary').guard():
+            if size > CLOUDINARY_LARGE_UPLOAD_BYTES:
+                response = cloudinary.uploader.upload_large(_KeepOpen(file), timeout=cloudinary_timeout(), **options)
+            else:
+                response = cloudinary.uploader.upload(file, timeout=cloudinary_timeout(), **options)
+        if MODE == 'record':
+            _save('cloudinary', key, {'bytes': size, 'options': stable}, response, time.perf_counter() - start)
+    _count('cloudinary', size, 0)
+    return response
+
+
+def destroy(public_id, **options):
+    """cloudinary.uploader.destroy の代わり（replay では何もしない）"""
+    if MODE == 'replay':
+        return {'result': 'ok'}
+    import cloudinary.uploader
+    with breaker('cloudinary').guard():
+        return cloudinary.uploader.destroy(public_id, timeout=cloudinary_timeout(), **options)
+
+
+def fetch(url, timeout):
+    """URL の内容を取得する（Cloudinary に保存した設計図の再取得など）"""
+    key = _key(url.encode('utf-8'))
+    if MODE == 'replay':
+        _, body = _load('http', key, body=True)
+    else:
+        start = time.perf_counter()
+        # 設計図のURLは Cloudinary のもの
+        with breaker('cloudinary').guard(), urllib.request.urlopen(url, timeout=timeout) as response:
+            body = response.read()
+        if MODE == 'record':
+            _save('http', key, {'url': url}, None, time.perf_counter() - start, body=body)
+    _count('http', len(url), len(body))
+    return body
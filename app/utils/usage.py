@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+OpenAI の利用量の記録（テナント別の利用台帳）とテナント別のレート制限
+
+metered() で包んだクライアントは chat.completions.create のたびに
+
+    1. テナントのトークンバケットから1つ取り出す（空なら補充されるまで待つ）
+    2. 呼び出して、モデル・トークン数・所要時間・待ち時間を T_AI利用履歴 に記録する
+
+台帳への書き込みはキューに積むだけで、バックグラウンドのスレッドが
+USAGE_FLUSH_INTERVAL 秒ごと（または USAGE_BATCH_SIZE 件たまったら）まとめて INSERT します。
+
+レート制限は1テナントの大きなPDFが全ワーカーの OpenAI 呼び出しを占有しないためのもので、
+ピーク時の速度より公平さを優先します。バケットはワーカープロセスごとなので、
+全体の上限は おおよそ RATE_LIMIT_PER_MINUTE × ワーカー数 です。
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from app.utils.db import get_db_connection, _sql
+from app.utils.metrics import inc_counter
+
+logger = logging.getLogger(__name__)
+
+LEDGER_ENABLED = os.getenv('USAGE_LEDGER_ENABLED', '1') != '0'
+FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', '2.0'))
+BATCH_SIZE = int(os.getenv('USAGE_BATCH_SIZE', '100'))
+# 書き込み待ちの上限（DBに書けない間はこれを超えた分を捨てる）
+QUEUE_MAX = int(os.getenv('USAGE_QUEUE_MAX', '10000'))
+
+# テナントあたりの1分間の呼び出し回数（0 で制限なし）と、まとめて使える回数
+RATE_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', '20'))
+RATE_BURST = float(os.getenv('RATE_LIMIT_BURST', '5'))
+# テナント別の上書き: "3=60,7=10"（テナントID=1分間の回数）
+RATE_OVERRIDES = os.getenv('RATE_LIMIT_TENANT_OVERRIDES', '')
+# これ以上待つ必要がある場合は待たずに RateLimited にする（秒）
+MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '60'))
+
+# 100万トークンあたりの料金（USD、入力・出力）。レポートの概算費用に使う
+MODEL_PRICES = {
+    'gpt-4.1': (2.00, 8.00),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gpt-4.1-nano': (0.10, 0.40),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+}
+
+
+class RateLimited(Exception):
+    """テナントの呼び出し回数の上限に達した（MAX_WAIT 以内に順番が来ない）"""
+    status_code = 429
+    # 抽出の再試行で待ち直しても、同じテナントの順番待ちが長くなるだけ
+    retryable = False
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """概算費用（USD、料金表に無いモデルは 0）"""
+    price_in, price_out = MODEL_PRICES.get(model or '', (0.0, 0.0))
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+
+# ===========================
+# テナント別のトークンバケット
+# ===========================
+class TokenBucket:
+    """
+    呼び出し回数のトークンバケット（スレッド間で共有可）
+
+    reserve() は先に取り出して（残りがマイナスになってもよい）待つべき秒数を返すので、
+    同じテナントの呼び出しは到着順に間隔を空けて通ります。
+    """
+
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, cost=1.0):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, cost=1.0):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + cost)
+
+
+def _parse_overrides(value):
+    overrides = {}
+    for part in filter(None, (p.strip() for p in value.split(','))):
+        tenant_id, _, per_minute = part.partition('=')
+        try:
+            overrides[int(tenant_id)] = float(per_minute)
+        except ValueError:
+            logger.warning(f"RATE_LIMIT_TENANT_OVERRIDES の指定が不正です: {part}")
+    return overrides
+
+
+_overrides = _parse_overrides(RATE_OVERRIDES)
+_buckets = {}       # tenant_id -> TokenBucket
+_buckets_lock = threading.Lock()
+
+
+def _bucket(tenant_id):
+    bucket = _buckets.get(tenant_id)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.get(tenant_id)
+            if bucket is None:
+                bucket = TokenBucket(_overrides.get(tenant_id, RATE_PER_MINUTE), RATE_BURST)
+                _buckets[tenant_id] = bucket
+    return bucket
+
+
+def acquire(tenant_id):
+    """
+    テナントの順番が来るまで待つ
+
+    Returns:
+        float: 待った秒数
+
+    Raises:
+        RateLimited: MAX_WAIT を超えて待つ必要がある場合
+    """
+    if _overrides.get(tenant_id, RATE_PER_MINUTE) <= 0:
+        return 0.0
+    bucket = _bucket(tenant_id)
+    wait = bucket.reserve()
+    if wait > MAX_WAIT:
+        bucket.refund()
+        raise RateLimited(f"AI解析の呼び出しが混み合っています（約{int(wait)}秒待ち）。しばらくしてから再度お試しください")
+    if wait > 0:
+        inc_counter('rate_limit_wait_seconds_total', wait, service='openai')
+        time.sleep(wait)
+    return wait
+
+
+# ===========================
+# 利用台帳（まとめて非同期に書き込む）
+# ===========================
+_COLUMNS = ('テナントID', '店舗ID', '自動見積もりID', 'サービス', 'モデル',
+            '入力トークン', '出力トークン', '所要時間', '待ち時間', '結果', '作成日時')
+
+_queue = queue.Queue(maxsize=QUEUE_MAX)
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+_stopping = threading.Event()
+
+
+def record(tenant_id, model, prompt_tokens=0, completion_tokens=0, seconds=0.0, wait=0.0,
+           status='ok', store_id=None, auto_estimate_id=None, service='openai'):
+    """利用を1件記録する（キューに積むだけ）"""
+    inc_counter('ai_tokens_total', prompt_tokens, service=service, kind='prompt')
+    inc_counter('ai_tokens_total', completion_tokens, service=service, kind='completion')
+    if not LEDGER_ENABLED:
+        return
+    _ensure_writer()
+    row = (tenant_id, store_id, auto_estimate_id, service, model, int(prompt_tokens), int(completion_tokens),
+           round(seconds, 3), round(wait, 3), status, datetime.now())
+    try:
+        _queue.put_nowait(row)
+    except queue.Full:
+        logger.warning("AI利用履歴の書き込みが追いつかないため1件捨てました")
+
+
+def _ensure_writer():
+    """書き込みスレッドを起動（gunicorn の fork 後はワーカーごとに起動し直す）"""
+    global _writer, _writer_pid
+    if _writer is not None and _writer_pid == os.getpid() and _writer.is_alive():
+        return
+    with _writer_lock:
+        if _writer is not None and _writer_pid == os.getpid() and _writer.is_alive():
+            return
+        _writer = threading.Thread(target=_write_loop, name='usage-ledger', daemon=True)
+        _writer_pid = os.getpid()
+        _writer.start()
+
+
+def _write_batch(rows):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.executemany(_sql(conn,
+            'INSERT INTO "T_AI利用履歴" (' + ', '.join(f'"{c}"' for c in _COLUMNS) + ') '
+            'VALUES (' + ', '.join(['%s'] * len(_COLUMNS)) + ')'
+        ), rows)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"AI利用履歴の書き込みエラー（{len(rows)}件を破棄）: {e}")
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _drain(rows, limit):
+    while len(rows) < limit:
+        try:
+            rows.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return rows
+
+
+def _write_loop():
+    while not _stopping.is_set():
+        try:
+            rows = [_queue.get(timeout=FLUSH_INTERVAL)]
+        except queue.Empty:
+            continue
+        # 最初の1件から FLUSH_INTERVAL の間に来た分をまとめる
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while len(rows) < BATCH_SIZE and not _stopping.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _write_batch(_drain(rows, BATCH_SIZE))
+
+
+def flush():
+    """キューに残っている分を呼び出し元のスレッドで書き込む（終了時・スクリプト用）"""
+    while True:
+        rows = _drain([], BATCH_SIZE)
+        if not rows:
+            return
+        _write_batch(rows)
+
+
+def _shutdown():
+    _stopping.set()
+    try:
+        flush()
+    except Exception as e:
+        logger.warning(f"AI利用履歴の書き込みエラー（終了時）: {e}")
+
+
+atexit.register(_shutdown)
+
+
+# ===========================
+# クライアントの計測
+# ===========================
+class _MeteredCompletions:
+    def __init__(self, completions, context):
+        self._completions = completions
+        self._context = context
+
+    def create(self, **kwargs):
+        model = kwargs.get('model')
+        try:
+            wait = acquire(self._context['tenant_id'])
+        except RateLimited:
+            record(model=model, status='rate_limited', **self._context)
+            raise
+        start = time.perf_counter()
+        status = 'ok'
+        response = None
+        try:
+            response = self._completions.create(**kwargs)
+            return response
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            usage = getattr(response, 'usage', None)
+            record(model=getattr(response, 'model', None) or model,
+                   prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+                   completion_tokens=getattr(usage, 'completion_tokens', 0) or 0,
+                   seconds=time.perf_counter() - start, wait=wait, status=status, **self._context)
+
+
+class MeteredClient:
+    """chat.completions.create を計測・レート制限するクライアント（他の属性はそのまま）"""
+
+    def __init__(self, client, tenant_id, store_id=None, auto_estimate_id=None):
+        self._client = client
+        context = {'tenant_id': tenant_id, 'store_id': store_id, 'auto_estimate_id': auto_estimate_id}
+        self.chat = SimpleNamespace(completions=_MeteredCompletions(client.chat.completions, context))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def metered(client, tenant_id, store_id=None, auto_estimate_id=None):
+    """
+    OpenAI クライアントをテナントの利用台帳・レート制限に掛ける
+
+    解析スレッドなどリクエスト外でも使えるよう、テナント・店舗は呼び出し時に渡します。
+    """
+    if client is None:
+        return None
+    return MeteredClient(client, tenant_id, store_id, auto_estimate_id)
+
+
+# ===========================
+# レポート
+# ===========================
+def _since(days):
+    return datetime.now() - timedelta(days=days)
+
+
+def _with_cost(rows, keys):
+    """[(keys..., モデル, 回数, 入力, 出力, 所要時間, 待ち時間, 失敗)] をキーごとに合算して費用を付ける"""
+    summary = {}
+    for row in rows:
+        key = row[:len(keys)]
+        model, calls, prompt_tokens, completion_tokens, seconds, wait, failed = row[len(keys):]
+        entry = summary.setdefault(key, dict(zip(keys, key), calls=0, prompt_tokens=0, completion_tokens=0,
+                                             seconds=0.0, wait_seconds=0.0, failed=0, cost_usd=0.0))
+        entry['calls'] += calls or 0
+        entry['prompt_tokens'] += prompt_tokens or 0
+        entry['completion_tokens'] += completion_tokens or 0
+        entry['seconds'] += float(seconds or 0)
+        entry['wait_seconds'] += float(wait or 0)
+        entry['failed'] += failed or 0
+        entry['cost_usd'] += estimate_cost(model, prompt_tokens or 0, completion_tokens or 0)
+    return list(summary.values())
+
+
+_AGGREGATES = '''
+    "モデル", COUNT(*), SUM("入力トークン"), SUM("出力トークン"), SUM("所要時間"), SUM("待ち時間"),
+    SUM(CASE WHEN "結果" = 'ok' THEN 0 ELSE 1 END)
+'''
+
+
+def tenant_report(conn, tenant_id, days=30):
+    """
+    テナントの利用状況（日別・モデル別）
+
+    Returns:
+        dict: {'daily': [{'day', 'calls', 'prompt_tokens', 'completion_tokens', 'seconds',
+                          'wait_seconds', 'failed', 'cost_usd'}], 'models': [{'model', ...}]}
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(_sql(conn,
+            'SELECT DATE("作成日時"), ' + _AGGREGATES + ' FROM "T_AI利用履歴" '
+            'WHERE "テナントID" = %s AND "作成日時" >= %s GROUP BY DATE("作成日時"), "モデル"'
+        ), (tenant_id, _since(days)))
+        daily = _with_cost(cur.fetchall(), ('day',))
+        cur.execute(_sql(conn,
+            'SELECT "モデル", ' + _AGGREGATES + ' FROM "T_AI利用履歴" '
+            'WHERE "テナントID" = %s AND "作成日時" >= %s GROUP BY "モデル"'
+        ), (tenant_id, _since(days)))
+        models = _with_cost(cur.fetchall(), ('model',))
+    finally:
+        cur.close()
+    daily.sort(key=lambda r: str(r['day']), reverse=True)
+    models.sort(key=lambda r: -r['cost_usd'])
+    return {'daily': daily, 'models': models}
+
+
+def system_report(conn, days=30):
+    """
+    全テナントの利用状況（テナント別、費用の多い順）
+
+    Returns:
+        list: [{'tenant_id', 'tenant_name', 'calls', 'prompt_tokens', ..., 'cost_usd'}]
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(_sql(conn,
+            'SELECT u."テナントID", t."名称", ' + _AGGREGATES +
+            ' FROM "T_AI利用履歴" u LEFT JOIN "T_テナント" t ON t."id" = u."テナントID" '
+            'WHERE u."作成日時" >= %s GROUP BY u."テナントID", t."名称", u."モデル"'
+        ), (_since(days),))
+        tenants = _with_cost(cur.fetchall(), ('tenant_id', 'tenant_name'))
+    finally:
+        cur.close()
+    tenants.sort(key=lambda r: (-r['cost_usd'], -r['calls']))
+    return tenants
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+自動見積もり（設計図のAI解析）のベンチマーク
+
+サンプル図面のフォルダを、アップロード → 画像変換 → AI解析 → 明細の保存 の
+一連の処理（/auto_estimate/new と解析ストリーム）に通し、図面ごとの
+所要時間・ピークRSS・送信バイト数を表示します。
+
+OpenAI・Cloudinary との通信は app/utils/transport.py で記録・再生できます。
+
+    # 1回目: 実際に通信して応答を記録（APIキーと Cloudinary の設定が必要）
+    python benchmark_auto_estimate.py samples/ --mode record
+
+    # 以降: 記録から再生（記録時の所要時間だけ待つ / --latency 0 で待たない）
+    python benchmark_auto_estimate.py samples/
+    python benchmark_auto_estimate.py samples/ --latency openai=2.0,cloudinary=0.3
+
+ピークRSSを図面ごとに分けるため、既定では図面ごとに子プロセスで実行します。
+作成した自動見積もりのレコードは終了時に削除します（--keep で残す）。
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+# アプリケーションのルートディレクトリをパスに追加
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.gif')
+
+
+def run_drawing(path, tenant_id, keep=False):
+    """
+    1図面を処理して計測結果を返す（TRANSPORT_* は呼び出し前に環境変数で設定しておく）
+    """
+    from app import create_app
+    from app.utils import transport
+
+    app = create_app()
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['tenant_id'] = tenant_id
+        sess['role'] = 'tenant_admin'
+
+    transport.reset_stats()
+    filename = os.path.basename(path)
+    start = time.perf_counter()
+
+    # アップロード（自動見積もりの作成）
+    with open(path, 'rb') as f:
+        response = client.post('/auto_estimate/new', data={
+            'customer_name': f'benchmark {filename}',
+            'blueprint_files': (f, filename),
+        }, content_type='multipart/form-data')
+    m = re.search(r'/auto_estimate/analyze/(\d+)', response.headers.get('Location', ''))
+    if not m:
+        raise RuntimeError(f"アップロードに失敗しました: {filename}（HTTP {response.status_code}）")
+    auto_estimate_id = int(m.group(1))
+    uploaded = time.perf_counter()
+
+    # 画像変換・AI解析・明細の保存（進捗ストリームを最後まで読む）
+    events = {}
+    items = 0
+    first_item = None
+    response = client.get(f'/auto_estimate/api/analyze/{auto_estimate_id}/stream')
+    for chunk in response.response:
+        text = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+        for block in text.split('\n\n'):
+            lines = dict(line.split(': ', 1) for line in block.split('\n') if ': ' in line and not line.startswith(':'))
+            if 'event' not in lines:
+                continue
+            data = json.loads(lines.get('data', '{}'))
+            name = lines['event'] if lines['event'] != 'page' else f"page:{data.get('stage')}"
+            events[name] = events.get(name, 0) + 1
+            if name == 'page:parsed' and data.get('items'):
+                items += len(data['items'])
+                first_item = first_item or time.perf_counter()
+            if name == 'analysis_error':
+                raise RuntimeError(f"解析に失敗しました: {filename} {data.get('error')}")
+    finished = time.perf_counter()
+
+    if not keep:
+        _cleanup(auto_estimate_id)
+
+    return {
+        'file': filename,
+        'file_bytes': os.path.getsize(path),
+        'upload_seconds': round(uploaded - start, 3),
+        'analyze_seconds': round(finished - uploaded, 3),
+        'first_item_seconds': round(first_item - start, 3) if first_item else None,
+        'wall_seconds': round(finished - start, 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'items': items,
+        'events': events,
+        'transport': transport.stats(),
+    }
+
+
+def _cleanup(auto_estimate_id):
+    from app.utils import blob_store
+    from app.utils.db import get_db_connection
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        blob_store.release(cur, auto_estimate_id)
+        for table in ('T_自動見積もり明細', 'T_設計図ファイル'):
+            cur.execute(f'DELETE FROM "{table}" WHERE "自動見積もりID" = %s', (auto_estimate_id,))
+        cur.execute('DELETE FROM "T_自動見積もり" WHERE "ID" = %s', (auto_estimate_id,))
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _run_isolated(path, args):
+    """子プロセスで1図面を実行（ピークRSSを図面ごとに分ける）"""
+    command = [sys.executable, os.path.abspath(__file__), '--worker', path, '--tenant-id', str(args.tenant_id)]
+    if args.keep:
+        command.append('--keep')
+    proc = subprocess.run(command, capture_output=True, text=True, env=os.environ.copy())
+    lines = [line for line in proc.stdout.splitlines() if line.startswith('{')]
+    if proc.returncode != 0 or not lines:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"終了コード {proc.returncode}")
+    return json.loads(lines[-1])
+
+
+def _sent(result, service):
+    return result['transport'].get(service, {}).get('bytes_sent', 0)
+
+
+def print_report(results):
+    print(f"{'図面':<32} {'サイズKB':>9} {'合計s':>7} {'UPs':>6} {'解析s':>7} {'初回明細s':>9} "
+          f"{'RSS MB':>7} {'OpenAI KB':>10} {'Cloud KB':>9} {'明細':>5}")
+    for r in results:
+        if 'error' in r:
+            print(f"{r['file']:<32} ❌ {r['error']}")
+            continue
+        first = f"{r['first_item_seconds']:.2f}" if r['first_item_seconds'] is not None else '-'
+        print(f"{r['file'][:32]:<32} {r['file_bytes'] / 1024:>9.0f} {r['wall_seconds']:>7.2f} "
+              f"{r['upload_seconds']:>6.2f} {r['analyze_seconds']:>7.2f} {first:>9} {r['peak_rss_mb']:>7.1f} "
+              f"{_sent(r, 'openai') / 1024:>10.0f} {_sent(r, 'cloudinary') / 1024:>9.0f} {r['items']:>5}")
+
+    ok = [r for r in results if 'error' not in r]
+    if ok:
+        walls = [r['wall_seconds'] for r in ok]
+        print(f"\n{len(ok)}図面: 合計 {sum(walls):.2f}s / 中央値 {statistics.median(walls):.2f}s / "
+              f"最大RSS {max(r['peak_rss_mb'] for r in ok):.1f}MB / "
+              f"OpenAI送信 {sum(_sent(r, 'openai') for r in ok) / 1024 / 1024:.2f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='自動見積もりのベンチマーク')
+    parser.add_argument('corpus', nargs='?', help='サンプル図面のフォルダ（またはファイル）')
+    parser.add_argument('--mode', choices=('replay', 'record', 'live'), default='replay')
+    parser.add_argument('--latency', help='再生時の待ち時間（recorded / 秒 / openai=1.5,cloudinary=0.2）')
+    parser.add_argument('--cassettes', help='記録の保存先（既定: TRANSPORT_CASSETTE_DIR）')
+    parser.add_argument('--tenant-id', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--json', help='結果をJSONで書き出すファイル')
+    parser.add_argument('--in-process', action='store_true', help='子プロセスを使わずに実行')
+    parser.add_argument('--keep', action='store_true', help='作成したレコードを削除しない')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_drawing(args.worker, args.tenant_id, args.keep), ensure_ascii=False))
+        return 0
+
+    if not args.corpus:
+        parser.print_help()
+        return 1
+
+    # 子プロセスにも引き継ぐため、app を読み込む前に環境変数で設定
+    os.environ['TRANSPORT_MODE'] = args.mode
+    if args.latency:
+        os.environ['TRANSPORT_REPLAY_LATENCY'] = args.latency
+    if args.cassettes:
+        os.environ['TRANSPORT_CASSETTE_DIR'] = args.cassettes
+
+    if os.path.isdir(args.corpus):
+        paths = sorted(os.path.join(args.corpus, name) for name in os.listdir(args.corpus)
+                       if name.lower().endswith(EXTENSIONS))
+    else:
+        paths = [args.corpus]
+    if not paths:
+        print(f"❌ 図面が見つかりません: {args.corpus}")
+        return 1
+
+    results = []
+    for _ in range(args.repeat):
+        for path in paths:
+            try:
+                if args.in_process:
+                    result = run_drawing(path, args.tenant_id, args.keep)
+                else:
+                    result = _run_isolated(path, args)
+            except Exception as e:
+                result = {'file': os.path.basename(path), 'error': str(e)}
+            results.append(result)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"✅ {args.json} に書き出しました")
+    return 0 if all('error' not in r for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
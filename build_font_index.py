@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+フォント計測インデックスを作成するスクリプト
+
+使い方:
+    python build_font_index.py <出力先.fmi> <フォント.ttf|.otf> [フォールバック ...]
+
+出力先を FONT_INDEX_DIR（既定: instance/fonts）に <名前>.fmi で置くと、
+見積もり作成画面の文字加工で文字幅と周長の自動入力に使われます。
+"""
+import os
+import sys
+
+# アプリケーションのルートディレクトリをパスに追加
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.utils.font_metrics import build_index
+
+
+def main(argv):
+    if len(argv) < 3:
+        print(__doc__)
+        return 1
+
+    output_path, font_paths = argv[1], argv[2:]
+    for path in font_paths:
+        if not os.path.exists(path):
+            print(f"❌ フォントが見つかりません: {path}")
+            return 1
+
+    count = build_index(output_path, font_paths)
+    size_kb = os.path.getsize(output_path) / 1024
+    print(f"✅ {output_path} を作成しました（{count}文字, {size_kb:.1f}KB）")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+明細抽出の精度・速度・コストの比較（ゴールデンセットによるオフライン評価）
+
+正解の明細を付けた図面のセットを、プロンプト・モデル・画像サイズの組み合わせ
+（バリアント）ごとに抽出し、明細単位の適合率・再現率・寸法誤差と、
+1ページあたりの応答時間・トークン数・費用を表にします。先頭のバリアントを基準に、
+精度を保ったまま最も速いバリアントを示します。
+
+ゴールデンセット（golden.json、図面のパスは golden.json からの相対パス）:
+
+    [
+      {"file": "shop_front.pdf",
+       "items": [{"material_name": "アルミ複合板 t3", "width": 1800, "height": 600, "quantity": 1}]}
+    ]
+
+バリアント（"名前:キー=値,..."、キーは model / prompt / max_edge / max_tokens / detail）:
+
+    python evaluate_extraction.py golden/golden.json \\
+        --variant "base:model=gpt-4.1-mini" \\
+        --variant "nano-1024:model=gpt-4.1-nano,max_edge=1024" \\
+        --variant "mini-low:model=gpt-4.1-mini,detail=low"
+
+通信は app/utils/transport.py を使います（--mode replay が既定、記録は --mode record）。
+--mode stub は正解の明細をそのまま返す応答で、評価の手順だけを確認できます。
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+# アプリケーションのルートディレクトリをパスに追加
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+VARIANT_KEYS = {'model': str, 'prompt': str, 'max_edge': int, 'max_tokens': int, 'detail': str}
+
+
+def parse_variant(spec):
+    """
+    "名前:model=gpt-4.1-nano,max_edge=1024" を dict に変換
+
+    Raises:
+        ValueError: 不明なキーの場合
+    """
+    name, _, options = spec.partition(':')
+    variant = {'name': name.strip()}
+    for option in filter(None, (o.strip() for o in options.split(','))):
+        key, _, value = option.partition('=')
+        key = key.strip()
+        if key not in VARIANT_KEYS:
+            raise ValueError(f"不明なキーです: {key}（{', '.join(VARIANT_KEYS)}）")
+        variant[key] = VARIANT_KEYS[key](value.strip())
+    return variant
+
+
+def load_golden(path):
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    for entry in entries:
+        entry['path'] = os.path.join(base, entry['file'])
+    return entries
+
+
+def render_pages(path, max_edge):
+    """図面をページ画像（PDF は PIL.Image、画像はバイト列）のリストにする"""
+    with open(path, 'rb') as f:
+        content = f.read()
+    if path.lower().endswith('.pdf'):
+        from pdf2image import convert_from_bytes
+        return convert_from_bytes(content, size=max_edge)
+    return [content]
+
+
+# ===========================
+# 採点
+# ===========================
+def _dimension_error(predicted, expected):
+    """幅・高さの相対誤差の大きい方（縦横が入れ替わっていても一致とみなす）"""
+    ew, eh = float(expected['width']), float(expected['height'])
+    pw, ph = float(predicted['width']), float(predicted['height'])
+    if ew <= 0 or eh <= 0:
+        return float('inf')
+    straight = max(abs(pw - ew) / ew, abs(ph - eh) / eh)
+    swapped = max(abs(ph - ew) / ew, abs(pw - eh) / eh)
+    return min(straight, swapped)
+
+
+def match_items(predicted, expected, tolerance):
+    """
+    予測と正解の明細を1対1で対応付ける（寸法誤差の小さい組から）
+
+    Returns:
+        list: [(予測, 正解, 寸法誤差)]
+    """
+    pairs = sorted(
+        (_dimension_error(p, e), i, j)
+        for i, p in enumerate(predicted) for j, e in enumerate(expected)
+    )
+    used_p, used_e, matches = set(), set(), []
+    for error, i, j in pairs:
+        if error > tolerance:
+            break
+        if i in used_p or j in used_e:
+            continue
+        used_p.add(i)
+        used_e.add(j)
+        matches.append((predicted[i], expected[j], error))
+    return matches
+
+
+def _same_material(a, b):
+    from app.utils.material_match import parse
+    return parse(a or '')[0] == parse(b or '')[0]
+
+
+# ===========================
+# スタブ（正解をそのまま返す）
+# ===========================
+class StubClient:
+    """図面ごとに正解の明細を1回だけ返すクライアント（オフラインで手順を確認する用）"""
+
+    def __init__(self):
+        self.pending = []
+        self.chat = SimpleNamespace(completions=self)
+
+    def load(self, items):
+        self.pending = list(items)
+
+    def create(self, **kwargs):
+        items, self.pending = self.pending, []
+        content = json.dumps({'customer_name': None, 'items': [
+            {'material_name': i.get('material_name', '不明'), 'width': i['width'], 'height': i['height'],
+             'quantity': i.get('quantity', 1), 'description': ''} for i in items
+        ]}, ensure_ascii=False)
+        prompt_bytes = len(json.dumps(kwargs, default=str))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(finish_reason='stop', message=SimpleNamespace(content=content, refusal=None))],
+            usage=SimpleNamespace(prompt_tokens=prompt_bytes // 4, completion_tokens=len(content) // 2),
+        )
+
+
+# ===========================
+# 評価
+# ===========================
+def evaluate(client, golden, variant, prices, tolerance):
+    from app.utils import extraction, image_payload
+
+    totals = {'expected': 0, 'predicted': 0, 'matched': 0, 'material_ok': 0, 'quantity_ok': 0,
+              'errors': [], 'latencies': [], 'prompt_tokens': 0, 'completion_tokens': 0, 'failed_pages': 0}
+    drawings = []
+    max_edge = variant.get('max_edge') or image_payload.MAX_EDGE
+    for entry in golden:
+        if isinstance(client, StubClient):
+            client.load(entry['items'])
+        predicted = []
+        for page in render_pages(entry['path'], max_edge):
+            payload = image_payload.optimize(page, os.path.splitext(entry['path'])[1].lstrip('.'), max_edge)
+            detail = variant.get('detail')
+            image_content = {'url': payload['url'], 'detail': payload['detail'] if detail in (None, 'auto') else detail}
+            start = time.perf_counter()
+            try:
+                result = extraction.extract_image(client, image_content, version=variant.get('prompt'),
+                                                  model=variant.get('model'), max_tokens=variant.get('max_tokens'))
+            except extraction.ExtractionError as e:
+                totals['failed_pages'] += 1
+                print(f"  ⚠️ {variant['name']} {entry['file']}: {e}", file=sys.stderr)
+                continue
+            finally:
+                totals['latencies'].append(time.perf_counter() - start)
+            predicted.extend(result['items'])
+            totals['prompt_tokens'] += result['usage']['prompt_tokens']
+            totals['completion_tokens'] += result['usage']['completion_tokens']
+
+        matches = match_items(predicted, entry['items'], tolerance)
+        totals['expected'] += len(entry['items'])
+        totals['predicted'] += len(predicted)
+        totals['matched'] += len(matches)
+        totals['errors'].extend(error for _, _, error in matches)
+        totals['material_ok'] += sum(_same_material(p['material_name'], e.get('material_name')) for p, e, _ in matches)
+        totals['quantity_ok'] += sum(int(p['quantity']) == int(e.get('quantity', 1)) for p, e, _ in matches)
+        drawings.append({'file': entry['file'], 'expected': len(entry['items']),
+                         'predicted': len(predicted), 'matched': len(matches)})
+
+    model = variant.get('model') or extraction.MODEL
+    price_in, price_out = prices.get(model, (0.0, 0.0))
+    precision = totals['matched'] / totals['predicted'] if totals['predicted'] else 0.0
+    recall = totals['matched'] / totals['expected'] if totals['expected'] else 0.0
+    latencies = sorted(totals['latencies']) or [0.0]
+    matched = totals['matched'] or 1
+    return {
+        'variant': variant,
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        'dimension_error': statistics.mean(totals['errors']) if totals['errors'] else None,
+        'material_accuracy': totals['material_ok'] / matched,
+        'quantity_accuracy': totals['quantity_ok'] / matched,
+        'latency_p50': statistics.median(latencies),
+        'latency_p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'pages': len(totals['latencies']),
+        'failed_pages': totals['failed_pages'],
+        'prompt_tokens': totals['prompt_tokens'],
+        'completion_tokens': totals['completion_tokens'],
+        'cost_usd': (totals['prompt_tokens'] * price_in + totals['completion_tokens'] * price_out) / 1_000_000,
+        'drawings': drawings,
+    }
+
+
+def recommend(results, max_drop):
+    """基準（先頭）から適合率・再現率の低下が max_drop 以内で、最も速いバリアント"""
+    base = results[0]
+    eligible = [r for r in results
+                if r['recall'] >= base['recall'] - max_drop and r['precision'] >= base['precision'] - max_drop]
+    return min(eligible, key=lambda r: (r['latency_p50'], r['cost_usd']))
+
+
+def print_report(results, drawing_count):
+    print(f"{'バリアント':<20} {'適合率':>6} {'再現率':>6} {'F1':>6} {'寸法誤差':>8} {'材質':>6} {'数量':>6} "
+          f"{'p50 s':>6} {'p95 s':>6} {'入力tok':>9} {'出力tok':>8} {'USD/図面':>9} {'失敗':>4}")
+    for r in results:
+        error = f"{r['dimension_error'] * 100:.1f}%" if r['dimension_error'] is not None else '-'
+        print(f"{r['variant']['name'][:20]:<20} {r['precision']:>6.2f} {r['recall']:>6.2f} {r['f1']:>6.2f} "
+              f"{error:>8} {r['material_accuracy']:>6.2f} {r['quantity_accuracy']:>6.2f} "
+              f"{r['latency_p50']:>6.2f} {r['latency_p95']:>6.2f} {r['prompt_tokens']:>9} "
+              f"{r['completion_tokens']:>8} {r['cost_usd'] / max(drawing_count, 1):>9.5f} {r['failed_pages']:>4}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='明細抽出のゴールデンセット評価')
+    parser.add_argument('golden', help='golden.json')
+    parser.add_argument('--variant', action='append', default=[], help='"名前:キー=値,..."（複数指定可、先頭が基準）')
+    parser.add_argument('--mode', choices=('replay', 'record', 'live', 'stub'), default='replay')
+    parser.add_argument('--latency', help='再生時の待ち時間（TRANSPORT_REPLAY_LATENCY）')
+    parser.add_argument('--cassettes', help='記録の保存先（TRANSPORT_CASSETTE_DIR）')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='寸法が一致とみなす相対誤差（既定 5%%）')
+    parser.add_argument('--max-drop', type=float, default=0.02, help='基準から許容する適合率・再現率の低下')
+    parser.add_argument('--prices', help='料金表のJSON {"モデル": [入力, 出力]}（USD / 100万トークン）')
+    parser.add_argument('--json', help='結果をJSONで書き出すファイル')
+    args = parser.parse_args()
+
+    # transport を読み込む前に設定
+    if args.mode != 'stub':
+        os.environ['TRANSPORT_MODE'] = args.mode
+    if args.latency:
+        os.environ['TRANSPORT_REPLAY_LATENCY'] = args.latency
+    if args.cassettes:
+        os.environ['TRANSPORT_CASSETTE_DIR'] = args.cassettes
+
+    from app.utils import transport
+    from app.utils.usage import MODEL_PRICES
+
+    try:
+        variants = [parse_variant(spec) for spec in args.variant] or [parse_variant('default')]
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    # 100万トークンあたりの料金（USD、入力・出力）
+    prices = dict(MODEL_PRICES)
+    if args.prices:
+        with open(args.prices, encoding='utf-8') as f:
+            prices.update({model: tuple(value) for model, value in json.load(f).items()})
+    golden = load_golden(args.golden)
+
+    if args.mode == 'stub':
+        client = StubClient()
+    elif args.mode == 'replay':
+        client = transport.wrap_openai(None)
+    else:
+        from openai import OpenAI
+        client = transport.wrap_openai(OpenAI())
+
+    results = []
+    for variant in variants:
+        print(f"▶ {variant['name']} ...", file=sys.stderr)
+        results.append(evaluate(client, golden, variant, prices, args.tolerance))
+
+    print_report(results, len(golden))
+    best = recommend(results, args.max_drop)
+    print(f"\n推奨: {best['variant']['name']}（基準 {results[0]['variant']['name']} からの精度低下 {args.max_drop:.0%} 以内で最速）")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"✅ {args.json} に書き出しました")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+参照されなくなった設計図の実体の削除（app/utils/blob_store.py）
+
+自動見積もりの削除などで参照数が0になり、BLOB_GC_GRACE_HOURS 経った実体を
+保存先（Cloudinary / S3 / ローカル）から削除します。Heroku Scheduler などで定期的に実行してください。
+
+    python gc_blueprints.py              # 削除
+    python gc_blueprints.py --dry-run    # 対象の件数とサイズだけ表示
+    python gc_blueprints.py --grace-hours 72 --limit 500
+"""
+import argparse
+import os
+import sys
+
+# アプリケーションのルートディレクトリをパスに追加
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    from app.utils import blob_store
+    from app.utils.db import get_db_connection
+
+    parser = argparse.ArgumentParser(description='参照されなくなった設計図の実体の削除')
+    parser.add_argument('--grace-hours', type=float, default=blob_store.GC_GRACE_HOURS,
+                        help='参照数が0になってから削除するまでの時間')
+    parser.add_argument('--limit', type=int, default=blob_store.GC_BATCH_SIZE, help='1回に削除する件数の上限')
+    parser.add_argument('--dry-run', action='store_true', help='削除せずに対象だけ数える')
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        stats = blob_store.collect_garbage(conn, args.grace_hours, args.limit, dry_run=args.dry_run)
+    except Exception as e:
+        print(f"❌ 削除に失敗しました: {e}")
+        return 1
+    finally:
+        conn.close()
+
+    print(f"参照数を数え直した実体: {stats['reconciled']}件")
+    if args.dry_run:
+        print(f"✅ 削除対象: {stats['candidates']}件（{stats['bytes'] / 1024 / 1024:.1f} MB）")
+        return 0
+    print(f"✅ 削除: {stats['deleted']}/{stats['candidates']}件、派生画像 {stats['derivatives']}件"
+          f"（{stats['bytes'] / 1024 / 1024:.1f} MB）")
+    if stats['errors']:
+        print(f"❌ 実体を削除できなかったもの: {stats['errors']}件（ログを確認してください）")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+ローカルに保存した設計図ファイルを STORAGE_BACKEND（S3互換・Cloudinary）に移行
+
+複数の dyno / ノードで動かす前に実行してください。ローカルのファイルは
+保存したノードからしか読めません。
+
+- T_設計図ブロブ の保存先が local の実体を移し、ファイルパスを書き換えます
+- content_hash の無い（migrations/009 より前の）ローカルのファイルは、内容の
+  SHA-256 で実体にまとめてから移します
+
+    python migrate_blueprint_storage.py --dry-run
+    python migrate_blueprint_storage.py                   # STORAGE_BACKEND に移行
+    python migrate_blueprint_storage.py --to s3 --delete-local
+
+移行は1件ずつコミットするので、途中で止めても再実行で続きから移行できます。
+"""
+import argparse
+import os
+import sys
+
+# アプリケーションのルートディレクトリをパスに追加
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _local_blobs(cur, limit):
+    cur.execute('''
+        SELECT "content_hash", "ファイルパス", "ファイルタイプ"
+        FROM "T_設計図ブロブ"
+        WHERE "保存先" = 'local'
+        ORDER BY "作成日時"
+        LIMIT %s
+    ''', (limit,))
+    return cur.fetchall()
+
+
+def _legacy_files(cur, limit):
+    cur.execute('''
+        SELECT "ID", "ファイルパス", "ファイルタイプ"
+        FROM "T_設計図ファイル"
+        WHERE "content_hash" IS NULL
+          AND "ファイルパス" NOT LIKE 'http://%%'
+          AND "ファイルパス" NOT LIKE 'https://%%'
+          AND "ファイルパス" NOT LIKE 's3://%%'
+        ORDER BY "ID"
+        LIMIT %s
+    ''', (limit,))
+    return cur.fetchall()
+
+
+def migrate_blobs(conn, target, limit, delete_local):
+    """
+    保存先が local の実体を target に移す
+
+    Returns:
+        dict: {'moved', 'missing', 'errors'}
+    """
+    from app.utils import storage
+
+    stats = {'moved': 0, 'missing': 0, 'errors': 0}
+    backend = storage.get_backend(target)
+    cur = conn.cursor()
+    try:
+        for digest, filepath, filetype in _local_blobs(cur, limit):
+            if not os.path.exists(filepath):
+                print(f"❌ ファイルがありません: {filepath}")
+                stats['missing'] += 1
+                continue
+            try:
+                with open(filepath, 'rb') as f:
+                    location = backend.put(f"{digest}.{filetype}", f, filetype)
+                cur.execute('''
+                    UPDATE "T_設計図ブロブ" SET "保存先" = %s, "ファイルパス" = %s WHERE "content_hash" = %s
+                ''', (backend.name, location, digest))
+                cur.execute('''
+                    UPDATE "T_設計図ファイル" SET "ファイルパス" = %s WHERE "content_hash" = %s
+                ''', (location, digest))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"❌ 移行に失敗しました: {filepath} {e}")
+                stats['errors'] += 1
+                continue
+            stats['moved'] += 1
+            if delete_local:
+                os.remove(filepath)
+    finally:
+        cur.close()
+    return stats
+
+
+def migrate_legacy(conn, target, limit, delete_local):
+    """
+    content_hash の無いローカルのファイルを実体にまとめて target に移す
+
+    Returns:
+        dict: {'moved', 'missing', 'errors'}
+    """
+    from app.utils import blob_store
+
+    stats = {'moved': 0, 'missing': 0, 'errors': 0}
+    cur = conn.cursor()
+    try:
+        for file_id, filepath, filetype in _legacy_files(cur, limit):
+            if not os.path.exists(filepath):
+                print(f"❌ ファイルがありません: {filepath}（ID {file_id}）")
+                stats['missing'] += 1
+                continue
+            try:
+                with open(filepath, 'rb') as f:
+                    digest, location = blob_store.acquire(cur, f, filetype, backend=target, fallback=False)
+                cur.execute('''
+                    UPDATE "T_設計図ファイル" SET "ファイルパス" = %s, "content_hash" = %s WHERE "ID" = %s
+                ''', (location, digest, file_id))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"❌ 移行に失敗しました: {filepath}（ID {file_id}） {e}")
+                stats['errors'] += 1
+                continue
+            stats['moved'] += 1
+            if delete_local:
+                # 旧形式のファイル名はアップロードごとに異なるので、他の行からは参照されない
+                os.remove(filepath)
+    finally:
+        cur.close()
+    return stats
+
+
+def main():
+    from app.utils import storage
+    from app.utils.db import get_db_connection
+
+    parser = argparse.ArgumentParser(description='ローカルの設計図ファイルの移行')
+    parser.add_argument('--to', default=storage.BACKEND, help='移行先（既定は STORAGE_BACKEND）')
+    parser.add_argument('--limit', type=int, default=1000, help='1回に移行する件数の上限（実体・旧形式それぞれ）')
+    parser.add_argument('--delete-local', action='store_true', help='移行したローカルのファイルを削除する')
+    parser.add_argument('--dry-run', action='store_true', help='移行せずに対象だけ数える')
+    args = parser.parse_args()
+
+    if args.to == 'local':
+        print("❌ 移行先に local は指定できません（--to s3 / cloudinary）")
+        return 1
+    try:
+        storage.get_backend(args.to)
+    except storage.StorageError as e:
+        print(f"❌ {e}")
+        return 1
+
+    conn = get_db_connection()
+    try:
+        if args.dry_run:
+            cur = conn.cursor()
+            blobs = _local_blobs(cur, args.limit)
+            legacy = _legacy_files(cur, args.limit)
+            cur.close()
+            print(f"✅ 移行対象: 実体 {len(blobs)}件、旧形式のファイル {len(legacy)}件（移行先: {args.to}）")
+            return 0
+        results = {
+            '実体': migrate_blobs(conn, args.to, args.limit, args.delete_local),
+            '旧形式のファイル': migrate_legacy(conn, args.to, args.limit, args.delete_local),
+        }
+    finally:
+        conn.close()
+
+    failed = False
+    for label, stats in results.items():
+        print(f"✅ {label}: {stats['moved']}件を {args.to} に移行"
+              f"（ファイルなし {stats['missing']}件、失敗 {stats['errors']}件）")
+        failed = failed or stats['errors'] > 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,26 @@
+-- 008_add_ai_usage_ledger.sql
+-- OpenAI の利用履歴（テナント別の利用台帳）テーブルを作成
+
+CREATE TABLE IF NOT EXISTS "T_AI利用履歴" (
+    "ID" SERIAL PRIMARY KEY,
+    "テナントID" INTEGER NOT NULL,
+    "店舗ID" INTEGER,
+    -- 自動見積もりを削除しても利用履歴は残すため外部キーにしない
+    "自動見積もりID" INTEGER,
+    "サービス" VARCHAR(50) NOT NULL DEFAULT 'openai',
+    "モデル" VARCHAR(100),
+    "入力トークン" INTEGER NOT NULL DEFAULT 0,
+    "出力トークン" INTEGER NOT NULL DEFAULT 0,
+    "所要時間" NUMERIC(10, 3) NOT NULL DEFAULT 0,
+    "待ち時間" NUMERIC(10, 3) NOT NULL DEFAULT 0,
+    "結果" VARCHAR(20) NOT NULL DEFAULT 'ok',
+    "作成日時" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON COLUMN "T_AI利用履歴"."所要時間" IS 'API呼び出しの所要時間（秒）';
+COMMENT ON COLUMN "T_AI利用履歴"."待ち時間" IS 'テナント別レート制限で待った時間（秒）';
+COMMENT ON COLUMN "T_AI利用履歴"."結果" IS 'ok / error / rate_limited';
+
+-- インデックス作成（テナント別・期間別の集計用）
+CREATE INDEX IF NOT EXISTS "idx_ai_usage_tenant_created" ON "T_AI利用履歴"("テナントID", "作成日時");
+CREATE INDEX IF NOT EXISTS "idx_ai_usage_created" ON "T_AI利用履歴"("作成日時");
@@ -0,0 +1,27 @@
+-- 009_add_blueprint_blobs.sql
+-- 設計図ファイルの実体を内容の SHA-256 で1件にまとめる（重複アップロードの排除）
+
+CREATE TABLE IF NOT EXISTS "T_設計図ブロブ" (
+    "content_hash" VARCHAR(64) PRIMARY KEY,
+    "保存先" VARCHAR(50) NOT NULL,
+    "ファイルパス" VARCHAR(500) NOT NULL,
+    "ファイルタイプ" VARCHAR(50) NOT NULL,
+    "サイズ" BIGINT NOT NULL DEFAULT 0,
+    "参照数" INTEGER NOT NULL DEFAULT 0,
+    "作成日時" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "最終参照日時" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON COLUMN "T_設計図ブロブ"."content_hash" IS 'ファイル内容の SHA-256（16進）';
+COMMENT ON COLUMN "T_設計図ブロブ"."保存先" IS 'cloudinary / local';
+COMMENT ON COLUMN "T_設計図ブロブ"."参照数" IS 'この実体を参照している T_設計図ファイル の件数';
+COMMENT ON COLUMN "T_設計図ブロブ"."最終参照日時" IS '参照数が最後に変わった日時（参照数0の実体の削除猶予の起点）';
+
+-- 設計図ファイルから実体への参照（既存の行は NULL のまま、従来どおり個別のファイル）
+-- 参照中の実体は削除できない
+ALTER TABLE "T_設計図ファイル"
+    ADD COLUMN IF NOT EXISTS "content_hash" VARCHAR(64) REFERENCES "T_設計図ブロブ"("content_hash");
+
+-- インデックス作成（重複の検索・参照数の数え直し用、削除対象の検索用）
+CREATE INDEX IF NOT EXISTS "idx_blueprint_file_content_hash" ON "T_設計図ファイル"("content_hash");
+CREATE INDEX IF NOT EXISTS "idx_blueprint_blob_unreferenced" ON "T_設計図ブロブ"("最終参照日時") WHERE "参照数" = 0;
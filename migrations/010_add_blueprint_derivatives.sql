@@ -0,0 +1,14 @@
+-- 010_add_blueprint_derivatives.sql
+-- 設計図のサムネイル・プレビュー（派生画像）のキャッシュ
+
+CREATE TABLE IF NOT EXISTS "T_設計図派生" (
+    -- 実体の削除後に派生画像の行を消すため外部キーにしない（blob_store.collect_garbage）
+    "content_hash" VARCHAR(64) NOT NULL,
+    "サイズ" VARCHAR(20) NOT NULL,
+    "ファイルパス" VARCHAR(500) NOT NULL,
+    "バイト数" INTEGER NOT NULL DEFAULT 0,
+    "作成日時" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY ("content_hash", "サイズ")
+);
+
+COMMENT ON COLUMN "T_設計図派生"."サイズ" IS 'サイズ名（thumb / preview など、DERIVATIVE_SIZES）';
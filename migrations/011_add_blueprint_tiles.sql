@@ -0,0 +1,22 @@
+-- 011_add_blueprint_tiles.sql
+-- 設計図の拡大表示用タイル（Deep Zoom）の作成状態
+
+CREATE TABLE IF NOT EXISTS "T_設計図タイル" (
+    -- 実体の削除後にタイルを消すため外部キーにしない（blob_store.collect_garbage）
+    "content_hash" VARCHAR(64) NOT NULL,
+    "ページ" INTEGER NOT NULL,
+    "ページ数" INTEGER NOT NULL DEFAULT 1,
+    "状態" VARCHAR(20) NOT NULL DEFAULT 'building',
+    "保存先" VARCHAR(50) NOT NULL,
+    "幅" INTEGER,
+    "高さ" INTEGER,
+    "タイルサイズ" INTEGER,
+    "重なり" INTEGER,
+    "エラー" TEXT,
+    "作成日時" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "更新日時" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY ("content_hash", "ページ")
+);
+
+COMMENT ON COLUMN "T_設計図タイル"."状態" IS 'building / ready / failed';
+COMMENT ON COLUMN "T_設計図タイル"."保存先" IS 'タイルの保存先（local / s3、TILE_STORAGE_BACKEND）';
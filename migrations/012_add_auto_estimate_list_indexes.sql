@@ -0,0 +1,14 @@
+-- 012_add_auto_estimate_list_indexes.sql
+-- 自動見積もり一覧のページ送りと、放置された自動見積もりの削除（app/utils/reaper.py）用のインデックス
+
+-- 一覧（テナントごとに新しい順、1ページずつ）
+CREATE INDEX IF NOT EXISTS "idx_auto_estimate_tenant_created"
+    ON "T_自動見積もり"("テナントID", "作成日時" DESC, "ID" DESC);
+
+-- 削除対象の検索（解析中のまま更新されていないもの）
+CREATE INDEX IF NOT EXISTS "idx_auto_estimate_analyzing_updated"
+    ON "T_自動見積もり"("更新日時") WHERE "ステータス" = '解析中';
+
+-- 手動見積もりから参照されている自動見積もりの確認
+CREATE INDEX IF NOT EXISTS "idx_signboard_estimate_auto_estimate_id"
+    ON "T_看板見積もり"("自動見積もりID") WHERE "自動見積もりID" IS NOT NULL;
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+放置された自動見積もりの削除（app/utils/reaper.py）
+
+AI解析を始めたまま REAPER_MAX_AGE_HOURS 以上更新されていない（顧客名が空で「解析中」の）
+自動見積もりを、設計図ファイルと保存先（Cloudinary / S3 / ローカル）の実体ごと削除し、
+空いた容量を表示します。Heroku Scheduler などで1日1回程度実行してください。
+
+    python reap_auto_estimates.py              # 削除
+    python reap_auto_estimates.py --dry-run    # 対象の件数だけ表示
+    python reap_auto_estimates.py --max-age-hours 168 --batch-size 50 --max-batches 10
+"""
+import argparse
+import os
+import sys
+
+# アプリケーションのルートディレクトリをパスに追加
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    from app.utils import reaper
+    from app.utils.db import get_db_connection
+
+    parser = argparse.ArgumentParser(description='放置された自動見積もりの削除')
+    parser.add_argument('--max-age-hours', type=float, default=reaper.MAX_AGE_HOURS,
+                        help='最後に更新されてから削除するまでの時間')
+    parser.add_argument('--batch-size', type=int, default=reaper.BATCH_SIZE, help='1回のトランザクションで削除する件数')
+    parser.add_argument('--max-batches', type=int, default=reaper.MAX_BATCHES, help='1回の実行で処理するバッチ数の上限')
+    parser.add_argument('--dry-run', action='store_true', help='削除せずに対象だけ数える')
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if args.dry_run:
+            cur = conn.cursor()
+            estimates, files = reaper.count_stale(cur, args.max_age_hours)
+            cur.close()
+            print(f"✅ 削除対象: 自動見積もり {estimates}件、設計図ファイル {files}件")
+            return 0
+        stats = reaper.reap(conn, args.max_age_hours, args.batch_size, args.max_batches)
+    except Exception as e:
+        print(f"❌ 削除に失敗しました: {e}")
+        return 1
+    finally:
+        conn.close()
+
+    print(f"✅ 削除: 自動見積もり {stats['estimates']}件、設計図ファイル {stats['files']}件")
+    print(f"   保存先から削除: 実体 {stats['blobs_deleted']}件、旧形式のファイル {stats['legacy_deleted']}件、"
+          f"派生画像 {stats['derivatives']}件（{stats['bytes'] / 1024 / 1024:.1f} MB）")
+    if stats['errors']:
+        print(f"❌ 保存先から削除できなかったもの: {stats['errors']}件（ログを確認してください）")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+テスト共通のフィクスチャ
+
+DBを使うテストは TEST_DATABASE_URL（PostgreSQL）が設定されているときだけ実行します。
+そのDBの public スキーマはテストの開始時に作り直すので、テスト専用のDBを指定してください。
+
+    TEST_DATABASE_URL=postgresql://postgres@127.0.0.1:5432/signboard_test python -m pytest -q
+"""
+
+import os
+import sys
+from contextlib import contextmanager
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+if TEST_DATABASE_URL:
+    # app.db は import 時に DATABASE_URL でエンジンを作るので、先に差し替える
+    os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+
+
+# ===========================
+# クエリ件数の予算（app/utils/query_budget.py）
+# ===========================
+@pytest.fixture
+def assert_max_queries():
+    """with assert_max_queries(K): ... でスコープ内のSQLが K 件以下であることを検証する"""
+    from app.utils.query_budget import N_PLUS_ONE_THRESHOLD, QueryBudgetExceeded, max_queries
+
+    @contextmanager
+    def _assert(limit, allow_n_plus_one=False, threshold=N_PLUS_ONE_THRESHOLD):
+        try:
+            with max_queries(limit, allow_n_plus_one, threshold) as collector:
+                yield collector
+        except QueryBudgetExceeded as e:
+            pytest.fail(str(e), pytrace=False)
+    return _assert
+
+
+# ===========================
+# シード済みのDBとアプリ
+# ===========================
+# N+1 があれば N_PLUS_ONE_THRESHOLD（既定5）回以上繰り返されるだけの件数を入れる
+SEED_COUNT = 8
+
+
+def _reset_schema():
+    import psycopg2
+
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute('DROP SCHEMA public CASCADE')
+    cur.execute('CREATE SCHEMA public')
+    conn.close()
+
+
+def _seed(conn):
+    """テナント1件に、管理者・店舗・従業員・見積タイプを SEED_COUNT 件ずつ入れる"""
+    from werkzeug.security import generate_password_hash
+
+    password_hash = generate_password_hash('password')
+    cur = conn.cursor()
+    cur.execute('''
+        INSERT INTO "T_テナント" ("名称", slug, accounting_method) VALUES (%s, %s, 'tax_inclusive') RETURNING id
+    ''', ('テスト看板', 'test-sign'))
+    tenant_id = cur.fetchone()[0]
+    for app_id in ('signboard', 'auto-estimate', 'survey-app'):
+        cur.execute('INSERT INTO "T_テナントアプリ設定" (tenant_id, app_id, enabled) VALUES (%s, %s, 1)',
+                    (tenant_id, app_id))
+
+    admin_ids = []
+    for i in range(SEED_COUNT):
+        cur.execute('''
+            INSERT INTO "T_管理者" (login_id, name, email, password_hash, role, tenant_id, active, is_owner)
+            VALUES (%s, %s, %s, %s, 'tenant_admin', %s, 1, %s) RETURNING id
+        ''', (f'admin{i}', f'管理者{i}', f'admin{i}@example.com', password_hash, tenant_id, 1 if i == 0 else 0))
+        admin_id = cur.fetchone()[0]
+        admin_ids.append(admin_id)
+        cur.execute('''
+            INSERT INTO "T_テナント管理者_テナント" (admin_id, tenant_id, is_owner, can_manage_tenant_admins)
+            VALUES (%s, %s, %s, 1)
+        ''', (admin_id, tenant_id, 1 if i == 0 else 0))
+
+    store_ids = []
+    for i in range(SEED_COUNT):
+        cur.execute('INSERT INTO "T_店舗" (tenant_id, "名称", slug) VALUES (%s, %s, %s) RETURNING id',
+                    (tenant_id, f'店舗{i}', f'store-{i}'))
+        store_ids.append(cur.fetchone()[0])
+
+    cur.execute('''
+        INSERT INTO "T_従業員" (email, login_id, name, password_hash, tenant_id, active)
+        VALUES ('staff@example.com', 'staff', '従業員', %s, %s, 1) RETURNING id
+    ''', (password_hash, tenant_id))
+    employee_id = cur.fetchone()[0]
+    for store_id in store_ids:
+        cur.execute('INSERT INTO "T_従業員_店舗" (employee_id, store_id) VALUES (%s, %s)', (employee_id, store_id))
+
+    # 見積タイプは migrations/004 の既定データに足して SEED_COUNT 件以上にする
+    for i in range(SEED_COUNT):
+        cur.execute('''
+            INSERT INTO "T_見積タイプ" (name, code, display_order) VALUES (%s, %s, %s) RETURNING id
+        ''', (f'テスト{i}', f'test_{i}', 100 + i))
+        type_id = cur.fetchone()[0]
+        cur.execute('''
+            INSERT INTO "T_見積サブタイプ" (estimate_type_id, name, code, display_order) VALUES (%s, %s, %s, 1)
+        ''', (type_id, f'テスト{i}-1', f'test_{i}_1'))
+    conn.commit()
+    cur.close()
+    return {'tenant_id': tenant_id, 'admin_ids': admin_ids, 'store_ids': store_ids, 'employee_id': employee_id}
+
+
+@pytest.fixture(scope='session')
+def seeded_app():
+    """スキーマを作り直してシードしたDBにつないだアプリ（TEST_DATABASE_URL が無ければスキップ）"""
+    if not TEST_DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL が設定されていません')
+    _reset_schema()
+
+    from app import create_app
+    from app.db import Base, engine
+    from app.utils.db import get_db_connection
+
+    # テーブルは app の import 時に作られるが、スキーマを消した後なので作り直す
+    Base.metadata.create_all(bind=engine)
+    app = create_app()
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        # 見積タイプの表と既定データだけを作る（T_大分類 は migrations/002 が前提とする
+        # 明細テーブルがモデルに無いので、それに触れる文は飛ばす）
+        with open(os.path.join(ROOT_DIR, 'migrations', '004_add_estimate_type_system.sql'), encoding='utf-8') as f:
+            for statement in f.read().split(';'):
+                if statement.strip() and '"T_大分類"' not in statement:
+                    cur.execute(statement)
+        conn.commit()
+        app.config['SEED'] = _seed(conn)
+    finally:
+        conn.close()
+    return app
+
+
+def _login(app, role, user_id, **extra):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+        sess['user_name'] = 'テスト'
+        sess['role'] = role
+        sess['tenant_id'] = app.config['SEED']['tenant_id']
+        sess.update(extra)
+    return client
+
+
+@pytest.fixture
+def tenant_admin_client(seeded_app):
+    """オーナーのテナント管理者でログインしたクライアント"""
+    return _login(seeded_app, 'tenant_admin', seeded_app.config['SEED']['admin_ids'][0], is_owner=True)
+
+
+@pytest.fixture
+def employee_client(seeded_app):
+    """従業員でログインしたクライアント"""
+    return _login(seeded_app, 'employee', seeded_app.config['SEED']['employee_id'], store_id=None)
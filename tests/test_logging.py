@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""JSON ログ（app/logging.py）"""
+
+import json
+import logging
+import queue
+
+from app.logging import JsonFormatter, RecordQueueHandler
+
+
+def _queued_record(log):
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger('tests.logging')
+    logger.addHandler(RecordQueueHandler(log_queue))
+    logger.propagate = False
+    try:
+        log(logger)
+    finally:
+        logger.handlers.clear()
+        logger.propagate = True
+    return log_queue.get_nowait()
+
+
+def test_exception_keeps_exc_info_field():
+    def log(logger):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception('boom %s', 42)
+
+    record = _queued_record(log)
+    # 整形はリスナー側で行う（msg / args はそのまま、トレースバックのフレームは渡さない）
+    assert (record.msg, record.args, record.exc_info) == ('boom %s', (42,), None)
+
+    output = json.loads(JsonFormatter().format(record))
+    assert output['message'] == 'boom 42'
+    assert output['exc_info'].startswith('Traceback')
+    assert 'ZeroDivisionError' in output['exc_info']
+
+
+def test_plain_message_has_no_exc_info():
+    record = _queued_record(lambda logger: logger.warning('done'))
+    output = json.loads(JsonFormatter().format(record))
+    assert output['message'] == 'done'
+    assert 'exc_info' not in output
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""白紙・重複ページの検出（app/utils/page_dedup.py）"""
+
+import io
+
+from PIL import Image, ImageDraw
+
+from app.utils import page_dedup
+
+
+def _thin_line_drawing(size=(4960, 3508)):
+    """A4 横 600dpi 相当に 1px の線だけで描いた図面"""
+    image = Image.new('L', size, 255)
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    draw.rectangle((200, 200, width - 200, height - 200), outline=0, width=1)
+    for x in range(600, width - 600, 700):
+        draw.line((x, 400, x, height - 400), fill=0, width=1)
+    draw.line((400, height // 2, width - 400, height // 2), fill=0, width=1)
+    return image
+
+
+def test_thin_line_drawing_is_not_blank():
+    image = _thin_line_drawing()
+    assert page_dedup.ink_coverage(image) >= page_dedup.BLANK_INK_COVERAGE
+    assert page_dedup.PageDeduplicator().check_image(image, 1) == ('new', 1)
+
+
+def test_thin_line_drawing_jpeg_is_not_blank():
+    buffer = io.BytesIO()
+    _thin_line_drawing().save(buffer, 'JPEG', quality=85)
+    assert page_dedup.PageDeduplicator().check_image(buffer.getvalue(), 1) == ('new', 1)
+
+
+def test_blank_page_with_specks_is_blank():
+    image = Image.new('L', (4960, 3508), 255)
+    draw = ImageDraw.Draw(image)
+    for i in range(20):
+        draw.point((100 + i * 200, 150 + i * 150), fill=0)
+    dedup = page_dedup.PageDeduplicator()
+    assert dedup.check_image(image, 1) == ('blank', None)
+    assert dedup.skipped['blank'] == 1
+
+
+def test_duplicate_page():
+    dedup = page_dedup.PageDeduplicator()
+    assert dedup.check_image(_thin_line_drawing(), 1) == ('new', 1)
+    assert dedup.check_image(_thin_line_drawing(), 2) == ('duplicate', 1)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""ベクターPDFのテキスト層からの抽出（app/utils/pdf_text.py）と、画像解析への振り分け"""
+
+import pytest
+
+from app.utils import extraction, pdf_text
+
+
+def _line(text, x=100, y=100):
+    return {'text': text, 'bbox': (x, y, x + 10 * len(text), y + 12)}
+
+
+def _pages(*pages):
+    return [{'page': number, 'width': 842, 'height': 595, 'lines': lines} for number, lines in enumerate(pages, 1)]
+
+
+def test_only_pages_with_dimensions_are_vector(monkeypatch):
+    monkeypatch.setattr(pdf_text, 'read_pages', lambda pdf: _pages(
+        [_line('W1800 x H600'), _line('アルミ複合板 t3', y=130)],
+        # 表題欄だけが文字で、寸法はアウトライン化されたCAD出力
+        [_line('株式会社テスト看板'), _line('図面番号 A-102 2024/05/01', y=130)],
+        # スキャン画像のOCR層
+        [_line('看板 正面図 縮尺 1/20')],
+        [],
+    ))
+
+    pages = pdf_text.extract(b'%PDF')
+
+    assert [page['vector'] for page in pages] == [True, False, False, False]
+    assert [(item['width'], item['height']) for item in pages[0]['items']] == [(1800, 600)]
+
+
+@pytest.fixture
+def analyze_stubs(monkeypatch):
+    """pdftotext・画像変換・AI を差し替えて、どのページがどの経路で解析されたかを記録する"""
+    import pdf2image
+
+    from app.blueprints import auto_estimate
+    from app.utils import page_dedup
+
+    calls = []
+
+    def extract_text(client, text, budget=None):
+        calls.append(('text', text))
+        return {'items': []}
+
+    def analyze_single_image(client, image, *args, budget=None):
+        calls.append(('image', image))
+        return {'items': [{'material_name': '不明', 'width': 900, 'height': 450, 'quantity': 1}]}
+
+    monkeypatch.setattr(pdf_text, 'read_pages', lambda pdf: _pages(
+        [_line('株式会社テスト看板'), _line('図面番号 A-102 2024/05/01', y=130)],
+        [_line('幅 1200 ステンレス'), _line('サイン 2台', y=130)],
+    ))
+    monkeypatch.setattr(extraction, 'extract_text', extract_text)
+    monkeypatch.setattr(auto_estimate, 'analyze_single_image', analyze_single_image)
+    monkeypatch.setattr(pdf2image, 'convert_from_bytes',
+                        lambda content, size, first_page, last_page: [f'page-{first_page}'])
+    monkeypatch.setattr(page_dedup.PageDeduplicator, 'check_image', lambda self, image, label: ('new', None))
+
+    def run():
+        dedup = page_dedup.PageDeduplicator()
+        return list(auto_estimate.iter_file_pages(None, 'a.pdf', 'pdf', b'%PDF', dedup))
+    return run, calls
+
+
+def test_pages_without_dimensions_are_rasterized(analyze_stubs):
+    run, calls = analyze_stubs
+
+    events = run()
+
+    # 1ページ目は寸法が無いのでテキストを送らずに画像、2ページ目は寸法があるのでまずテキスト
+    assert [kind for kind, _ in calls] == ['text', 'image', 'image']
+    assert [image for kind, image in calls if kind == 'image'] == ['page-1', 'page-2']
+    parsed = [(event['page'], event['source']) for event in events if event['stage'] == 'parsed']
+    assert parsed == [(1, 'image'), (2, 'image')]
+    assert all(event['items'] for event in events if event['stage'] == 'parsed')
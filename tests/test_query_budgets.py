@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+主要画面のクエリ件数の予算（N+1 の再発防止）
+
+シードは SEED_COUNT 件ずつなので、行ごとにクエリを発行するとすぐ予算を超え、
+同形SQLの繰り返しとしても検出されます。件数を増やす変更をしたら予算も見直してください。
+"""
+
+
+def test_tenant_admins(tenant_admin_client, assert_max_queries):
+    with assert_max_queries(8):
+        response = tenant_admin_client.get('/tenant_admin/tenant_admins')
+    assert response.status_code == 200
+    assert '管理者7'.encode() in response.data
+
+
+def test_estimate_type_manage(tenant_admin_client, assert_max_queries):
+    with assert_max_queries(4):
+        response = tenant_admin_client.get('/signboard/estimate/manage')
+    assert response.status_code == 200
+    assert 'テスト7-1'.encode() in response.data
+
+
+def test_employee_mypage(employee_client, assert_max_queries):
+    with assert_max_queries(5):
+        response = employee_client.get('/employee/mypage')
+    assert response.status_code == 200
+    assert '店舗7'.encode() in response.data
+
+
+def test_tenant_admin_dashboard(tenant_admin_client, assert_max_queries):
+    with assert_max_queries(3):
+        response = tenant_admin_client.get('/tenant_admin/')
+    assert response.status_code == 200
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""外部サービスの通信の差し替え（app/utils/transport.py）"""
+
+import io
+
+import cloudinary.uploader
+
+from app.utils import transport
+
+
+def test_large_upload_is_sent_in_parts(monkeypatch):
+    parts = []
+
+    def upload_large_part(file, http_headers=None, **options):
+        name, chunk = file
+        parts.append((name, http_headers['Content-Range'], chunk))
+        return {'public_id': 'blueprints/test', 'bytes': len(chunk)}
+
+    monkeypatch.setattr(transport, 'MODE', 'live')
+    monkeypatch.setattr(transport, 'CLOUDINARY_LARGE_UPLOAD_BYTES', 10)
+    monkeypatch.setattr(cloudinary.uploader, 'upload_large_part', upload_large_part)
+    file = io.BytesIO(b'0123456789' * 5)
+
+    response = transport.upload(file, public_id='blueprints/test', chunk_size=20)
+
+    assert response['public_id'] == 'blueprints/test'
+    assert [(name, content_range) for name, content_range, _ in parts] == [
+        ('blueprint', 'bytes 0-19/50'), ('blueprint', 'bytes 20-39/50'), ('blueprint', 'bytes 40-49/50'),
+    ]
+    assert b''.join(chunk for _, _, chunk in parts) == file.getvalue()
+    # upload_large は送信後にファイルを閉じるが、呼び出し側のファイルはそのまま使える
+    assert not file.closed